@@ -0,0 +1,291 @@
+import argparse
+import bisect
+import json
+import os
+import re
+import threading
+import time
+import logging
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+FUNNEL_STAGES = ("store", "selected", "pay", "activated")
+
+# Approval latency buckets in seconds (upper bounds; +Inf is implicit)
+APPROVAL_BUCKETS = (60, 300, 900, 1800, 3600, 2 * 3600, 6 * 3600, 12 * 3600, 86400, 2 * 86400, 3 * 86400)
+
+
+def _day_of(when):
+    if when is None:
+        return datetime.now().strftime("%Y-%m-%d")
+    if isinstance(when, str):
+        return when[:10]
+    return when.strftime("%Y-%m-%d")
+
+
+def _parse_time(value):
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def format_duration(seconds):
+    if seconds == float("inf"):
+        return f">{format_duration(APPROVAL_BUCKETS[-1])}"
+    if seconds < 3600:
+        return f"{seconds / 60:.0f}m"
+    if seconds < 86400:
+        return f"{seconds / 3600:.1f}h"
+    return f"{seconds / 86400:.1f}d"
+
+
+# Amount an order brought in: what the provider reported, else its catalog item's
+# "$NN" price, else the "$NN" in its payment text
+def order_amount(order, items):
+    if order.get("paid_amount") is not None:
+        return float(order["paid_amount"])
+    item = items.get(order.get("item"))
+    match = re.search(r"\$(\d+(?:\.\d+)?)", item["price"] if item else order.get("payment", ""))
+    return float(match.group(1)) if match else 0.0
+
+
+# Seconds from the payment request to activation, or None if either time is missing
+def approval_latency(order):
+    requested, activated = _parse_time(order.get("timestamp")), _parse_time(order.get("activated_at"))
+    if requested is None or activated is None:
+        return None
+    return max((activated - requested).total_seconds(), 0.0)
+
+
+# Sales aggregates kept per day and updated as events happen, so a report only sums
+# the days it covers: funnel stage counts, revenue (orders, amount) per plan, and an
+# approval latency histogram. Snapshotted to `path` as JSON by flush(), which only
+# writes when something changed.
+class Analytics:
+    def __init__(self, path=None, buckets=APPROVAL_BUCKETS):
+        self.path = path
+        self.buckets = buckets
+        self._days = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.load()
+
+    # (Re)read the saved snapshot, replacing what is held in memory
+    def load(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                days = json.load(f)["days"]
+        except FileNotFoundError:
+            return
+        with self._lock:
+            self._days = days
+            self._dirty = False
+
+    def exists(self):
+        return bool(self._days) or bool(self.path and os.path.exists(self.path))
+
+    def _day(self, when):
+        day = _day_of(when)
+        entry = self._days.get(day)
+        if entry is None:
+            entry = self._days[day] = {
+                "funnel": dict.fromkeys(FUNNEL_STAGES, 0), "revenue": {},
+                "latency": [0] * (len(self.buckets) + 1), "latency_sum": 0.0,
+            }
+        return entry
+
+    def count(self, stage, when=None):
+        with self._lock:
+            self._day(when)["funnel"][stage] += 1
+            self._dirty = True
+
+    # An order was activated: revenue for its plan, its approval latency and the funnel's last stage
+    def activated(self, plan, amount, latency=None, when=None):
+        with self._lock:
+            entry = self._day(when)
+            entry["funnel"]["activated"] += 1
+            revenue = entry["revenue"].setdefault(plan, [0, 0.0])
+            revenue[0] += 1
+            revenue[1] += amount
+            if latency is not None:
+                entry["latency"][bisect.bisect_left(self.buckets, latency)] += 1
+                entry["latency_sum"] += latency
+            self._dirty = True
+
+    def reset(self):
+        with self._lock:
+            self._days = {}
+            self._dirty = True
+
+    # Totals over the last `days` days (today included), or all time
+    def summary(self, days=None, today=None):
+        today = today or datetime.now()
+        first = _day_of(today - timedelta(days=days - 1)) if days else ""
+        funnel = dict.fromkeys(FUNNEL_STAGES, 0)
+        revenue, daily = {}, {}
+        latency = [0] * (len(self.buckets) + 1)
+        latency_sum = 0.0
+        with self._lock:
+            for day, entry in self._days.items():
+                if day < first:
+                    continue
+                for stage, value in entry["funnel"].items():
+                    funnel[stage] = funnel.get(stage, 0) + value
+                for plan, (orders, amount) in entry["revenue"].items():
+                    total = revenue.setdefault(plan, [0, 0.0])
+                    total[0] += orders
+                    total[1] += amount
+                    daily[day] = daily.get(day, 0.0) + amount
+                for i, value in enumerate(entry["latency"]):
+                    latency[i] += value
+                latency_sum += entry["latency_sum"]
+        approvals = sum(latency)
+        return {
+            "funnel": funnel,
+            "revenue": revenue,
+            "daily": dict(sorted(daily.items())),
+            "total": sum(amount for _, amount in revenue.values()),
+            "approvals": approvals,
+            "latency_avg": latency_sum / approvals if approvals else None,
+            "latency_p50": self._quantile(latency, 0.5),
+            "latency_p90": self._quantile(latency, 0.9),
+        }
+
+    # Upper bound of the bucket holding the q-quantile (inf past the last bucket)
+    def _quantile(self, counts, q):
+        total = sum(counts)
+        if not total:
+            return None
+        seen = 0
+        for bound, value in zip(self.buckets + (float("inf"),), counts):
+            seen += value
+            if seen >= q * total:
+                return bound
+
+    def flush(self):
+        if not self.path:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            data = json.dumps({"days": self._days})
+            self._dirty = False
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+
+    def start(self, interval=60):
+        def run():
+            while not self._stop.wait(interval):
+                try:
+                    self.flush()
+                except Exception as e:
+                    logger.error("Failed to save analytics to %s: %s", self.path, e)
+        self._thread = threading.Thread(target=run, name="analytics-flush", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        self.flush()
+
+
+# One pass over (key, order) pairs. Every order counts as selected on its timestamp's
+# day (the payment request time once it has one), paid if a payment was requested, and
+# activated on its activated_at day (orders activated before that was recorded count on
+# their timestamp's day, without a latency). `items` are catalog items, for prices.
+def backfill_orders(analytics, orders, items):
+    count = 0
+    for _, order in orders:
+        count += 1
+        when = order.get("timestamp")
+        analytics.count("selected", when)
+        if order.get("status") != "selected" and order.get("transaction_id"):
+            analytics.count("pay", when)
+        activated_at = order.get("activated_at")
+        if activated_at or order.get("status") in ("activated", "expired"):
+            analytics.activated(order.get("plan", "N/A"), order_amount(order, items), approval_latency(order), activated_at or when)
+    return count
+
+
+TEXT_LINE = re.compile(r"^(\d{4}-\d\d-\d\d) \d\d:\d\d:\d\d,\d{3} - \w+ - (.*)$")
+LOG_STAGES = (
+    ("store", re.compile(r"^User \d+ sent message: (🛒|\\U0001f6d2) Store$")),
+    ("selected", re.compile(r"^User \d+ selected ")),
+    ("pay", re.compile(r"^Admin \d+ notified of Website payment request ")),
+    ("activated", re.compile(r"^(Admin \d+ activated|Auto-activated) purchase ")),
+)
+
+
+# One pass over bot.log lines (text or JSON) counting the funnel `stages` on the day they
+# were logged. The log has no prices, so revenue and latency come from backfill_orders.
+def backfill_log(analytics, lines, stages=FUNNEL_STAGES):
+    count = 0
+    for line in lines:
+        line = line.strip()
+        if line.startswith("{"):
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            day, message = entry.get("ts", "")[:10], entry.get("message", "")
+        else:
+            match = TEXT_LINE.match(line)
+            if not match:
+                continue
+            day, message = match.groups()
+        for stage, pattern in LOG_STAGES:
+            if stage in stages and pattern.match(message):
+                analytics.count(stage, day)
+                count += 1
+                break
+    return count
+
+
+# Rebuild analytics.json offline:
+#   python analytics.py --orders orders.json --log bot.log
+#   python analytics.py --backend sqlite --orders bot.db
+# With both sources, orders give revenue, latency and the selected/pay/activated stages
+# and the log gives Store clicks; with only the log, every stage comes from the log.
+def main():
+    from catalog import Catalog
+    from storage import open_repository
+
+    parser = argparse.ArgumentParser(description="Rebuild sales analytics from the order store and/or bot.log")
+    parser.add_argument("--orders", help="orders journal snapshot (journal backend) or database file (sqlite)")
+    parser.add_argument("--backend", default="journal", choices=("journal", "sqlite"))
+    parser.add_argument("--log", nargs="*", default=[], help="bot.log files, oldest first")
+    parser.add_argument("--catalog", default="catalog.json")
+    parser.add_argument("--out", default="analytics.json")
+    args = parser.parse_args()
+    if not args.orders and not args.log:
+        parser.error("give --orders and/or --log")
+
+    started = time.perf_counter()
+    analytics = Analytics(args.out)
+    analytics.reset()
+    if args.orders:
+        with open(args.catalog, "r", encoding="utf-8") as f:
+            items = Catalog(json.load(f)).items
+        repository = open_repository(args.backend, "orders", {"journal_path": args.orders, "sqlite_path": args.orders})
+        if args.backend == "journal":
+            repository.load_all()
+        print(f"Orders: {backfill_orders(analytics, repository.iter_after(''), items)}")
+        repository.close()
+    for path in args.log:
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            print(f"{path}: {backfill_log(analytics, f, ('store',) if args.orders else FUNNEL_STAGES)} events")
+    analytics.flush()
+    print(f"Wrote {args.out} in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,363 @@
+import argparse
+import gc
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from datetime import datetime, timedelta
+
+from fake_telegram_api import FakeTelegramAPI, synthetic_updates
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+SEED_FIRST_USER_ID = 200000000
+
+
+# Offline load test: runs bot.py against the local fake Bot API with a store
+# pre-seeded to each size, and reports updates/sec, handler latency and memory.
+# Every size runs in a fresh process, so memory figures are not shared between runs.
+#
+#   python benchmark.py --sizes 1000,100000,1000000 --users 500
+#   python benchmark.py --memory 1000000
+#   python benchmark.py --sizes 1000 --workers 1,2,4 --api-latency 0.02
+#
+# --workers runs workers.py (front receiver plus N worker processes, SQLite store)
+# once per worker count instead of the single-process bot.
+#
+# Outbound rate limits are lifted by default so the numbers measure the bot, not
+# Telegram's quotas; pass --production-rates to keep the configured limits.
+
+
+# Write subscriptions and orders snapshots with `size` records (one order per user),
+# streamed so the parent never holds them
+SEED_STATUSES = ("activated",) * 7 + ("rejected",) * 2 + ("pending",)
+SEED_STARTED = datetime(2025, 1, 1)
+
+
+def seed_record(i):
+    return {
+        "plan": "$45 for 3 Months" if i % 2 else "550 Sites $50",
+        "item": "plan_3m" if i % 2 else "price_550",
+        "payment": "$45 via Website" if i % 2 else "$50 via Website",
+        "status": SEED_STATUSES[i % len(SEED_STATUSES)],
+        "timestamp": str(SEED_STARTED + timedelta(seconds=i * 30, microseconds=i % 997 * 1001)),
+        "transaction_id": str(uuid.UUID(int=i)),
+    }
+
+
+def seed_subscriptions(path, size, orders_path=None):
+    with open(path, "w") as f, open(orders_path or os.devnull, "w") as orders:
+        f.write("{")
+        orders.write("{")
+        for i in range(size):
+            user_id = str(SEED_FIRST_USER_ID + i)
+            record = seed_record(i)
+            f.write(("," if i else "") + json.dumps(user_id) + ":" + json.dumps(record))
+            orders.write(("," if i else "") + json.dumps(record["transaction_id"]) + ":" + json.dumps(dict(record, user_id=user_id)))
+        f.write("}")
+        orders.write("}")
+
+
+# The same records in a SQLite database, as the sqlite backend stores them
+def seed_sqlite(path, size):
+    sys.path.insert(0, REPO_DIR)
+    from storage import SQLiteRepository
+
+    subscriptions, orders = SQLiteRepository(path, "subscriptions"), SQLiteRepository(path, "orders")
+    for i in range(size):
+        user_id = str(SEED_FIRST_USER_ID + i)
+        record = seed_record(i)
+        subscriptions.put(user_id, record)
+        orders.put(record["transaction_id"], dict(record, user_id=user_id))
+    subscriptions.close()
+    orders.close()
+
+
+def percentile(samples, q):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# Child process: import the bot (loading the seeded store), poll the fake API
+# until `expected` updates have been handled, then print one JSON result line.
+def run_child(expected, timeout):
+    sys.path.insert(0, REPO_DIR)
+    load_started = time.perf_counter()
+    import bot
+    load_seconds = time.perf_counter() - load_started
+    rss_after_load = max_rss_mb()
+
+    samples = []
+    errors = []
+    lock = threading.Lock()
+    done = threading.Event()
+
+    def timed(fn):
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                # Counted, not re-raised: telebot's threaded poller can drop the rest of a batch on a handler error
+                with lock:
+                    errors.append(repr(e))
+            finally:
+                with lock:
+                    samples.append(time.perf_counter() - started)
+                    if len(samples) >= expected:
+                        done.set()
+        return wrapper
+
+    for handlers in (bot.bot.message_handlers, bot.bot.callback_query_handlers):
+        for handler in handlers:
+            handler["function"] = timed(handler["function"])
+
+    started = time.perf_counter()
+    bot.polling_supervisor.start()
+    completed = done.wait(timeout)
+    handled_seconds = time.perf_counter() - started
+    drained = bot.outbound.drain(timeout)
+    total_seconds = time.perf_counter() - started
+    bot.polling_supervisor.stop()
+
+    print(json.dumps({
+        "handled": len(samples),
+        "completed": completed and drained,
+        "errors": len(errors),
+        "error_sample": errors[:3],
+        "load_seconds": load_seconds,
+        "handled_per_second": len(samples) / handled_seconds if handled_seconds else 0.0,
+        "end_to_end_per_second": len(samples) / total_seconds if total_seconds else 0.0,
+        "p50_ms": percentile(samples, 0.50) * 1000,
+        "p99_ms": percentile(samples, 0.99) * 1000,
+        "max_ms": max(samples, default=0.0) * 1000,
+        "rss_after_load_mb": rss_after_load,
+        "max_rss_mb": max_rss_mb(),
+    }), flush=True)
+    os._exit(0)
+
+
+# Child process for --workers: start workers.py's pool of `count` workers in this
+# directory, feed it from the fake API until `expected` updates have been handled,
+# stop it (each worker drains its outbound queue) and print one JSON result line.
+def run_workers_child(expected, timeout, count):
+    sys.path.insert(0, REPO_DIR)
+    from workers import WorkerPool, run_receiver, use_api_url
+
+    samples = []
+    errors = []
+    done = threading.Event()
+
+    def on_event(event):
+        if event[0] == "handled":
+            samples.append(event[2])
+            if event[3]:
+                errors.append(event[3])
+            if len(samples) >= expected:
+                done.set()
+
+    use_api_url(os.environ["TELEGRAM_API_URL"])
+    load_started = time.perf_counter()
+    pool = WorkerPool(count, lock_path=os.path.abspath("bot.leader.lock"), on_event=on_event)
+    pool.start(timeout)
+    load_seconds = time.perf_counter() - load_started
+
+    started = time.perf_counter()
+    receiver = threading.Thread(target=run_receiver, args=(pool, os.environ["TELEGRAM_BOT_TOKEN"]), kwargs={"poll_timeout": 1}, daemon=True)
+    receiver.start()
+    completed = done.wait(timeout)
+    handled_seconds = time.perf_counter() - started
+    pool.stop(timeout)
+    total_seconds = time.perf_counter() - started
+
+    print(json.dumps({
+        "handled": len(samples),
+        "completed": completed,
+        "errors": len(errors),
+        "error_sample": errors[:3],
+        "load_seconds": load_seconds,
+        "handled_per_second": len(samples) / handled_seconds if handled_seconds else 0.0,
+        "end_to_end_per_second": len(samples) / total_seconds if total_seconds else 0.0,
+        "p50_ms": percentile(samples, 0.50) * 1000,
+        "p99_ms": percentile(samples, 0.99) * 1000,
+        "max_ms": max(samples, default=0.0) * 1000,
+        "per_worker": pool.handled,
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }), flush=True)
+    os._exit(0)
+
+
+# Working directory for one bot process: catalog and logo copied from the repo
+def make_workdir(prefix):
+    workdir = tempfile.mkdtemp(prefix=prefix)
+    for name in ("catalog.json", "logo.png"):
+        shutil.copy(os.path.join(REPO_DIR, name), workdir)
+    return workdir
+
+
+# Start bot.py in `workdir` against `api`, counting `expected` handled updates (see run_child)
+def start_bot_child(api, workdir, expected, timeout, production_rates=False, workers=None):
+    env = dict(
+        os.environ,
+        TELEGRAM_BOT_TOKEN="1:benchmark",
+        TELEGRAM_API_URL=api.url,
+        SUBSCRIPTIONS_FILE=os.path.join(workdir, "subscriptions.json"),
+        ORDERS_FILE=os.path.join(workdir, "orders.json"),
+        STORAGE_BACKEND="journal",
+        LOG_FILE=os.path.join(workdir, "bot.log"),
+        METRICS_PORT="0",
+        POLL_TIMEOUT="1",
+    )
+    if not production_rates:
+        env.update(OUTBOUND_GLOBAL_RATE="1000000", OUTBOUND_CHAT_RATE="1000000", OUTBOUND_CHAT_BURST="1000000")
+    command = [sys.executable, os.path.join(REPO_DIR, "benchmark.py"), "--child", "--expected", str(expected), "--timeout", str(timeout)]
+    if workers:
+        env.update(STORAGE_BACKEND="sqlite", SQLITE_PATH=os.path.join(workdir, "bot.db"))
+        command += ["--workers", str(workers)]
+    return subprocess.Popen(
+        command,
+        cwd=workdir, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+    )
+
+
+def child_result(child):
+    stdout, stderr = child.communicate()
+    lines = [line for line in stdout.splitlines() if line.startswith("{")]
+    if child.returncode or not lines:
+        raise RuntimeError(f"bot process failed:\n{stderr[-2000:]}")
+    return json.loads(lines[-1])
+
+
+def run_size(api, size, users, catalog, timeout, production_rates, workers=None):
+    workdir = make_workdir(f"bench-{size}-")
+    try:
+        seed_started = time.perf_counter()
+        if workers:
+            seed_sqlite(os.path.join(workdir, "bot.db"), size)
+        else:
+            seed_subscriptions(os.path.join(workdir, "subscriptions.json"), size, os.path.join(workdir, "orders.json"))
+        seed_seconds = time.perf_counter() - seed_started
+
+        api.reset_calls()
+        expected = api.push_updates(synthetic_updates(users, catalog))
+        result = child_result(start_bot_child(api, workdir, expected, timeout, production_rates, workers))
+        result.update(size=size, workers=workers, updates=expected, seed_seconds=seed_seconds, api_calls=dict(api.method_counts))
+        return result
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+# Memory held by a JournalRepository of `size` orders after load_all() (records plus
+# the status/user/item/transaction indexes), with records packed as CompactRecord versus
+# kept as the loaded dicts, measured with tracemalloc; plus the cost of packing a record
+# and of reading one back
+def memory_benchmark(size):
+    sys.path.insert(0, REPO_DIR)
+    from records import CompactRecord
+    from storage import JournalRepository
+
+    # The same load with the records left as dicts, for comparison
+    def load_dicts(repository):
+        repository.records = repository.store.load()
+        for key, record in repository.records.items():
+            repository._index(key, record)
+        repository.transaction_index.load(repository.records)
+        return repository.records
+
+    def measure(path, load):
+        gc.collect()
+        tracemalloc.start()
+        started = time.perf_counter()
+        repository = JournalRepository(path)
+        load(repository)
+        seconds = time.perf_counter() - started
+        gc.collect()
+        used = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        repository.close()
+        return used, seconds
+
+    workdir = tempfile.mkdtemp(prefix="subscription-bot-memory-")
+    try:
+        path = os.path.join(workdir, "orders.json")
+        seed_subscriptions(os.devnull, size, path)
+        dict_bytes, _ = measure(path, load_dicts)
+        compact_bytes, _ = measure(path, lambda repository: repository.load_all())
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    # Timed without tracemalloc, which slows allocation-heavy code several times over
+    sample = [dict(seed_record(i), user_id=str(SEED_FIRST_USER_ID + i)) for i in range(min(size, 100000))]
+    started = time.perf_counter()
+    packed = [CompactRecord.pack(record) for record in sample]
+    pack_seconds = (time.perf_counter() - started) / len(sample)
+    started = time.perf_counter()
+    for record in packed:
+        record.to_dict()
+    unpack_seconds = (time.perf_counter() - started) / len(sample)
+    print(f"{size} orders, JournalRepository.load_all() with indexes")
+    print(f"  dict:          {dict_bytes / 2**20:8.1f} MB  {dict_bytes / size:6.0f} B/record")
+    print(f"  CompactRecord: {compact_bytes / 2**20:8.1f} MB  {compact_bytes / size:6.0f} B/record  ({dict_bytes / compact_bytes:.1f}x smaller)")
+    print(f"  pack {pack_seconds * 1e6:.1f} us/record, to_dict {unpack_seconds * 1e6:.1f} us/record")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark bot.py against the local fake Bot API")
+    parser.add_argument("--sizes", default="1000,100000,1000000", help="comma-separated subscriber counts to seed")
+    parser.add_argument("--users", type=int, default=500, help="synthetic purchase sessions per run")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds to wait for each run")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="seconds the fake API adds to each call")
+    parser.add_argument("--production-rates", action="store_true", help="keep the configured outbound rate limits")
+    parser.add_argument("--json", action="store_true", help="print one JSON object per run instead of a table")
+    parser.add_argument("--memory", type=int, metavar="N", help="only compare JournalRepository memory for N orders (e.g. 1000000)")
+    parser.add_argument("--workers", help="comma-separated worker process counts to run workers.py with (SQLite store)")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--expected", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child and args.workers:
+        run_workers_child(args.expected, args.timeout, int(args.workers))
+        return
+    if args.child:
+        run_child(args.expected, args.timeout)
+        return
+    if args.memory:
+        memory_benchmark(args.memory)
+        return
+
+    with open(os.path.join(REPO_DIR, "catalog.json"), "r", encoding="utf-8") as f:
+        catalog = json.load(f)
+    api = FakeTelegramAPI(latency=args.api_latency).start()
+    try:
+        if not args.json:
+            print(f"{'subscribers':>12} {'workers':>7} {'updates':>8} {'load s':>7} {'upd/s':>9} {'e2e upd/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8} {'RSS MB':>8} {'API calls':>10} {'errors':>7}")
+        runs = [(int(size), int(workers) if workers else None) for size in args.sizes.split(",") for workers in (args.workers or "").split(",")]
+        for size, workers in runs:
+            result = run_size(api, size, args.users, catalog, args.timeout, args.production_rates, workers)
+            if args.json:
+                print(json.dumps(result), flush=True)
+                continue
+            print(
+                f"{result['size']:>12} {workers or '-':>7} {result['updates']:>8} {result['load_seconds']:>7.2f} {result['handled_per_second']:>9.1f} "
+                f"{result['end_to_end_per_second']:>10.1f} {result['p50_ms']:>8.2f} {result['p99_ms']:>8.2f} {result['max_ms']:>8.2f} "
+                f"{result['max_rss_mb']:>8.1f} {sum(result['api_calls'].values()):>10} {result['errors']:>7}"
+                + ("" if result["completed"] else "  (timed out)"),
+                flush=True
+            )
+    finally:
+        api.stop()
+
+
+if __name__ == "__main__":
+    main()
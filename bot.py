@@ -6,7 +6,32 @@ import logging
 from datetime import datetime, timedelta
 import uuid
 import time
-import json
+import re
+import shlex
+import atexit
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from storage import open_repository, search_cursor
+from structured_logging import setup_logging
+from webhook import run_webhook
+from media_cache import MediaCache
+from catalog import CatalogLoader
+from router import CallbackRouter
+from outbound import OutboundDispatcher, is_retryable, PRIORITY_ADMIN, PRIORITY_USER, PRIORITY_BULK
+from broadcast import BroadcastManager
+from export import export_records, EXPORT_FORMATS
+from metrics import Metrics, instrument_telegram_api, serve_metrics
+from scheduler import ExpiryScheduler, add_months
+from payments import open_payment_provider, PaymentWatcher
+from search import SearchSessions
+from analytics import Analytics, backfill_orders, order_amount, approval_latency, format_duration
+from records import payment_text, payment_with_method
+from conversations import ConversationStore
+from polling import PollingSupervisor
+from workers import LeaderProxy, forwarded_future, serve_leader_channel
+from transitions import SubscriptionStateMachine, RecentKeys, state_of, SELECTED, PENDING, ACTIVATED
 
 # Load environment variables from .env file
 load_dotenv()
@@ -14,24 +39,138 @@ load_dotenv()
 # Access the Telegram bot token from the .env file
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 
+# Bot API base URL; point it at a local stand-in (fake_telegram_api.py) for benchmarks and replays
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = TELEGRAM_API_URL.rstrip("/") + "/bot{0}/{1}"
+
 # Initialize the bot
 bot = telebot.TeleBot(TELEGRAM_BOT_TOKEN)
 
-# Persistent storage for subscriptions
-SUBSCRIPTIONS_FILE = "subscriptions.json"
+# Set up logging: JSON lines written by a background listener, rotated by size (or time)
+LOG_FILE = os.getenv('LOG_FILE', 'bot.log')
+log_listener = setup_logging(
+    LOG_FILE,
+    level=os.getenv('LOG_LEVEL', 'INFO'),
+    fmt=os.getenv('LOG_FORMAT', 'json'),  # json or text
+    max_bytes=int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024))),
+    backup_count=int(os.getenv('LOG_BACKUP_COUNT', '5')),
+    rotate_when=os.getenv('LOG_ROTATE_WHEN')  # e.g. "midnight" for daily files instead of size-based
+)
+atexit.register(log_listener.stop)
+logger = logging.getLogger(__name__)
 
-def load_subscriptions():
-    try:
-        with open(SUBSCRIPTIONS_FILE, "r") as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return {}
+# Handler, Bot API and storage timings, served on /metrics and summarised by /stats
+metrics = Metrics()
+instrument_telegram_api(metrics)
+
+# Persistent storage for subscriptions (journal file by default, or SQLite/Postgres)
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'journal')  # journal, sqlite or postgres
+STORAGE_CONFIG = {
+    "compact_every": int(os.getenv('JOURNAL_COMPACT_EVERY', '1000')),  # Journal entries before background compaction
+    "journal_path": os.getenv('SUBSCRIPTIONS_FILE'),  # Journal backend snapshot (default subscriptions.json)
+    "sqlite_path": os.getenv('SQLITE_PATH', 'bot.db'),
+    "db_host": os.getenv('DB_HOST'),
+    "db_name": os.getenv('DB_NAME'),
+    "db_user": os.getenv('DB_USER'),
+    "db_password": os.getenv('DB_PASSWORD'),
+    "db_port": int(os.getenv('DB_PORT', '5432')),
+    "db_pool_max": int(os.getenv('DB_POOL_MAX', '10')),
+}
 
-def save_subscriptions(subscriptions):
-    with open(SUBSCRIPTIONS_FILE, "w") as f:
-        json.dump(subscriptions, f, indent=4)
+# Multi-process mode (workers.py) runs this module in every worker; one is the leader and
+# runs the one-time startup work, scheduled jobs and admin notifications, the followers
+# hand theirs to it over `leader_channel`. A single-process bot is always the leader.
+BOT_ROLE = os.getenv('BOT_ROLE', 'leader')  # leader or follower
+leader_channel = None
 
-subscriptions = load_subscriptions()
+# On a follower, queue `name(*args, **kwargs)` to run in the leader and return True
+def run_on_leader(name, *args, **kwargs):
+    if leader_channel is None:
+        return False
+    leader_channel.put((name, None, args, kwargs))
+    return True
+
+subscription_repository = open_repository(STORAGE_BACKEND, "subscriptions", STORAGE_CONFIG)
+# Every order placed, keyed by transaction_id and indexed by user and status. The
+# subscriptions store keeps each user's most recently changed order (what broadcasts filter on).
+order_repository = open_repository(STORAGE_BACKEND, "orders", dict(STORAGE_CONFIG, journal_path=os.getenv('ORDERS_FILE')))
+
+# The journal backend serves reads from memory, so its file is loaded once at startup;
+# the SQL backends read rows on demand and load nothing
+def load_repository(repository):
+    if STORAGE_BACKEND == "journal":
+        repository.load_all()
+
+# Mirror an order as its user's latest record (one row/journal entry, not a full rewrite)
+def save_subscription(order):
+    user_id = order["user_id"]
+    with metrics.timer("store_write_seconds", backend=STORAGE_BACKEND):
+        subscription_repository.put(user_id, {key: value for key, value in order.items() if key != "user_id"})
+
+def save_order(transaction_id, order):
+    with metrics.timer("store_write_seconds", backend=STORAGE_BACKEND):
+        order_repository.put(transaction_id, order)
+    save_subscription(order)
+
+# Lifecycle changes (selected -> pending -> activated/rejected/expired) go through per-order
+# locks and compare-and-set writes, so duplicate clicks and concurrent handlers are no-ops
+order_states = SubscriptionStateMachine(
+    order_repository, write_timer=lambda: metrics.timer("store_write_seconds", backend=STORAGE_BACKEND)
+)
+
+def transition_order(transaction_id, event, update=None):
+    order, applied = order_states.apply(transaction_id, event, update)
+    metrics.inc("subscription_transitions_total", event=event, result="applied" if applied else "refused")
+    if applied:
+        save_subscription(order)
+        expiry_scheduler.track(transaction_id, order)
+    return order, applied
+
+def modify_order(transaction_id, update, **conditions):
+    order, applied = order_states.modify(transaction_id, update, **conditions)
+    if applied:
+        save_subscription(order)
+    return order, applied
+
+# Buttons carry the order's transaction_id; ones sent before orders existed carry the
+# user's chat ID, which resolves to that user's latest order in one of `states`
+def find_order(key, *states):
+    if not key.isdigit():
+        return key
+    for transaction_id, order in reversed(order_repository.find_by_user(key)):
+        if state_of(order) in states:
+            return transaction_id
+    return None
+
+load_repository(subscription_repository)
+load_repository(order_repository)
+atexit.register(subscription_repository.close)
+atexit.register(order_repository.close)
+
+# First start with order history: every per-user record becomes that user's first order
+if BOT_ROLE == "leader" and next(order_repository.iter_after(""), None) is None and next(subscription_repository.iter_after(""), None) is not None:
+    migrated = 0
+    for user_id, record in subscription_repository.iter_after(""):
+        order = dict(record, user_id=user_id)
+        # Selections used to be stored as "pending" before any payment was requested
+        order["status"] = state_of(order)
+        order.setdefault("transaction_id", str(uuid.uuid4()))
+        save_order(order["transaction_id"], order)
+        migrated += 1
+    logger.info("Migrated %s subscription records to orders", migrated)
+
+# Pending steps of multi-step flows (e.g. change payment: user, then method), persisted
+# with the other stores and dropped after CONVERSATION_TTL seconds
+conversation_repository = open_repository(STORAGE_BACKEND, "conversations", dict(STORAGE_CONFIG, journal_path=os.getenv('CONVERSATIONS_FILE')))
+load_repository(conversation_repository)
+atexit.register(conversation_repository.close)
+conversations = ConversationStore(
+    conversation_repository,
+    ttl=float(os.getenv('CONVERSATION_TTL', '900')),
+    capacity=int(os.getenv('CONVERSATION_CAPACITY', '10000'))
+)
+conversations.load()
 
 # Admin chat ID (replace with actual admin Telegram chat ID)
 ADMIN_CHAT_ID = "7944149645"
@@ -39,14 +178,6 @@ ADMIN_CHAT_ID = "7944149645"
 # Pagination settings
 PAGE_SIZE = 5  # Number of subscriptions per page
 
-# Set up logging
-logging.basicConfig(
-    filename='bot.log',
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
-logger = logging.getLogger(__name__)
-
 # Attractive text to append to every reply (now empty)
 ATTRACTIVE_TEXT = ""
 
@@ -56,8 +187,25 @@ WELCOME_DESCRIPTION = (
     "YOUR #1 PUBLIC RECORDS SUPPLIER‼️ BEST DEALS, BEST RATES, MONTHLY SPECIALS⚡️📈 🏪 CUSTOMER SUPPORT ☎️✅"
 )
 
-# Helper function to create custom keyboard markup
-def get_custom_markup(chat_id):
+# Product catalog (plans, site tiers, prices); edits to catalog.json are picked up without a restart
+CATALOG_FILE = "catalog.json"
+catalog_loader = CatalogLoader(CATALOG_FILE, check_interval=int(os.getenv('CATALOG_CHECK_INTERVAL', '5')))
+
+# Sales analytics behind /report, updated on each funnel event and saved in the background
+ANALYTICS_FILE = os.getenv('ANALYTICS_FILE', 'analytics.json')
+ANALYTICS_FLUSH_INTERVAL = float(os.getenv('ANALYTICS_FLUSH_INTERVAL', '60'))
+analytics = Analytics(ANALYTICS_FILE)
+atexit.register(analytics.stop)
+
+# First start with analytics: rebuild them from the order history (Store clicks are
+# only in bot.log; `python analytics.py --orders ... --log bot.log` adds those)
+if BOT_ROLE == "leader" and not analytics.exists() and next(order_repository.iter_after(""), None) is not None:
+    rebuilt = backfill_orders(analytics, order_repository.iter_after(""), catalog_loader.get().items)
+    analytics.flush()
+    logger.info("Rebuilt analytics from %s orders", rebuilt)
+
+# Reply keyboards are built once; admins get the extra admin rows
+def build_custom_markup(is_admin):
     markup = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=False)
     buttons = [
         ("🛒 Store", "📞 Customer Support"),
@@ -66,55 +214,599 @@ def get_custom_markup(chat_id):
     ]
     for row in buttons:
         markup.row(*[types.KeyboardButton(btn) for btn in row])
-    if str(chat_id) == ADMIN_CHAT_ID:
+    if is_admin:
         markup.row(types.KeyboardButton("🛠️ Admin"))
         markup.row(types.KeyboardButton("🔄 Change Payment Method"))
     return markup
 
+USER_MARKUP = build_custom_markup(is_admin=False)
+ADMIN_MARKUP = build_custom_markup(is_admin=True)
+
+# Inline keyboards that never change
+STORE_MARKUP = types.InlineKeyboardMarkup()
+STORE_MARKUP.add(
+    types.InlineKeyboardButton("🏬 Our Shop", callback_data="our_shop"),
+    types.InlineKeyboardButton("🔙 Back", callback_data="back_inline")
+)
+BACK_MARKUP = types.InlineKeyboardMarkup()
+BACK_MARKUP.add(types.InlineKeyboardButton("🔙 Back", callback_data="back_inline"))
+
+# Helper function to pick the custom keyboard markup for a chat
+def get_custom_markup(chat_id):
+    return ADMIN_MARKUP if str(chat_id) == ADMIN_CHAT_ID else USER_MARKUP
+
+# Outbound Bot API calls go through a rate-limited background queue. Every worker
+# process (workers.py) has its own queue, so the token's global rate is split evenly
+# between them; per-chat limits hold as each chat is handled by one worker.
+WORKER_COUNT = int(os.getenv('BOT_WORKER', '0/1').split('/')[1])
+outbound = OutboundDispatcher(
+    workers=int(os.getenv('OUTBOUND_WORKERS', '8')),
+    global_rate=float(os.getenv('OUTBOUND_GLOBAL_RATE', '30')) / WORKER_COUNT,  # Messages per second across all chats
+    chat_rate=float(os.getenv('OUTBOUND_CHAT_RATE', '1')),  # Sustained messages per second per chat
+    chat_burst=int(os.getenv('OUTBOUND_CHAT_BURST', '3'))
+)
+metrics.gauge("outbound_queue_depth", outbound.depth)
+metrics.gauge("pending_subscriptions", lambda: order_repository.count_by_status("pending"))
+
+# Queue a message without waiting for Telegram; the admin chat gets the priority lane
+def queue_message(chat_id, text, priority=None, **kwargs):
+    if priority is None:
+        priority = PRIORITY_ADMIN if str(chat_id) == ADMIN_CHAT_ID else PRIORITY_USER
+    if str(chat_id) == ADMIN_CHAT_ID and run_on_leader("queue_message", chat_id, text, priority, **kwargs):
+        return forwarded_future()
+    return outbound.submit(chat_id, bot.send_message, chat_id, text, priority=priority, **kwargs)
+
+def queue_reply(message, text, priority=None, **kwargs):
+    if priority is None:
+        priority = PRIORITY_ADMIN if str(message.chat.id) == ADMIN_CHAT_ID else PRIORITY_USER
+    return outbound.submit(message.chat.id, bot.reply_to, message, text, priority=priority, **kwargs)
+
+# Inline menus (shop, families, plans) are edited in place by the clicks on them; the
+# reply keyboard from /start stays, so it is not sent again.
+# Without a click to answer, or when Telegram refuses the edit (deleted, too old), a
+# new menu message is sent.
+MENU_PROMPT = "🔹 Please select the desired option"
+
+# Show `text` with `reply_markup` as the chat's menu: edited in place when answering a
+# click (`call`), sent as a new message otherwise
+def show_menu(chat_id, text, reply_markup, call=None):
+    priority = PRIORITY_ADMIN if str(chat_id) == ADMIN_CHAT_ID else PRIORITY_USER
+    clicked = call.message.message_id if call is not None else None
+    return outbound.submit(chat_id, update_menu, chat_id, text + ATTRACTIVE_TEXT, reply_markup, clicked, priority=priority)
+
+# Runs on the outbound queue, after any menu sent earlier for the chat. A click edits
+# the message that was clicked, even an older menu than the chat's latest.
+def update_menu(chat_id, text, reply_markup, clicked):
+    if clicked is not None:
+        try:
+            return bot.edit_message_text(text, chat_id, clicked, parse_mode='Markdown', reply_markup=reply_markup)
+        except telebot.apihelper.ApiTelegramException as e:
+            if "message is not modified" in str(e):
+                return None
+            if e.error_code != 400:
+                raise  # 429/5xx: retried by the outbound queue
+            logger.info("Menu %s in chat %s can't be edited, sending a new one: %s", clicked, chat_id, e)
+    return bot.send_message(chat_id, text, parse_mode='Markdown', reply_markup=reply_markup)
+
+# Media assets: local files are uploaded once and re-sent by cached file_id;
+# anything that is not a local file is treated as a Telegram file_id already
+LOGO_IMAGE = "logo.png"
+WELCOME_STICKER = "CAACAgQAAxkBAAEOHOhn2cf3AAHyh1ctojFLvQ_oA0lHDuwAAioDAAK8pBoD3ybItIoPIg82BA"
+MEDIA_CACHE_FILE = "media_cache.json"
+
+media_cache = MediaCache(MEDIA_CACHE_FILE)
+
+# Helper function to send a media asset, reusing the file_id from its first upload
+def send_media(chat_id, source, method="send_photo", **kwargs):
+    send = getattr(bot, method)
+    if not os.path.isfile(source):
+        return send(chat_id, source, **kwargs)
+    file_id = media_cache.lookup(source)
+    if file_id:
+        try:
+            return send(chat_id, file_id, **kwargs)
+        except telebot.apihelper.ApiTelegramException as e:
+            # Only a 400 about the file means the file_id is gone; 429/5xx are retried by the outbound queue
+            if e.error_code != 400 or "file" not in str(e.description).lower():
+                raise
+            logger.warning("Cached file_id for %s rejected, re-uploading: %s", source, e)
+            media_cache.forget(source)
+    with open(source, 'rb') as f:
+        sent = send(chat_id, f, **kwargs)
+    media = getattr(sent, sent.content_type)
+    media_cache.store(source, media[-1].file_id if isinstance(media, list) else media.file_id)
+    return sent
+
 # Helper function to display welcome message and logo (every time "Store" is clicked)
 def display_welcome_and_logo(chat_id):
-    bot.send_message(chat_id, WELCOME_DESCRIPTION, parse_mode='Markdown')
+    outbound.submit(chat_id, send_logo, chat_id)
+
+# Upload (or re-send by file_id) the logo with the welcome text as its caption (one call
+# instead of two); runs on the outbound queue. Without the logo the text goes on its own.
+def send_logo(chat_id):
     try:
-        with open('logo.png', 'rb') as photo:
-            bot.send_photo(chat_id, photo)
-        logger.info(f"Sent logo image to user {chat_id}")
+        if not os.path.isfile(LOGO_IMAGE):
+            raise FileNotFoundError(LOGO_IMAGE)
+        send_media(chat_id, LOGO_IMAGE, caption=WELCOME_DESCRIPTION, parse_mode='Markdown')
+        logger.info("Sent logo image to user %s", chat_id)
     except FileNotFoundError:
-        logger.error(f"Logo image not found for user {chat_id}")
-        bot.send_message(chat_id, "⚠️ Logo image not available. Please contact support.")
+        logger.error("Logo image not found for user %s", chat_id)
+        bot.send_message(chat_id, WELCOME_DESCRIPTION, parse_mode='Markdown')
+        queue_message(chat_id, "⚠️ Logo image not available. Please contact support.")
     except Exception as e:
-        logger.error(f"Error sending logo image to user {chat_id}: {str(e)}")
-        bot.send_message(chat_id, "⚠️ Error sending logo image. Please contact support.")
+        if is_retryable(e):
+            raise  # retried by the outbound queue
+        logger.error("Error sending logo image to user %s: %s", chat_id, e)
+        bot.send_message(chat_id, WELCOME_DESCRIPTION, parse_mode='Markdown')
+        queue_message(chat_id, "⚠️ Error sending logo image. Please contact support.")
 
 # Handler for the /start command (no welcome text/logo here)
 @bot.message_handler(commands=['start'])
+@metrics.timed("handler", handler="send_welcome")
 def send_welcome(message):
-    logger.info(f"User {message.chat.id} started the bot")
+    logger.info("User %s started the bot", message.chat.id, extra={"event": "start", "user_id": str(message.chat.id)})
     markup = get_custom_markup(message.chat.id)
-    bot.send_sticker(message.chat.id, "CAACAgQAAxkBAAEOHOhn2cf3AAHyh1ctojFLvQ_oA0lHDuwAAioDAAK8pBoD3ybItIoPIg82BA")
+    outbound.submit(message.chat.id, send_media, message.chat.id, WELCOME_STICKER, method="send_sticker")
     welcome_message = (
         "✨ Dear Customers\n"
         "Welcome To Our Store Bots 🛒🤖🔥🔥🔥\n\n"
         "⚜️ Select One Of The Following Options:"
     ) + ATTRACTIVE_TEXT
-    bot.send_message(message.chat.id, welcome_message, parse_mode='Markdown', reply_markup=markup)
+    queue_message(message.chat.id, welcome_message, parse_mode='Markdown', reply_markup=markup)
+
+# Broadcasts to subscribers (admin only), checkpointed so a restart resumes without resending
+BROADCAST_DIR = "broadcasts"
+BROADCAST_FILTER_KEYS = ("status", "family", "active_days")
+
+# Build the recipient predicate for a broadcast's stored filters
+def build_broadcast_filter(filters):
+    statuses = set(filters["status"].split(",")) if filters.get("status") else None
+    families = set(filters["family"].split(",")) if filters.get("family") else None
+    active_since = None
+    if filters.get("active_days"):
+        active_since = str(datetime.now() - timedelta(days=int(filters["active_days"])))
+
+    def matches(record):
+        if statuses and record.get("status") not in statuses:
+            return False
+        if families:
+            family = catalog_loader.get().item_family.get(record.get("item"))
+            if not family or family["id"] not in families:
+                return False
+        if active_since and record.get("timestamp", "") < active_since:
+            return False
+        return True
+    return matches
+
+def send_broadcast_message(chat_id, text):
+    return outbound.submit(chat_id, bot.send_message, int(chat_id), text, priority=PRIORITY_BULK)
+
+# Post or update the live progress message in the admin chat
+def report_broadcast(broadcast, rate, final):
+    state = broadcast.state
+    errors = ", ".join(f"{code}: {count}" for code, count in state["errors"].items()) or "none"
+    status = "✅ Finished" if state["done"] and not state["cancelled"] else "🛑 Cancelled" if state["cancelled"] else "⏳ Running" if not final else "⚠️ Stopped"
+    report_message = (
+        f"📣 Broadcast {broadcast.id}\n"
+        f"────\n"
+        f"Status: {status}\n"
+        f"Sent: {state['sent']}  Failed: {state['failed']}  Skipped: {state['skipped']}\n"
+        f"Throughput: {rate:.1f} msg/s\n"
+        f"Errors: {errors}"
+    )
+    if state["report_message_id"]:
+        outbound.submit(ADMIN_CHAT_ID, bot.edit_message_text, report_message, chat_id=ADMIN_CHAT_ID, message_id=state["report_message_id"], priority=PRIORITY_ADMIN)
+    else:
+        def remember_message(future):
+            if not future.exception():
+                state["report_message_id"] = future.result().message_id
+        queue_message(ADMIN_CHAT_ID, report_message).add_done_callback(remember_message)
+
+broadcast_manager = BroadcastManager(
+    subscription_repository, BROADCAST_DIR, send_broadcast_message, build_broadcast_filter, report_broadcast,
+    window=int(os.getenv('BROADCAST_WINDOW', '200'))
+)
+
+# Handler for /broadcast [status=a,b] [family=subscribe] [active_days=N] <text>
+@bot.message_handler(commands=['broadcast'], func=lambda message: str(message.chat.id) == ADMIN_CHAT_ID)
+def handle_broadcast(message):
+    # Broadcasts run (and resume after restarts) in the leader worker
+    if run_on_leader("handle_broadcast", message):
+        return
+    parts = message.text.split(None, 1)
+    remainder = parts[1] if len(parts) > 1 else ""
+    filters = {}
+    while remainder:
+        token, _, rest = remainder.partition(" ")
+        key, sep, value = token.partition("=")
+        if not sep or key not in BROADCAST_FILTER_KEYS:
+            break
+        filters[key] = value
+        remainder = rest.lstrip(" ")
+    if not remainder.strip():
+        queue_reply(message, "Usage: /broadcast [status=activated,pending] [family=subscribe] [active_days=30] <message>")
+        return
+    broadcast = broadcast_manager.start(remainder, filters)
+    logger.info("Admin %s started broadcast %s with filters %s", message.chat.id, broadcast.id, filters)
+    queue_reply(message, f"📣 Broadcast {broadcast.id} started. Cancel with /broadcast_cancel {broadcast.id}")
+
+@bot.message_handler(commands=['broadcast_cancel'], func=lambda message: str(message.chat.id) == ADMIN_CHAT_ID)
+def handle_broadcast_cancel(message):
+    if run_on_leader("handle_broadcast_cancel", message):
+        return
+    parts = message.text.split()
+    if len(parts) == 2 and broadcast_manager.cancel(parts[1]):
+        queue_reply(message, f"🛑 Cancelling broadcast {parts[1]}...")
+    else:
+        queue_reply(message, "No running broadcast with that ID.")
+
+# Renewal reminders, expiry and auto-rejection of unapproved payments, driven by a timer heap
+REMINDER_DAYS = [int(days) for days in os.getenv('REMINDER_DAYS', '7,1').split(',') if days]  # Days before expiry
+PENDING_TIMEOUT_HOURS = float(os.getenv('PENDING_TIMEOUT_HOURS', '72'))  # Unapproved payments are rejected after this
+
+# Scheduler jobs are per order: (transaction_id, order)
+def remind_expiry(transaction_id, record, days):
+    # Record the reminder through the state machine; if the order was renewed, expired
+    # or edited meanwhile, the scheduler re-reads it and decides again
+    def mark_sent(order):
+        if order.get("expires_at") == record.get("expires_at"):
+            order["reminders_sent"] = record["reminders_sent"]
+    order, applied = modify_order(transaction_id, mark_sent, states=(ACTIVATED,))
+    if not applied or order.get("reminders_sent") != record["reminders_sent"]:
+        return
+    user_id = record["user_id"]
+    reminder_message = (
+        f"⏰ Renewal Reminder\n"
+        f"────\n"
+        f"Your {record['plan']} expires in {days} day{'s' if days != 1 else ''} ({record['expires_at'][:10]}).\n"
+        "👉 Renew from the 🛒 Store to keep your access without interruption."
+    ) + ATTRACTIVE_TEXT
+    queue_message(int(user_id), reminder_message, priority=PRIORITY_BULK)
+    logger.info("Sent %s-day renewal reminder to user %s", days, user_id, extra={"event": "renewal_reminder", "user_id": user_id})
+
+def expire_subscription(transaction_id, record):
+    record, applied = transition_order(transaction_id, "expire")
+    if not applied:
+        return
+    user_id = record["user_id"]
+    expired_message = (
+        f"⌛ Subscription Expired\n"
+        f"────\n"
+        f"Transaction ID: {record.get('transaction_id', 'N/A')}\n"
+        f"Your {record['plan']} has expired.\n"
+        "👉 Visit the 🛒 Store to renew."
+    ) + ATTRACTIVE_TEXT
+    queue_message(int(user_id), expired_message, priority=PRIORITY_BULK)
+    logger.info("Subscription expired for user %s", user_id, extra={"event": "expired", "user_id": user_id, "transaction_id": record.get("transaction_id")})
+
+def reject_stale_payment(transaction_id, record):
+    def reject(record):
+        record["reason"] = "Payment not confirmed in time"
+    record, applied = transition_order(transaction_id, "reject", reject)
+    if not applied:
+        return
+    user_id = record["user_id"]
+    user_message = (
+        f"❌ Purchase Rejected ❌\n"
+        f"────\n"
+        f"Transaction ID: {record['transaction_id']}\n"
+        f"Your {record['plan']} request has been rejected. 😔\n"
+        f"Reason: {record['reason']}\n"
+        f"Payment: {record['payment']}\n"
+        "👉 Contact support for assistance: [Support](https://prbot247.com/support)\n"
+    ) + ATTRACTIVE_TEXT
+    queue_message(int(user_id), user_message, parse_mode='Markdown', priority=PRIORITY_BULK)
+    logger.info(
+        "Auto-rejected stale payment request for user %s with Transaction ID: %s", user_id, record['transaction_id'],
+        extra={"event": "rejected", "user_id": user_id, "transaction_id": record['transaction_id']}
+    )
+
+expiry_scheduler = ExpiryScheduler(
+    order_repository.get, remind_expiry, expire_subscription, reject_stale_payment,
+    reminder_days=REMINDER_DAYS, pending_timeout=PENDING_TIMEOUT_HOURS * 3600,
+    batch_size=int(os.getenv('SCHEDULER_BATCH_SIZE', '500'))
+)
+metrics.gauge("scheduled_subscriptions", expiry_scheduler.pending)
+
+# Automatic payment confirmation; with PAYMENT_PROVIDER=none every purchase waits for admin approval
+PAYMENT_PROVIDER = os.getenv('PAYMENT_PROVIDER', 'none')  # none, mock or coinbase
+PAYMENT_CONFIG = {
+    "coinbase_api_key": os.getenv('COINBASE_API_KEY'),
+    "coinbase_webhook_secret": os.getenv('COINBASE_WEBHOOK_SECRET'),
+    "mock_inbox": os.getenv('MOCK_PAYMENTS_FILE', 'mock_payments.jsonl'),  # JSON lines of {"transaction_id", "amount"}
+}
+PAYMENT_WEBHOOK_PATH = os.getenv('PAYMENT_WEBHOOK_PATH', '/payments')  # Served in webhook mode
+payment_provider = open_payment_provider(PAYMENT_PROVIDER, PAYMENT_CONFIG)
+
+# Price of a record's catalog item in dollars (falls back to the "$NN" in its payment text)
+def record_price(record):
+    item = catalog_loader.get().items.get(record.get("item"))
+    match = re.search(r"\$(\d+(?:\.\d+)?)", item["price"] if item else record.get("payment", ""))
+    return float(match.group(1)) if match else None
+
+# A provider reported a confirmed payment: activate the matching pending order once
+def confirm_payment(transaction_id, record, payment):
+    user_id = record.get("user_id")
+    def record_payment(record):
+        record["paid_amount"] = payment.amount
+        record["paid_via"] = payment.provider
+        record["provider_payment_id"] = payment.provider_id
+    price = record_price(record)
+    if price is not None and payment.amount + 0.01 < price:
+        record, applied = modify_order(transaction_id, record_payment, states=(PENDING,))
+        if not applied:
+            logger.info("Ignoring %s for user %s: request is %s", payment, user_id, state_of(record))
+            return
+        queue_message(
+            ADMIN_CHAT_ID,
+            f"⚠️ Underpaid order\n────\nUser ID: {user_id}\nTransaction ID: {payment.transaction_id}\n"
+            f"Plan: {record['plan']}\nPaid: {payment.amount:.2f} {payment.currency} of ${price:.2f}\n👉 Review it in the Admin panel."
+        )
+        logger.warning("Underpaid %s for user %s (price %s)", payment, user_id, price, extra={"event": "payment_underpaid", "user_id": user_id, "transaction_id": payment.transaction_id})
+        return
+    record, applied = activate_order(transaction_id, record_payment)
+    if not applied:
+        logger.info("Ignoring %s for user %s: request is %s", payment, user_id, state_of(record))
+        return
+    queue_message(
+        ADMIN_CHAT_ID,
+        f"✅ Payment confirmed automatically\n────\nUser ID: {user_id}\nTransaction ID: {payment.transaction_id}\n"
+        f"Plan: {record['plan']}\nPaid: {payment.amount:.2f} {payment.currency} via {payment.provider}"
+    )
+    logger.info(
+        "Auto-activated purchase for user %s with Transaction ID: %s via %s", user_id, payment.transaction_id, payment.provider,
+        extra={"event": "activated", "user_id": user_id, "transaction_id": payment.transaction_id}
+    )
+
+payment_watcher = PaymentWatcher(
+    payment_provider, order_repository, confirm_payment,
+    lookback=PENDING_TIMEOUT_HOURS * 3600, interval=float(os.getenv('PAYMENT_POLL_INTERVAL', '30'))
+)
+
+# Payment provider push notifications (webhook mode)
+def receive_payment_webhook(body, headers):
+    try:
+        payments = payment_provider.parse_webhook(body, headers)
+    except ValueError as e:
+        logger.warning("Rejected payment webhook: %s", e)
+        return 400
+    payment_watcher.submit(payments)
+    return 200
+
+# Streaming user data export (admin only); runs on a background thread and sends one document per part
+EXPORT_FILTER_KEYS = ("format", "gzip", "status", "from", "to")
+export_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="export")
+
+def start_export(chat_id, fmt, compress, filters):
+    export_executor.submit(run_export, chat_id, fmt, compress, filters)
+
+def run_export(chat_id, fmt, compress, filters):
+    directory = tempfile.mkdtemp(prefix="export-")
+    try:
+        orders = ((order.get("user_id"), order) for _, order in order_repository.iter_after(""))
+        parts, rows = export_records(orders, directory, fmt=fmt, compress=compress, filters=filters)
+        logger.info("Admin %s exported %s orders in %s part(s) as %s%s", chat_id, rows, len(parts), fmt, '.gz' if compress else '')
+        futures = [outbound.submit(ADMIN_CHAT_ID, send_export_part, path, priority=PRIORITY_ADMIN) for path in parts]
+        for future in futures:
+            future.exception()
+        queue_message(chat_id, f"📥 Export finished: {rows} orders in {len(parts)} file(s).")
+    except Exception as e:
+        logger.error("Failed to download user data for admin %s: %s", chat_id, e)
+        queue_message(chat_id, "Failed to download user data. Check logs for details.")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+def send_export_part(path):
+    with open(path, "rb") as f:
+        return bot.send_document(ADMIN_CHAT_ID, f, visible_file_name=os.path.basename(path))
+
+# Handler for /export [format=txt|csv|jsonl] [gzip=1] [status=a,b] [from=YYYY-MM-DD] [to=YYYY-MM-DD]
+@bot.message_handler(commands=['export'], func=lambda message: str(message.chat.id) == ADMIN_CHAT_ID)
+def handle_export(message):
+    options = {}
+    for token in message.text.split()[1:]:
+        key, sep, value = token.partition("=")
+        if not sep or key not in EXPORT_FILTER_KEYS:
+            queue_reply(message, "Usage: /export [format=txt|csv|jsonl] [gzip=1] [status=pending,activated] [from=YYYY-MM-DD] [to=YYYY-MM-DD]")
+            return
+        options[key] = value
+    fmt = options.pop("format", "txt")
+    if fmt not in EXPORT_FORMATS:
+        queue_reply(message, f"Unknown format {fmt}; use one of: {', '.join(EXPORT_FORMATS)}")
+        return
+    compress = options.pop("gzip", "0") in ("1", "true", "yes")
+    queue_reply(message, "📥 Export started; files will arrive here when ready.")
+    start_export(message.chat.id, fmt, compress, options)
+
+# Admin order search, answered from the repository's indexes and paged by keyset cursor
+SEARCH_FILTER_KEYS = ("user", "tx", "plan", "status", "from", "to")
+SEARCH_PAGE_SIZE = int(os.getenv('SEARCH_PAGE_SIZE', '10'))
+SEARCH_USAGE = ('Usage: /search [user=ID] [tx=PREFIX] [plan=ITEM_OR_NAME] [status=pending,activated] [from=YYYY-MM-DD] [to=YYYY-MM-DD]\n'
+                'Quote names with spaces: plan="550 Sites $50"')
+search_sessions = SearchSessions(capacity=int(os.getenv('SEARCH_SESSIONS', '200')))
+
+# Repository filters for the /search terms (shell-style, so quoted values may hold
+# spaces), or an error message
+def parse_search_terms(text):
+    try:
+        tokens = shlex.split(text)
+    except ValueError:
+        return None, SEARCH_USAGE
+    filters = {}
+    for token in tokens:
+        key, sep, value = token.partition("=")
+        if not sep or not value or key not in SEARCH_FILTER_KEYS:
+            return None, SEARCH_USAGE
+        if key in ("from", "to"):
+            try:
+                datetime.strptime(value, "%Y-%m-%d")
+            except ValueError:
+                return None, f"Bad date {value}; use YYYY-MM-DD"
+            filters[key] = value
+        elif key == "plan":
+            catalog = catalog_loader.get()
+            item = value if value in catalog.items else next(
+                (item_id for item_id, item in catalog.items.items() if item["name"].lower() == value.lower()), None
+            )
+            if item is None:
+                return None, f"Unknown plan {value}; use one of: {', '.join(catalog.items)}"
+            filters["item"] = item
+        elif key == "user":
+            filters["user_id"] = value
+        elif key == "tx":
+            filters["transaction_prefix"] = value.lower()
+        else:
+            filters["status"] = value
+    return filters, None
+
+# Handler for /search [user=ID] [tx=PREFIX] [plan=ITEM_OR_NAME] [status=a,b] [from=YYYY-MM-DD] [to=YYYY-MM-DD]
+@bot.message_handler(commands=['search'], func=lambda message: str(message.chat.id) == ADMIN_CHAT_ID)
+def handle_search(message):
+    filters, error = parse_search_terms(" ".join(message.text.split(maxsplit=1)[1:]))
+    if error:
+        queue_reply(message, error)
+        return
+    search_id = search_sessions.create(filters)
+    logger.info("Admin %s searched orders: %s", message.chat.id, filters, extra={"event": "admin_search", "filters": filters})
+    show_search_page(message.chat.id, search_id, 0)
+
+def show_search_page(chat_id, search_id, page, message_id=None):
+    filters, after = search_sessions.page(search_id, page)
+    started = time.perf_counter()
+    with metrics.timer("search_seconds", backend=STORAGE_BACKEND):
+        results = order_repository.search(filters, after=after, limit=SEARCH_PAGE_SIZE + 1)
+    elapsed = time.perf_counter() - started
+    has_next = len(results) > SEARCH_PAGE_SIZE
+    results = results[:SEARCH_PAGE_SIZE]
+    if has_next:
+        search_sessions.remember(search_id, page + 1, search_cursor(*results[-1]))
+
+    text = f"🔎 Order Search (Page {page + 1}, {elapsed * 1000:.1f} ms)\n────\n"
+    if not results:
+        text += "No orders match." if page == 0 else "No more orders."
+    for transaction_id, order in results:
+        text += (
+            f"🔹 {order.get('status', 'N/A')} · User ID: {order.get('user_id', 'N/A')}\n"
+            f"  Transaction ID: {transaction_id}\n"
+            f"  Plan: {order.get('plan', 'N/A')}\n"
+            f"  Timestamp: {order.get('timestamp', 'N/A')}\n"
+        )
+    inline_markup = types.InlineKeyboardMarkup()
+    pagination_row = []
+    if page > 0:
+        pagination_row.append(types.InlineKeyboardButton("⬅️ Previous", callback_data=f"search_{search_id}_{page - 1}"))
+    if has_next:
+        pagination_row.append(types.InlineKeyboardButton("➡️ Next", callback_data=f"search_{search_id}_{page + 1}"))
+    if pagination_row:
+        inline_markup.row(*pagination_row)
+
+    if message_id is None:
+        queue_message(chat_id, text, priority=PRIORITY_ADMIN, reply_markup=inline_markup)
+    else:
+        outbound.submit(chat_id, bot.edit_message_text, text, chat_id=chat_id, message_id=message_id, reply_markup=inline_markup, priority=PRIORITY_ADMIN)
+
+# Handler for /report [days=N|all]: revenue, funnel and approval time from the running aggregates (admin only)
+@bot.message_handler(commands=['report'], func=lambda message: str(message.chat.id) == ADMIN_CHAT_ID)
+def handle_report(message):
+    # Analytics are kept by the leader worker
+    if run_on_leader("handle_report", message):
+        return
+    days = 7
+    for token in message.text.split()[1:]:
+        key, _, value = token.partition("=")
+        if key != "days" or not (value == "all" or value.isdigit() and int(value) > 0):
+            queue_reply(message, "Usage: /report [days=N|all]")
+            return
+        days = None if value == "all" else int(value)
+    summary = analytics.summary(days)
+    orders = sum(count for count, _ in summary["revenue"].values())
+    report_message = (
+        f"📈 Sales Report ({f'last {days} days' if days else 'all time'})\n"
+        f"────\n"
+        f"Revenue: ${summary['total']:.2f} from {orders} orders\n"
+    )
+    for plan, (count, amount) in sorted(summary["revenue"].items(), key=lambda item: item[1][1], reverse=True):
+        report_message += f"  {plan}: ${amount:.2f} ({count})\n"
+    if days and days <= 14 and summary["daily"]:
+        report_message += "\nBy day:\n" + "".join(f"  {day}: ${amount:.2f}\n" for day, amount in summary["daily"].items())
+
+    funnel = summary["funnel"]
+    report_message += "\nFunnel:\n"
+    previous = None
+    for stage, label in (("store", "Store"), ("selected", "Plan selected"), ("pay", "Pay clicked"), ("activated", "Activated")):
+        rate = f" ({funnel[stage] / previous * 100:.0f}%)" if previous else ""
+        report_message += f"  {label}: {funnel[stage]}{rate}\n"
+        previous = funnel[stage]
+
+    if summary["approvals"]:
+        report_message += (
+            f"\nApproval time ({summary['approvals']} orders): avg {format_duration(summary['latency_avg'])}, "
+            f"p50 ≤ {format_duration(summary['latency_p50'])}, p90 ≤ {format_duration(summary['latency_p90'])}\n"
+        )
+    queue_reply(message, report_message)
+    logger.info("Admin %s viewed sales report", message.chat.id)
+
+# Handler for /stats: a chat-sized summary of the /metrics data (admin only)
+@bot.message_handler(commands=['stats'], func=lambda message: str(message.chat.id) == ADMIN_CHAT_ID)
+def handle_stats(message):
+    gauges = metrics.read_gauges()
+    uptime = timedelta(seconds=int(time.time() - metrics.started))
+    stats_message = (
+        f"📊 Bot Stats (up {uptime})\n"
+        f"────\n"
+        f"Pending purchases: {gauges.get('pending_subscriptions', 'N/A')}\n"
+        f"Outbound queue: {gauges.get('outbound_queue_depth', 'N/A')}\n\n"
+        f"Handlers (calls, p50 / p99 / max ms):\n"
+    )
+    for labels, (count, _, peak, p50, p99) in sorted(metrics.histogram_summary("handler_seconds").items()):
+        errors = metrics.counter_value("handler_errors_total", **dict(labels))
+        stats_message += f"  {dict(labels)['handler']}: {count}, {p50 * 1000:.0f} / {p99 * 1000:.0f} / {peak * 1000:.0f}" + (f", {errors} errors" if errors else "") + "\n"
+
+    api = metrics.histogram_summary("telegram_api_seconds")
+    api_calls = sum(count for count, *_ in api.values())
+    slowest = sorted(api.items(), key=lambda item: item[1][4], reverse=True)[:3]
+    stats_message += f"\nTelegram API: {api_calls} calls\n"
+    for labels, (count, _, _, p50, p99) in slowest:
+        stats_message += f"  {dict(labels)['method']}: {count}, p50 {p50 * 1000:.0f} ms, p99 {p99 * 1000:.0f} ms\n"
+    errors_by_code = {}
+    for labels, value in metrics.counters("telegram_api_errors_total").items():
+        code = dict(labels)["code"]
+        errors_by_code[code] = errors_by_code.get(code, 0) + value
+    stats_message += "  Errors: " + (", ".join(f"{code}: {count}" for code, count in sorted(errors_by_code.items())) or "none") + "\n"
+
+    for labels, (count, _, peak, p50, p99) in metrics.histogram_summary("store_write_seconds").items():
+        stats_message += f"\nStore writes ({dict(labels)['backend']}): {count}, p99 {p99 * 1000:.1f} ms, max {peak * 1000:.1f} ms\n"
+
+    busiest = sorted(callback_router.stats().items(), key=lambda item: item[1][0], reverse=True)[:5]
+    if busiest:
+        stats_message += "\nTop callbacks:\n"
+        for name, (count, total, peak) in busiest:
+            stats_message += f"  {name}: {count}, avg {total / count * 1000:.0f} ms, max {peak * 1000:.0f} ms\n"
+    queue_reply(message, stats_message)
+    logger.info("Admin %s viewed stats", message.chat.id)
+
+# A chat with a pending conversation step gets its next text message routed to that step
+@bot.message_handler(content_types=['text'], func=lambda message: conversations.active(message.chat.id))
+def handle_conversation_step(message):
+    step = conversations.pop(message.chat.id)
+    if step is None:
+        handle_text(message)
+        return
+    name, args = step
+    logger.info("User %s answered conversation step %s", message.chat.id, name)
+    conversation_steps[name](message, *args)
 
 # Handler for text messages (custom keyboard buttons)
 @bot.message_handler(content_types=['text'])
+@metrics.timed("handler", handler="handle_text")
 def handle_text(message):
-    logger.info(f"User {message.chat.id} sent message: {message.text}")
+    logger.info("User %s sent message: %s", message.chat.id, message.text, extra={"event": "message", "user_id": str(message.chat.id)})
 
     if message.text == "🛒 Store":
+        # The funnel's store stage; the "Our Shop" click that usually follows is not counted again
+        analytics.count("store")
         display_welcome_and_logo(message.chat.id)  # Welcome text and logo shown every time
-        inline_markup = types.InlineKeyboardMarkup()
-        our_shop_btn = types.InlineKeyboardButton("🏬 Our Shop", callback_data="our_shop")
-        back_inline_btn = types.InlineKeyboardButton("🔙 Back", callback_data="back_inline")
-        inline_markup.add(our_shop_btn, back_inline_btn)
-        bot.send_message(
-            message.chat.id,
-            "🔹 Please select the desired option" + ATTRACTIVE_TEXT,
-            parse_mode='Markdown',
-            reply_markup=inline_markup
-        )
+        show_menu(message.chat.id, MENU_PROMPT, STORE_MARKUP)
 
     elif message.text == "🔙 Back to Start":
         send_welcome(message)
@@ -134,29 +826,18 @@ def handle_text(message):
             "*Questions*\n"
             "• If you have any inquiries regarding our return and refund policy, please don’t hesitate to contact us at Service@prbot247.com.\n"
         ) + ATTRACTIVE_TEXT
-        
-        inline_markup = types.InlineKeyboardMarkup()
-        back_btn = types.InlineKeyboardButton("🔙 Back", callback_data="back_inline")
-        inline_markup.add(back_btn)
-        
-        bot.reply_to(message, refund_message, parse_mode='Markdown', reply_markup=inline_markup)
-        logger.info(f"User {message.chat.id} viewed Refund Policy")
+        queue_reply(message, refund_message, parse_mode='Markdown', reply_markup=BACK_MARKUP)
+        logger.info("User %s viewed Refund Policy", message.chat.id)
 
     elif message.text == "📞 Customer Support":
-        inline_markup = types.InlineKeyboardMarkup()
-        back_btn = types.InlineKeyboardButton("🔙 Back", callback_data="back_inline")
-        inline_markup.add(back_btn)
         support_message = (
             "📲 Customer Support 📲\n"
             "@prbot247\n"
             "We’re here to help you 24/7! 💪"
         ) + ATTRACTIVE_TEXT
-        bot.reply_to(message, support_message, parse_mode='Markdown', reply_markup=inline_markup)
+        queue_reply(message, support_message, parse_mode='Markdown', reply_markup=BACK_MARKUP)
 
     elif message.text == "📋 How To Order Step by Step":
-        inline_markup = types.InlineKeyboardMarkup()
-        back_btn = types.InlineKeyboardButton("🔙 Back", callback_data="back_inline")
-        inline_markup.add(back_btn)
         how_to_order_message = (
             "🤖 Step-by-Step Guide 🤖\n"
             "────\n"
@@ -167,431 +848,393 @@ def handle_text(message):
             "4️⃣ Confirmation: You’ll receive a confirmation on your Phone or Telegram.\n\n"
             "🔗 Need more help? Contact Support ( @prbot247 )"
         ) + ATTRACTIVE_TEXT
-        bot.reply_to(message, how_to_order_message, parse_mode='Markdown', reply_markup=inline_markup)
+        queue_reply(message, how_to_order_message, parse_mode='Markdown', reply_markup=BACK_MARKUP)
 
     elif message.text == "💳 Payment & Checklist":
-        inline_markup = types.InlineKeyboardMarkup()
-        back_btn = types.InlineKeyboardButton("🔙 Back", callback_data="back_inline")
-        inline_markup.add(back_btn)
         payments_message = (
             "Payment Options: BTC, XRP, SOL, LTC, ETH\n"
             "REQUEST ADDRESS LINK  @prbot247"
         ) + ATTRACTIVE_TEXT
-        bot.reply_to(message, payments_message, parse_mode='Markdown', reply_markup=inline_markup)
+        queue_reply(message, payments_message, parse_mode='Markdown', reply_markup=BACK_MARKUP)
 
     elif message.text == "🛠️ Admin" and str(message.chat.id) == ADMIN_CHAT_ID:
-        logger.info(f"Admin {message.chat.id} accessed Admin panel")
+        logger.info("Admin %s accessed Admin panel", message.chat.id)
         show_admin_panel(message, page=1)
 
     elif message.text == "🔄 Change Payment Method" and str(message.chat.id) == ADMIN_CHAT_ID:
-        logger.info(f"Admin {message.chat.id} accessed Change Payment Method")
+        logger.info("Admin %s accessed Change Payment Method", message.chat.id)
         show_change_payment_keyboard(message)
 
+    elif str(message.chat.id) == ADMIN_CHAT_ID and (message.text in ("🔙 Back to Admin", "🌐 Website") or message.text.startswith("User ")):
+        handle_change_payment(message)
+
     else:
         unrecognized_message = "🤔 Please use the buttons below to navigate." + ATTRACTIVE_TEXT
-        bot.reply_to(message, unrecognized_message, parse_mode='Markdown')
-        logger.warning(f"User {message.chat.id} sent unrecognized message: {message.text}")
+        queue_reply(message, unrecognized_message, parse_mode='Markdown')
+        logger.warning("User %s sent unrecognized message: %s", message.chat.id, message.text)
+
+# Callback routes: exact names and "<prefix>_<args>" families resolve in constant time
+callback_router = CallbackRouter()
+
+# Callback query IDs already handled; Telegram redelivers updates after a restart or a failed webhook response
+handled_callbacks = RecentKeys(int(os.getenv('CALLBACK_DEDUP_SIZE', '10000')))
 
 # Handler for inline keyboard callback queries
 @bot.callback_query_handler(func=lambda call: True)
+@metrics.timed("handler", handler="callback_inline")
 def callback_inline(call):
-    logger.info(f"User {call.message.chat.id} triggered callback: {call.data}")
+    if not handled_callbacks.add(call.id):
+        metrics.inc("duplicate_callbacks_total")
+        logger.info("Dropped duplicate callback %s from user %s: %s", call.id, call.message.chat.id, call.data)
+        return
+    started = time.perf_counter()
+    try:
+        callback_router.dispatch(call)
+    finally:
+        latency_ms = round((time.perf_counter() - started) * 1000, 2)
+        logger.info(
+            "User %s triggered callback: %s", call.message.chat.id, call.data,
+            extra={"event": "callback", "user_id": str(call.message.chat.id), "callback": call.data, "latency_ms": latency_ms}
+        )
 
-    if call.data == "our_shop":
-        inline_markup = types.InlineKeyboardMarkup()
-        subscribe_btn = types.InlineKeyboardButton("📦 Subscription", callback_data="subscribe")
-        regular_price_btn = types.InlineKeyboardButton("💰 Regular Price", callback_data="regular_price")
-        member_prices_btn = types.InlineKeyboardButton("👥 Subscription Member Prices", callback_data="member_prices")
-        back_btn = types.InlineKeyboardButton("🔙 Back", callback_data="back_inline")
-        inline_markup.row(subscribe_btn, regular_price_btn)
-        inline_markup.row(member_prices_btn, back_btn)
-        shop_message = (
-            "🏬 Welcome to Our Shop!\nBrowse our premium products here. 🎉"
-        ) + ATTRACTIVE_TEXT
-        bot.answer_callback_query(call.id, "Opening Our Shop...")
-        bot.send_message(call.message.chat.id, shop_message, parse_mode='Markdown', reply_markup=get_custom_markup(call.message.chat.id))
-        bot.send_message(call.message.chat.id, "🔹 Please select the desired option" + ATTRACTIVE_TEXT, parse_mode='Markdown', reply_markup=inline_markup)
+@callback_router.exact("our_shop", "back_to_shop")
+def handle_shop(call):
+    catalog = catalog_loader.get()
+    shop_message = (
+        "🏬 Welcome to Our Shop!\nBrowse our premium products here. 🎉\n\n"
+    ) + MENU_PROMPT
+    bot.answer_callback_query(call.id, "Opening Our Shop..." if call.data == "our_shop" else "Returning to Our Shop...")
+    show_menu(call.message.chat.id, shop_message, catalog.shop_markup, call)
 
-    elif call.data == "subscribe":
-        inline_markup = types.InlineKeyboardMarkup()
-        plan_3m_btn = types.InlineKeyboardButton("💎 $45 / 3 Months", callback_data="plan_3m")
-        plan_6m_btn = types.InlineKeyboardButton("💎 $72 / 6 Months", callback_data="plan_6m")
-        plan_8m_btn = types.InlineKeyboardButton("💎 $95 / 8 Months", callback_data="plan_8m")
-        plan_12m_btn = types.InlineKeyboardButton("💎 $145 / 12 Months", callback_data="plan_12m")
-        back_to_shop_btn = types.InlineKeyboardButton("🔙 Back to Shop", callback_data="back_to_shop")
-        inline_markup.row(plan_3m_btn, plan_6m_btn)
-        inline_markup.row(plan_8m_btn, plan_12m_btn)
-        inline_markup.row(back_to_shop_btn)
-        plan_message = "📦 Subscription Plans" + ATTRACTIVE_TEXT
-        bot.answer_callback_query(call.id, "Choose a subscription plan...")
-        bot.send_message(call.message.chat.id, plan_message, parse_mode='Markdown', reply_markup=get_custom_markup(call.message.chat.id))
-        bot.send_message(call.message.chat.id, "🔹 Please select the desired option" + ATTRACTIVE_TEXT, parse_mode='Markdown', reply_markup=inline_markup)
-
-    elif call.data == "regular_price":
-        inline_markup = types.InlineKeyboardMarkup()
-        price_250_btn = types.InlineKeyboardButton("💰 250 Sites $25", callback_data="price_250")
-        price_350_btn = types.InlineKeyboardButton("💰 350 Sites $40", callback_data="price_350")
-        price_550_btn = types.InlineKeyboardButton("💰 550 Sites $50", callback_data="price_550")
-        price_750_btn = types.InlineKeyboardButton("💰 750 Sites $65", callback_data="price_750")
-        price_850_btn = types.InlineKeyboardButton("💰 850 Sites $79", callback_data="price_850")
-        price_1000_btn = types.InlineKeyboardButton("💰 1000 Sites $95", callback_data="price_1000")
-        price_1225_btn = types.InlineKeyboardButton("💰 1225 Sites $120", callback_data="price_1225")
-        price_1350_btn = types.InlineKeyboardButton("💰 1350 Sites $129", callback_data="price_1350")
-        price_1500_btn = types.InlineKeyboardButton("💰 1500 Sites $145", callback_data="price_1500")
-        price_1700_btn = types.InlineKeyboardButton("💰 1700 Sites $159", callback_data="price_1700")
-        price_1850_btn = types.InlineKeyboardButton("💰 1850 Sites $179", callback_data="price_1850")
-        price_2000_btn = types.InlineKeyboardButton("💰 2000 Sites $195", callback_data="price_2000")
-        price_2500_btn = types.InlineKeyboardButton("💰 2500 Sites $229", callback_data="price_2500")
-        price_3000_btn = types.InlineKeyboardButton("💰 3000 Sites $295", callback_data="price_3000")  # New button
-        back_to_shop_btn = types.InlineKeyboardButton("🔙 Back to Shop", callback_data="back_to_shop")
-        inline_markup.row(price_250_btn, price_350_btn)
-        inline_markup.row(price_550_btn, price_750_btn)
-        inline_markup.row(price_850_btn, price_1000_btn)
-        inline_markup.row(price_1225_btn, price_1350_btn)
-        inline_markup.row(price_1500_btn, price_1700_btn)
-        inline_markup.row(price_1850_btn, price_2000_btn)
-        inline_markup.row(price_2500_btn, price_3000_btn)  # Adjusted to include new button
-        inline_markup.row(back_to_shop_btn)
-        price_message = "💰 Regular Price Options" + ATTRACTIVE_TEXT
-        bot.answer_callback_query(call.id, "Viewing Regular Price options...")
-        bot.send_message(call.message.chat.id, price_message, parse_mode='Markdown', reply_markup=get_custom_markup(call.message.chat.id))
-        bot.send_message(call.message.chat.id, "🔹 Please select the desired option" + ATTRACTIVE_TEXT, parse_mode='Markdown', reply_markup=inline_markup)
-
-    elif call.data == "member_prices":
-        inline_markup = types.InlineKeyboardMarkup()
-        member_250_btn = types.InlineKeyboardButton("💰 250 Sites $15", callback_data="member_250")
-        member_350_btn = types.InlineKeyboardButton("💰 350 Sites $35", callback_data="member_350")
-        member_550_btn = types.InlineKeyboardButton("💰 550 Sites $45", callback_data="member_550")
-        member_750_btn = types.InlineKeyboardButton("💰 750 Sites $55", callback_data="member_750")
-        member_850_btn = types.InlineKeyboardButton("💰 850 Sites $65", callback_data="member_850")
-        member_1000_btn = types.InlineKeyboardButton("💰 1000 Sites $75", callback_data="member_1000")
-        member_1225_btn = types.InlineKeyboardButton("💰 1225 Sites $100", callback_data="member_1225")
-        member_1350_btn = types.InlineKeyboardButton("💰 1350 Sites $115", callback_data="member_1350")
-        member_1500_btn = types.InlineKeyboardButton("💰 1500 Sites $135", callback_data="member_1500")
-        member_1700_btn = types.InlineKeyboardButton("💰 1700 Sites $145", callback_data="member_1700")
-        member_1825_btn = types.InlineKeyboardButton("💰 1825 Sites $165", callback_data="member_1825")
-        member_2000_btn = types.InlineKeyboardButton("💰 2000 Sites $189", callback_data="member_2000")
-        member_2500_btn = types.InlineKeyboardButton("💰 2500 Sites $220", callback_data="member_2500")
-        member_3000_btn = types.InlineKeyboardButton("💰 3000 Sites $279", callback_data="member_3000")
-        back_to_shop_btn = types.InlineKeyboardButton("🔙 Back to Shop", callback_data="back_to_shop")
-        inline_markup.row(member_250_btn, member_350_btn)
-        inline_markup.row(member_550_btn, member_750_btn)
-        inline_markup.row(member_850_btn, member_1000_btn)
-        inline_markup.row(member_1225_btn, member_1350_btn)
-        inline_markup.row(member_1500_btn, member_1700_btn)
-        inline_markup.row(member_1825_btn, member_2000_btn)
-        inline_markup.row(member_2500_btn, member_3000_btn)
-        inline_markup.row(back_to_shop_btn)
-        price_message = "👥 Subscription Member Prices" + ATTRACTIVE_TEXT
-        bot.answer_callback_query(call.id, "Viewing Subscription Member Prices...")
-        bot.send_message(call.message.chat.id, price_message, parse_mode='Markdown', reply_markup=get_custom_markup(call.message.chat.id))
-        bot.send_message(call.message.chat.id, "🔹 Please select the desired option" + ATTRACTIVE_TEXT, parse_mode='Markdown', reply_markup=inline_markup)
-
-    elif call.data == "back_to_shop" or call.data == "back_inline":
-        if call.data == "back_inline":
-            bot.answer_callback_query(call.id, "Returning to main menu...")
-            send_welcome(call.message)
-        else:
-            inline_markup = types.InlineKeyboardMarkup()
-            subscribe_btn = types.InlineKeyboardButton("📦 Subscription", callback_data="subscribe")
-            regular_price_btn = types.InlineKeyboardButton("💰 Regular Price", callback_data="regular_price")
-            member_prices_btn = types.InlineKeyboardButton("👥 Subscription Member Prices", callback_data="member_prices")
-            back_btn = types.InlineKeyboardButton("🔙 Back", callback_data="back_inline")
-            inline_markup.row(subscribe_btn, regular_price_btn)
-            inline_markup.row(member_prices_btn, back_btn)
-            shop_message = (
-                "🏬 Welcome to Our Shop!\nBrowse our premium products here. 🎉"
-            ) + ATTRACTIVE_TEXT
-            bot.answer_callback_query(call.id, "Returning to Our Shop...")
-            bot.send_message(call.message.chat.id, shop_message, parse_mode='Markdown', reply_markup=get_custom_markup(call.message.chat.id))
-            bot.send_message(call.message.chat.id, "🔹 Please select the desired option" + ATTRACTIVE_TEXT, parse_mode='Markdown', reply_markup=inline_markup)
-
-    elif call.data in ["plan_3m", "plan_6m", "plan_8m", "plan_12m"]:
-        plan_details = {
-            "plan_3m": {"name": "$45 for 3 Months", "price": "$45"},
-            "plan_6m": {"name": "$72 for 6 Months", "price": "$72"},
-            "plan_8m": {"name": "$95 for 8 Months", "price": "$95"},
-            "plan_12m": {"name": "$145 for 12 Months", "price": "$145"}
-        }
-        selected_plan = plan_details[call.data]
-        user_id = str(call.message.chat.id)
-        subscriptions[user_id] = {
-            "plan": selected_plan["name"],
-            "payment": f"Payment: {selected_plan['price']} via Website",
-            "status": "pending"
-        }
-        save_subscriptions(subscriptions)
-        logger.info(f"User {user_id} selected subscription plan {selected_plan['name']} for {selected_plan['price']}. Subscriptions: {subscriptions}")
-        inline_markup = types.InlineKeyboardMarkup()
-        inline_markup.row(
-            types.InlineKeyboardButton("🌐 Pay via Website", callback_data=f"pay_website_{user_id}")
+@callback_router.exact("back_inline")
+def handle_back_inline(call):
+    bot.answer_callback_query(call.id, "Returning to main menu...")
+    send_welcome(call.message)
+
+# Catalog families and items are routed from the live catalog, so new price families need no code
+@callback_router.fallback
+def resolve_catalog_route(data):
+    catalog = catalog_loader.get()
+    if data in catalog.families:
+        return "catalog_family", handle_catalog_family
+    if data in catalog.items:
+        return "catalog_item", handle_catalog_item
+    return None
+
+def handle_catalog_family(call):
+    catalog = catalog_loader.get()
+    family = catalog.families[call.data]
+    bot.answer_callback_query(call.id, family["answer"])
+    show_menu(call.message.chat.id, family["title"] + "\n\n" + MENU_PROMPT, catalog.family_markups[call.data], call)
+
+def handle_catalog_item(call):
+    catalog = catalog_loader.get()
+    selected_item = catalog.items[call.data]
+    family = catalog.item_family[call.data]
+    user_id = str(call.message.chat.id)
+    def select(record):
+        record.update(
+            user_id=user_id, plan=selected_item["name"], item=selected_item["id"],
+            payment=payment_text(selected_item['price'], "Website"), timestamp=str(datetime.now())
         )
-        inline_markup.row(types.InlineKeyboardButton("🔙 Back to Plans", callback_data="subscribe"))
-        payment_message = (
-            f"💎 Subscription Plan Selected: {selected_plan['name']}\n"
-            "💳 Payment Method: Choose below to complete your payment.\n"
-            "⚠️ Your request is pending admin approval after payment. You’ll be notified once processed!\n"
+        record.setdefault("transaction_id", transaction_id)
+    # Choosing again before paying replaces the unpaid selection instead of opening another
+    # order. Updates from one chat can run in parallel (polling and webhook pools), so the
+    # find-or-create holds the user's lock: a double tap cannot open two orders.
+    with order_states.locked(user_id):
+        transaction_id = find_order(user_id, SELECTED)
+        record, applied = modify_order(transaction_id, select, states=(SELECTED,)) if transaction_id else (None, False)
+        if not applied:
+            transaction_id = str(uuid.uuid4())
+            transition_order(transaction_id, "select", select)
+            analytics.count("selected")
+    logger.info(
+        "User %s selected %s %s for %s", user_id, family['kind'], selected_item['name'], selected_item['price'],
+        extra={"event": "plan_selected", "user_id": user_id, "callback": call.data}
+    )
+    inline_markup = types.InlineKeyboardMarkup()
+    inline_markup.row(
+        types.InlineKeyboardButton("🌐 Pay via Website", callback_data=f"pay_website_{transaction_id}")
+    )
+    inline_markup.row(types.InlineKeyboardButton(family["back"], callback_data=family["id"]))
+    payment_message = (
+        f"{family['selected']}: {selected_item['name']}\n"
+        "💳 Payment Method: Choose below to complete your payment.\n"
+        "⚠️ Your request is pending admin approval after payment. You’ll be notified once processed!\n\n"
+    ) + MENU_PROMPT
+    bot.answer_callback_query(call.id, f"Selected {selected_item['name']}")
+    show_menu(call.message.chat.id, payment_message, inline_markup, call)
+
+# Admin notifications are sent by the leader, so the "notified" line is logged there,
+# once Telegram has accepted the message
+def notify_admin_of_payment(user_id, transaction_id, admin_message, admin_markup):
+    if run_on_leader("notify_admin_of_payment", user_id, transaction_id, admin_message, admin_markup):
+        return
+    def log_admin_notified(future):
+        if future.exception():
+            logger.error("Failed to notify admin %s for user %s: %s", ADMIN_CHAT_ID, user_id, future.exception())
+        else:
+            logger.info("Admin %s notified of Website payment request from user %s with Transaction ID: %s", ADMIN_CHAT_ID, user_id, transaction_id)
+    queue_message(ADMIN_CHAT_ID, admin_message, parse_mode='Markdown', reply_markup=admin_markup).add_done_callback(log_admin_notified)
+
+@callback_router.prefix("pay_website_", str)
+def handle_pay_website(call, key):
+    user_id = str(call.message.chat.id)
+    timestamp = datetime.now()
+    def request_payment(record):
+        record["timestamp"] = str(timestamp)
+        record["payment"] = payment_with_method(record["payment"], "Website")
+    transaction_id = find_order(key, SELECTED, PENDING)
+    record = order_repository.get(transaction_id) if transaction_id else None
+    if record is not None and record.get("user_id") == user_id:
+        record, applied = transition_order(transaction_id, "request_payment", request_payment)
+    else:
+        record = None
+    if record is None:
+        error_message = (
+            "⚠️ Selection not found.\n"
+            "It seems you haven’t selected a plan or price yet. Please choose an option first.\n"
+            "👉 Go back and select from the 'Our Shop' menu."
         ) + ATTRACTIVE_TEXT
-        bot.answer_callback_query(call.id, f"Selected {selected_plan['name']}")
-        bot.send_message(call.message.chat.id, payment_message, parse_mode='Markdown', reply_markup=get_custom_markup(call.message.chat.id))
-        bot.send_message(call.message.chat.id, "🔹 Please select the desired option" + ATTRACTIVE_TEXT, parse_mode='Markdown', reply_markup=inline_markup)
-
-    elif call.data in ["price_250", "price_350", "price_550", "price_750", "price_850", "price_1000", "price_1225", "price_1350", "price_1500", "price_1700", "price_1850", "price_2000", "price_2500", "price_3000"]:
-        price_details = {
-            "price_250": {"name": "250 Sites $25", "price": "$25"},
-            "price_350": {"name": "350 Sites $40", "price": "$40"},
-            "price_550": {"name": "550 Sites $50", "price": "$50"},
-            "price_750": {"name": "750 Sites $65", "price": "$65"},
-            "price_850": {"name": "850 Sites $79", "price": "$79"},
-            "price_1000": {"name": "1000 Sites $95", "price": "$95"},
-            "price_1225": {"name": "1225 Sites $120", "price": "$120"},
-            "price_1350": {"name": "1350 Sites $129", "price": "$129"},
-            "price_1500": {"name": "1500 Sites $145", "price": "$145"},
-            "price_1700": {"name": "1700 Sites $159", "price": "$159"},
-            "price_1850": {"name": "1850 Sites $179", "price": "$179"},
-            "price_2000": {"name": "2000 Sites $195", "price": "$195"},
-            "price_2500": {"name": "2500 Sites $229", "price": "$229"},
-            "price_3000": {"name": "3000 Sites $295", "price": "$295"}  # New entry
-        }
-        selected_price = price_details[call.data]
-        user_id = str(call.message.chat.id)
-        subscriptions[user_id] = {
-            "plan": selected_price["name"],
-            "payment": f"Payment: {selected_price['price']} via Website",
-            "status": "pending"
-        }
-        save_subscriptions(subscriptions)
-        logger.info(f"User {user_id} selected regular price {selected_price['name']} for {selected_price['price']}. Subscriptions: {subscriptions}")
-        inline_markup = types.InlineKeyboardMarkup()
-        inline_markup.row(
-            types.InlineKeyboardButton("🌐 Pay via Website", callback_data=f"pay_website_{user_id}")
-        )
-        inline_markup.row(types.InlineKeyboardButton("🔙 Back to Prices", callback_data="regular_price"))
-        payment_message = (
-            f"💰 Regular Price Selected: {selected_price['name']}\n"
-            "💳 Payment Method: Choose below to complete your payment.\n"
-            "⚠️ Your request is pending admin approval after payment. You’ll be notified once processed!\n"
+        queue_message(call.message.chat.id, error_message, parse_mode='Markdown')
+        logger.warning("Subscription not found for user_id: %s", user_id, extra={"event": "payment_without_selection", "user_id": user_id})
+        return
+    if not applied:
+        # A repeated tap (or a button from an old selection): no new transaction, no second admin request
+        if state_of(record) == PENDING:
+            bot.answer_callback_query(call.id, f"Payment already requested. Transaction ID: {record['transaction_id']}")
+        else:
+            bot.answer_callback_query(call.id, "Please select a plan from 'Our Shop' first.")
+        logger.info("Ignored payment request from user %s in state %s", user_id, state_of(record), extra={"event": "payment_duplicate", "user_id": user_id})
+        return
+    analytics.count("pay")
+    logger.info(
+        "User %s initiated Website payment for %s at %s with Transaction ID: %s", user_id, record['plan'], timestamp, transaction_id,
+        extra={"event": "payment_initiated", "user_id": user_id, "transaction_id": transaction_id}
+    )
+    admin_message = (
+        f"🔔 New Website Payment Request\n"
+        f"────\n"
+        f"User ID: {user_id}\n"
+        f"Transaction ID: {transaction_id}\n"
+        f"Plan: {record['plan']}\n"
+        f"Payment: {record['payment']}\n"
+        f"Status: {record['status']}\n"
+        f"Timestamp: {timestamp}\n"
+        "\n👉 Take action below:" + ATTRACTIVE_TEXT
+    )
+    admin_markup = types.InlineKeyboardMarkup()
+    admin_markup.row(
+        types.InlineKeyboardButton("✅ Approve", callback_data=f"activate_{transaction_id}"),
+        types.InlineKeyboardButton("❌ Reject", callback_data=f"reject_{transaction_id}")
+    )
+    notify_admin_of_payment(user_id, transaction_id, admin_message, admin_markup)
+    family = catalog_loader.get().item_family.get(record.get("item"))
+    if family:
+        payment_link = family["payment_link"]
+    else:
+        payment_link = "https://prbot247.com/subscribe-now/#link" if "Months" in record["plan"] else "https://prbot247.com/subscription-members/"
+    # Creating a provider checkout is a network call, so it runs on the outbound queue
+    outbound.submit(
+        call.message.chat.id, send_payment_link, call.message.chat.id, user_id, transaction_id,
+        record['plan'], record_price(record), payment_link
+    )
+
+# Send the payment link: a provider checkout for this transaction when one is configured, else the website
+def send_payment_link(chat_id, user_id, transaction_id, plan, price, website_link):
+    payment_link = None
+    if price is not None:
+        try:
+            payment_link = payment_provider.create_checkout(transaction_id, user_id, plan, price)
+        except Exception as e:
+            logger.error("Failed to create %s checkout for user %s: %s", payment_provider.name, user_id, e)
+    payment_message = (
+        f"🌐 Website Payment\n"
+        f"────\n"
+        f"Transaction ID: {transaction_id}\n"
+        f"Plan: {plan}\n"
+        "👉 Click the link below to complete your payment on our website.\n"
+        f"[Pay Now]({payment_link or website_link})\n"
+        + ("✅ Your purchase is activated automatically once the payment confirms." if payment_link else "⚠️ After payment, your request is pending admin approval.")
+    ) + ATTRACTIVE_TEXT
+    return bot.send_message(chat_id, payment_message, parse_mode='Markdown', disable_web_page_preview=True)
+
+# Activate a pending order: expiry from the catalog item's "months", scheduler and user
+# notification. update(record) adds to the same write. Returns (record, applied).
+def activate_order(transaction_id, update=None):
+    def activate(record):
+        activated_at = datetime.now()
+        record["activated_at"] = str(activated_at)
+        record.pop("reminders_sent", None)
+        # Subscription plans run for the item's "months"; one-off purchases never expire
+        months = catalog_loader.get().items.get(record.get("item"), {}).get("months")
+        if months:
+            record["expires_at"] = str(add_months(activated_at, months))
+        if update:
+            update(record)
+    record, applied = transition_order(transaction_id, "activate", activate)
+    if applied:
+        analytics.activated(record["plan"], order_amount(record, catalog_loader.get().items), approval_latency(record))
+        user_message = (
+            f"🎉 Purchase Activated! 🎉\n"
+            f"────\n"
+            f"Transaction ID: {record['transaction_id']}\n"
+            f"Your {record['plan']} has been activated successfully! 💎\n"
+            f"Payment: {record['payment']}\n"
+            "👉 Enjoy your premium features now! 🚀\n"
         ) + ATTRACTIVE_TEXT
-        bot.answer_callback_query(call.id, f"Selected {selected_price['name']}")
-        bot.send_message(call.message.chat.id, payment_message, parse_mode='Markdown', reply_markup=get_custom_markup(call.message.chat.id))
-        bot.send_message(call.message.chat.id, "🔹 Please select the desired option" + ATTRACTIVE_TEXT, parse_mode='Markdown', reply_markup=inline_markup)
-
-    elif call.data in ["member_250", "member_350", "member_550", "member_750", "member_850", "member_1000", "member_1225", "member_1350", "member_1500", "member_1700", "member_1825", "member_2000", "member_2500", "member_3000"]:
-        member_price_details = {
-            "member_250": {"name": "250 Sites $15", "price": "$15"},
-            "member_350": {"name": "350 Sites $35", "price": "$35"},
-            "member_550": {"name": "550 Sites $45", "price": "$45"},
-            "member_750": {"name": "750 Sites $55", "price": "$55"},
-            "member_850": {"name": "850 Sites $65", "price": "$65"},
-            "member_1000": {"name": "1000 Sites $75", "price": "$75"},
-            "member_1225": {"name": "1225 Sites $100", "price": "$100"},
-            "member_1350": {"name": "1350 Sites $115", "price": "$115"},
-            "member_1500": {"name": "1500 Sites $135", "price": "$135"},
-            "member_1700": {"name": "1700 Sites $145", "price": "$145"},
-            "member_1825": {"name": "1825 Sites $165", "price": "$165"},
-            "member_2000": {"name": "2000 Sites $189", "price": "$189"},
-            "member_2500": {"name": "2500 Sites $220", "price": "$220"},
-            "member_3000": {"name": "3000 Sites $279", "price": "$279"}
-        }
-        selected_price = member_price_details[call.data]
-        user_id = str(call.message.chat.id)
-        subscriptions[user_id] = {
-            "plan": selected_price["name"],
-            "payment": f"Payment: {selected_price['price']} via Website",
-            "status": "pending"
-        }
-        save_subscriptions(subscriptions)
-        logger.info(f"User {user_id} selected member price {selected_price['name']} for {selected_price['price']}. Subscriptions: {subscriptions}")
+        queue_message(int(record["user_id"]), user_message, parse_mode='Markdown')
+    return record, applied
+
+# An approve/reject that no longer applies: already handled (another tap, another admin, auto-confirmation) or nothing requested
+def answer_stale_action(call, key, record):
+    bot.answer_callback_query(call.id, f"No pending purchase for {key} ({state_of(record) or 'none'})")
+    logger.info("Admin %s action on %s ignored in state %s", call.message.chat.id, key, state_of(record), extra={"event": "stale_admin_action", "callback": call.data})
+
+# activate_<transaction_id> (or a user ID on older buttons)
+@callback_router.prefix("activate_", str)
+def handle_activate(call, key):
+    if str(call.message.chat.id) != ADMIN_CHAT_ID:
+        return
+    transaction_id = find_order(key, PENDING)
+    record, applied = activate_order(transaction_id) if transaction_id else (None, False)
+    if applied:
+        bot.answer_callback_query(call.id, f"Activated purchase for User ID {record['user_id']}")
+        logger.info(
+            "Admin %s activated purchase for user %s with Transaction ID: %s", call.message.chat.id, record['user_id'], transaction_id,
+            extra={"event": "activated", "user_id": record['user_id'], "transaction_id": transaction_id}
+        )
+    else:
+        answer_stale_action(call, key, record)
+    show_admin_panel(call.message, page=1)
+
+@callback_router.prefix("reject_", str)
+def handle_reject(call, key):
+    if str(call.message.chat.id) != ADMIN_CHAT_ID:
+        return
+    reason = "Reason not provided"
+    def reject(record):
+        record["reason"] = reason
+    transaction_id = find_order(key, PENDING)
+    record, applied = transition_order(transaction_id, "reject", reject) if transaction_id else (None, False)
+    if not applied:
+        answer_stale_action(call, key, record)
+        show_admin_panel(call.message, page=1)
+        return
+    user_id = record["user_id"]
+    user_message = (
+        f"❌ Purchase Rejected ❌\n"
+        f"────\n"
+        f"Transaction ID: {transaction_id}\n"
+        f"Your {record['plan']} request has been rejected. 😔\n"
+        f"Reason: {reason}\n"
+        f"Payment: {record['payment']}\n"
+        "👉 Contact support for assistance: [Support](https://prbot247.com/support)\n"
+    ) + ATTRACTIVE_TEXT
+    queue_message(int(user_id), user_message, parse_mode='Markdown')
+    bot.answer_callback_query(call.id, f"Rejected purchase for User ID {user_id}")
+    logger.info(
+        "Admin %s rejected purchase for user %s with Transaction ID: %s", call.message.chat.id, user_id, transaction_id,
+        extra={"event": "rejected", "user_id": user_id, "transaction_id": transaction_id}
+    )
+    show_admin_panel(call.message, page=1)
+
+@callback_router.exact("download_data")
+def handle_download_data(call):
+    if str(call.message.chat.id) != ADMIN_CHAT_ID:
+        return
+    bot.answer_callback_query(call.id, "Preparing user data export...")
+    start_export(call.message.chat.id, "txt", False, {})
+
+@callback_router.prefix("change_payment_", str)
+def handle_change_payment_callback(call, key):
+    transaction_id = find_order(key, PENDING)
+    record = order_repository.get(transaction_id) if transaction_id else None
+    if record is not None and str(call.message.chat.id) == ADMIN_CHAT_ID:
         inline_markup = types.InlineKeyboardMarkup()
         inline_markup.row(
-            types.InlineKeyboardButton("🌐 Pay via Website", callback_data=f"pay_website_{user_id}")
+            types.InlineKeyboardButton("🌐 Website", callback_data=f"set_payment_website_{transaction_id}")
         )
-        inline_markup.row(types.InlineKeyboardButton("🔙 Back to Member Prices", callback_data="member_prices"))
-        payment_message = (
-            f"👥 Subscription Member Price Selected: {selected_price['name']}\n"
-            "💳 Payment Method: Choose below to complete your payment.\n"
-            "⚠️ Your request is pending admin approval after payment. You’ll be notified once processed!\n"
-        ) + ATTRACTIVE_TEXT
-        bot.answer_callback_query(call.id, f"Selected {selected_price['name']}")
-        bot.send_message(call.message.chat.id, payment_message, parse_mode='Markdown', reply_markup=get_custom_markup(call.message.chat.id))
-        bot.send_message(call.message.chat.id, "🔹 Please select the desired option" + ATTRACTIVE_TEXT, parse_mode='Markdown', reply_markup=inline_markup)
-
-    elif call.data.startswith("pay_website_"):
-        user_id = call.data.split("_")[2]
-        logger.info(f"Payment attempt for user_id: {user_id}. Current subscriptions: {subscriptions}")
-        if user_id in subscriptions:
-            timestamp = datetime.now()
-            transaction_id = str(uuid.uuid4())
-            subscriptions[user_id]["timestamp"] = str(timestamp)
-            subscriptions[user_id]["transaction_id"] = transaction_id
-            subscriptions[user_id]["payment"] = f"Payment: {subscriptions[user_id]['payment'].split(' via')[0]} via Website"
-            save_subscriptions(subscriptions)
-            logger.info(f"User {user_id} initiated Website payment for {subscriptions[user_id]['plan']} at {timestamp} with Transaction ID: {transaction_id}")
-            admin_message = (
-                f"🔔 New Website Payment Request\n"
+        inline_markup.row(types.InlineKeyboardButton("🔙 Back", callback_data=f"back_to_admin_{transaction_id}"))
+        bot.answer_callback_query(call.id, "Select new payment method...")
+        queue_message(call.message.chat.id, f"🔄 Change Payment Method for User ID {record['user_id']}\nSelect a new payment method:", parse_mode='Markdown', reply_markup=inline_markup)
+
+# Rewrite the method in an order's payment text; returns (old payment, record) or (None, None)
+def change_payment_method(transaction_id, new_method):
+    old = []
+    def change(record):
+        old.append(record["payment"])
+        record["payment"] = payment_with_method(record["payment"], new_method)
+    record, applied = modify_order(transaction_id, change)
+    return (old[-1], record) if applied else (None, None)
+
+# set_payment_<method>_<transaction_id> (or a user ID on older buttons)
+@callback_router.prefix("set_payment_", str, str)
+def handle_set_payment(call, new_method_key, key):
+    transaction_id = find_order(key, PENDING)
+    if transaction_id and str(call.message.chat.id) == ADMIN_CHAT_ID:
+        method_mapping = {
+            "website": "Website"
+        }
+        new_method = method_mapping.get(new_method_key)
+        if new_method:
+            old_payment, record = change_payment_method(transaction_id, new_method)
+            if record is None:
+                return
+            user_id = record["user_id"]
+            user_message = (
+                f"ℹ️ Payment Method Updated\n"
                 f"────\n"
                 f"User ID: {user_id}\n"
-                f"Transaction ID: {transaction_id}\n"
-                f"Plan: {subscriptions[user_id]['plan']}\n"
-                f"Payment: {subscriptions[user_id]['payment']}\n"
-                f"Status: {subscriptions[user_id]['status']}\n"
-                f"Timestamp: {timestamp}\n"
-                "\n👉 Take action below:" + ATTRACTIVE_TEXT
-            )
-            admin_markup = types.InlineKeyboardMarkup()
-            admin_markup.row(
-                types.InlineKeyboardButton("✅ Approve", callback_data=f"activate_{user_id}"),
-                types.InlineKeyboardButton("❌ Reject", callback_data=f"reject_{user_id}")
-            )
-            try:
-                bot.send_message(ADMIN_CHAT_ID, admin_message, parse_mode='Markdown', reply_markup=admin_markup)
-                logger.info(f"Admin {ADMIN_CHAT_ID} notified of Website payment request from user {user_id} with Transaction ID: {transaction_id}")
-            except Exception as e:
-                logger.error(f"Failed to notify admin {ADMIN_CHAT_ID} for user {user_id}: {str(e)}")
-            payment_link = "https://prbot247.com/subscribe-now/#link" if "Months" in subscriptions[user_id]["plan"] else "https://prbot247.com/subscription-members/"
-            payment_message = (
-                f"🌐 Website Payment\n"
-                f"────\n"
-                f"Transaction ID: {transaction_id}\n"
-                f"Plan: {subscriptions[user_id]['plan']}\n"
-                "👉 Click the link below to complete your payment on our website.\n"
-                f"[Pay Now]({payment_link})\n"
-                "⚠️ After payment, your request is pending admin approval."
-            ) + ATTRACTIVE_TEXT
-            bot.send_message(call.message.chat.id, payment_message, parse_mode='Markdown', disable_web_page_preview=True)
-        else:
-            error_message = (
-                "⚠️ Selection not found.\n"
-                "It seems you haven’t selected a plan or price yet. Please choose an option first.\n"
-                "👉 Go back and select from the 'Our Shop' menu."
+                f"Old Payment: {old_payment}\n"
+                f"New Payment: {record['payment']}\n"
+                "👉 Your payment method has been updated by the admin."
             ) + ATTRACTIVE_TEXT
-            bot.send_message(call.message.chat.id, error_message, parse_mode='Markdown')
-            logger.warning(f"Subscription not found for user_id: {user_id}. Current subscriptions: {subscriptions}")
-
-    elif call.data.startswith("activate_") or call.data.startswith("reject_") or call.data == "download_data":
-        user_id = call.data.split("_")[1] if "_" in call.data else None
-        if user_id and str(call.message.chat.id) == ADMIN_CHAT_ID:
-            if call.data.startswith("activate_"):
-                subscriptions[user_id]["status"] = "activated"
-                save_subscriptions(subscriptions)
-                user_message = (
-                    f"🎉 Purchase Activated! 🎉\n"
-                    f"────\n"
-                    f"Transaction ID: {subscriptions[user_id]['transaction_id']}\n"
-                    f"Your {subscriptions[user_id]['plan']} has been activated successfully! 💎\n"
-                    f"Payment: {subscriptions[user_id]['payment']}\n"
-                    "👉 Enjoy your premium features now! 🚀\n"
-                ) + ATTRACTIVE_TEXT
-                bot.send_message(int(user_id), user_message, parse_mode='Markdown')
-                bot.answer_callback_query(call.id, f"Activated purchase for User ID {user_id}")
-                logger.info(f"Admin {call.message.chat.id} activated purchase for user {user_id} with Transaction ID: {subscriptions[user_id]['transaction_id']}")
-                show_admin_panel(call.message, page=1)
-            elif call.data.startswith("reject_"):
-                reason = "Reason not provided"
-                subscriptions[user_id]["status"] = "rejected"
-                save_subscriptions(subscriptions)
-                user_message = (
-                    f"❌ Purchase Rejected ❌\n"
-                    f"────\n"
-                    f"Transaction ID: {subscriptions[user_id]['transaction_id']}\n"
-                    f"Your {subscriptions[user_id]['plan']} request has been rejected. 😔\n"
-                    f"Reason: {reason}\n"
-                    f"Payment: {subscriptions[user_id]['payment']}\n"
-                    "👉 Contact support for assistance: [Support](https://prbot247.com/support)\n"
-                ) + ATTRACTIVE_TEXT
-                bot.send_message(int(user_id), user_message, parse_mode='Markdown')
-                bot.answer_callback_query(call.id, f"Rejected purchase for User ID {user_id}")
-                logger.info(f"Admin {call.message.chat.id} rejected purchase for user {user_id} with Transaction ID: {subscriptions[user_id]['transaction_id']}")
-                show_admin_panel(call.message, page=1)
-            elif call.data == "download_data":
-                try:
-                    user_data = "User Data with Payment Details:\n\n"
-                    for uid, data in subscriptions.items():
-                        user_data += f"User ID: {uid}\n"
-                        user_data += f"Transaction ID: {data.get('transaction_id', 'N/A')}\n"
-                        user_data += f"Plan: {data.get('plan', 'N/A')}\n"
-                        user_data += f"Payment: {data.get('payment', 'N/A')}\n"
-                        user_data += f"Status: {data.get('status', 'N/A')}\n"
-                        user_data += f"Timestamp: {data.get('timestamp', 'N/A')}\n"
-                        user_data += "────\n"
-                    with open("user_data.txt", "w", encoding='utf-8') as f:
-                        f.write(user_data)
-                    with open("user_data.txt", "rb") as f:
-                        bot.send_document(ADMIN_CHAT_ID, f)
-                    bot.answer_callback_query(call.id, "User data downloaded as 'user_data.txt'")
-                    logger.info(f"Admin {call.message.chat.id} downloaded user data")
-                    os.remove("user_data.txt")
-                except Exception as e:
-                    logger.error(f"Failed to download user data for admin {call.message.chat.id}: {str(e)}")
-                    bot.answer_callback_query(call.id, "Failed to download user data. Check logs for details.")
-                    raise e
-
-    elif call.data.startswith("change_payment_"):
-        user_id = call.data.split("_")[2]
-        if user_id in subscriptions and str(call.message.chat.id) == ADMIN_CHAT_ID:
-            inline_markup = types.InlineKeyboardMarkup()
-            inline_markup.row(
-                types.InlineKeyboardButton("🌐 Website", callback_data=f"set_payment_website_{user_id}")
-            )
-            inline_markup.row(types.InlineKeyboardButton("🔙 Back", callback_data=f"back_to_admin_{user_id}"))
-            bot.answer_callback_query(call.id, "Select new payment method...")
-            bot.send_message(call.message.chat.id, f"🔄 Change Payment Method for User ID {user_id}\nSelect a new payment method:", parse_mode='Markdown', reply_markup=inline_markup)
-
-    elif call.data.startswith("set_payment_"):
-        user_id = call.data.split("_")[2]
-        if user_id in subscriptions and str(call.message.chat.id) == ADMIN_CHAT_ID:
-            method_mapping = {
-                "website": "Website"
-            }
-            new_method_key = call.data.split("_")[2]
-            new_method = method_mapping.get(new_method_key)
-            if new_method:
-                old_payment = subscriptions[user_id]["payment"]
-                subscriptions[user_id]["payment"] = f"Payment: {old_payment.split(' via')[0]} via {new_method}"
-                save_subscriptions(subscriptions)
-                user_message = (
-                    f"ℹ️ Payment Method Updated\n"
-                    f"────\n"
-                    f"User ID: {user_id}\n"
-                    f"Old Payment: {old_payment}\n"
-                    f"New Payment: {subscriptions[user_id]['payment']}\n"
-                    "👉 Your payment method has been updated by the admin."
-                ) + ATTRACTIVE_TEXT
-                bot.send_message(int(user_id), user_message, parse_mode='Markdown')
-                bot.answer_callback_query(call.id, f"Payment method changed to {new_method} for User ID {user_id}")
-                logger.info(f"Admin {call.message.chat.id} changed payment method to {new_method} for user {user_id}")
-                show_admin_panel(call.message, page=1)
-
-    elif call.data.startswith("back_to_admin_"):
-        user_id = call.data.split("_")[2]
-        if str(call.message.chat.id) == ADMIN_CHAT_ID:
-            bot.answer_callback_query(call.id, "Returning to Admin Panel...")
+            queue_message(int(user_id), user_message, parse_mode='Markdown')
+            bot.answer_callback_query(call.id, f"Payment method changed to {new_method} for User ID {user_id}")
+            logger.info("Admin %s changed payment method to %s for user %s", call.message.chat.id, new_method, user_id)
             show_admin_panel(call.message, page=1)
 
-    elif call.data.startswith("page_"):
-        page = int(call.data.split("_")[1])
-        bot.answer_callback_query(call.id, f"Viewing page {page}...")
-        logger.info(f"Admin {call.message.chat.id} viewed admin panel page {page}")
-        show_admin_panel(call.message, page=page)
+@callback_router.prefix("back_to_admin_", str)
+def handle_back_to_admin(call, key):
+    if str(call.message.chat.id) == ADMIN_CHAT_ID:
+        bot.answer_callback_query(call.id, "Returning to Admin Panel...")
+        show_admin_panel(call.message, page=1)
+
+@callback_router.prefix("page_", int)
+def handle_page(call, page):
+    bot.answer_callback_query(call.id, f"Viewing page {page}...")
+    logger.info("Admin %s viewed admin panel page %s", call.message.chat.id, page)
+    show_admin_panel(call.message, page=page)
+
+@callback_router.prefix("search_", str, int)
+def handle_search_page(call, search_id, page):
+    if str(call.message.chat.id) != ADMIN_CHAT_ID:
+        bot.answer_callback_query(call.id, "Unauthorized action!")
+        return
+    if search_sessions.page(search_id, page) is None:
+        bot.answer_callback_query(call.id, "This search has expired; run /search again.")
+        return
+    bot.answer_callback_query(call.id, f"Viewing page {page + 1}...")
+    show_search_page(call.message.chat.id, search_id, page, message_id=call.message.message_id)
 
 # Admin panel to manage subscriptions with pagination
+@metrics.timed("handler", handler="show_admin_panel")
 def show_admin_panel(message, page=1):
     if str(message.chat.id) == ADMIN_CHAT_ID:
-        pending_subscriptions = {uid: data for uid, data in subscriptions.items() if data.get("status") == "pending"}
-        if not pending_subscriptions:
+        total_items = order_repository.count_by_status("pending")
+        if not total_items:
             no_pending_message = (
                 "📋 No Pending Purchases 📋\n────\nNo requests are pending at the moment."
             ) + ATTRACTIVE_TEXT
-            bot.reply_to(message, no_pending_message, parse_mode='Markdown')
-            logger.info(f"Admin {message.chat.id} viewed admin panel: No pending subscriptions")
+            queue_reply(message, no_pending_message, parse_mode='Markdown')
+            logger.info("Admin %s viewed admin panel: No pending subscriptions", message.chat.id)
             return
 
-        total_items = len(pending_subscriptions)
         total_pages = (total_items + PAGE_SIZE - 1) // PAGE_SIZE
         page = max(1, min(page, total_pages))
         start_idx = (page - 1) * PAGE_SIZE
-        end_idx = min(start_idx + PAGE_SIZE, total_items)
-        items_on_page = list(pending_subscriptions.items())[start_idx:end_idx]
+        items_on_page = order_repository.find_by_status("pending", offset=start_idx, limit=PAGE_SIZE)
 
         admin_message = (
             f"🛠️ Admin Panel: Manage Purchases 🛠️\n"
@@ -599,9 +1242,9 @@ def show_admin_panel(message, page=1):
             f"📋 Pending Purchases (Page {page}/{total_pages})\n"
             f"Total Requests: {total_items}\n\n"
         )
-        for user_id, data in items_on_page:
-            admin_message += f"🔹 User ID: {user_id}\n"
-            admin_message += f"  Transaction ID: {data.get('transaction_id', 'N/A')}\n"
+        for transaction_id, data in items_on_page:
+            admin_message += f"🔹 User ID: {data.get('user_id', 'N/A')}\n"
+            admin_message += f"  Transaction ID: {transaction_id}\n"
             admin_message += f"  Plan: {data.get('plan', 'N/A')}\n"
             admin_message += f"  Payment: {data.get('payment', 'N/A')}\n"
             admin_message += f"  Timestamp: {data.get('timestamp', 'N/A')}\n"
@@ -610,16 +1253,18 @@ def show_admin_panel(message, page=1):
         admin_message += "\n🔔 Additional Admin Features:\n"
         admin_message += "  - Change Payment Method\n"
         admin_message += "  - Download User Data\n"
+        admin_message += "  - Search Orders: /search\n"
+        admin_message += "  - Sales Report: /report\n"
         admin_message += ATTRACTIVE_TEXT
 
         inline_markup = types.InlineKeyboardMarkup()
-        for user_id, _ in items_on_page:
+        for transaction_id, _ in items_on_page:
             inline_markup.row(
-                types.InlineKeyboardButton("✅ Approve", callback_data=f"activate_{user_id}"),
-                types.InlineKeyboardButton("❌ Reject", callback_data=f"reject_{user_id}")
+                types.InlineKeyboardButton("✅ Approve", callback_data=f"activate_{transaction_id}"),
+                types.InlineKeyboardButton("❌ Reject", callback_data=f"reject_{transaction_id}")
             )
             inline_markup.row(
-                types.InlineKeyboardButton("🔄 Change Payment", callback_data=f"change_payment_{user_id}")
+                types.InlineKeyboardButton("🔄 Change Payment", callback_data=f"change_payment_{transaction_id}")
             )
 
         pagination_row = []
@@ -636,46 +1281,49 @@ def show_admin_panel(message, page=1):
 
         admin_options_message = "🔹 Admin Options:" + ATTRACTIVE_TEXT
 
-        if hasattr(message, 'message_id'):
-            try:
-                bot.edit_message_text(
-                    chat_id=message.chat.id,
-                    message_id=message.message_id,
-                    text=admin_message,
-                    parse_mode='Markdown',
-                    reply_markup=inline_markup
-                )
-                logger.info(f"Admin panel message edited for {message.chat.id}, message_id: {message.message_id}")
-            except Exception as e:
-                logger.error(f"Failed to edit admin panel message for {message.chat.id}, message_id: {message.message_id}: {str(e)}")
+        # Edit-or-replace runs as one queued job so it stays ordered with the options message
+        def render_panel():
+            if hasattr(message, 'message_id'):
                 try:
-                    bot.delete_message(chat_id=message.chat.id, message_id=message.message_id)
-                    logger.info(f"Deleted old admin panel message for {message.chat.id}, message_id: {message.message_id}")
-                except Exception as delete_error:
-                    logger.warning(f"Failed to delete old admin panel message for {message.chat.id}, message_id: {message.message_id}: {str(delete_error)}")
-                new_message = bot.send_message(message.chat.id, admin_message, parse_mode='Markdown', reply_markup=inline_markup)
-                logger.info(f"Sent new admin panel message for {message.chat.id}, new message_id: {new_message.message_id}")
-        else:
-            new_message = bot.reply_to(message, admin_message, parse_mode='Markdown', reply_markup=inline_markup)
-            logger.info(f"Sent initial admin panel message for {message.chat.id}, message_id: {new_message.message_id}")
+                    bot.edit_message_text(
+                        chat_id=message.chat.id,
+                        message_id=message.message_id,
+                        text=admin_message,
+                        parse_mode='Markdown',
+                        reply_markup=inline_markup
+                    )
+                    logger.info("Admin panel message edited for %s, message_id: %s", message.chat.id, message.message_id)
+                except Exception as e:
+                    logger.error("Failed to edit admin panel message for %s, message_id: %s: %s", message.chat.id, message.message_id, e)
+                    try:
+                        bot.delete_message(chat_id=message.chat.id, message_id=message.message_id)
+                        logger.info("Deleted old admin panel message for %s, message_id: %s", message.chat.id, message.message_id)
+                    except Exception as delete_error:
+                        logger.warning("Failed to delete old admin panel message for %s, message_id: %s: %s", message.chat.id, message.message_id, delete_error)
+                    new_message = bot.send_message(message.chat.id, admin_message, parse_mode='Markdown', reply_markup=inline_markup)
+                    logger.info("Sent new admin panel message for %s, new message_id: %s", message.chat.id, new_message.message_id)
+            else:
+                new_message = bot.reply_to(message, admin_message, parse_mode='Markdown', reply_markup=inline_markup)
+                logger.info("Sent initial admin panel message for %s, message_id: %s", message.chat.id, new_message.message_id)
 
-        bot.send_message(message.chat.id, admin_options_message, parse_mode='Markdown', reply_markup=get_custom_markup(message.chat.id))
+        outbound.submit(message.chat.id, render_panel, priority=PRIORITY_ADMIN)
+        queue_message(message.chat.id, admin_options_message, parse_mode='Markdown', reply_markup=get_custom_markup(message.chat.id))
 
 # Function to show change payment method keyboard
 def show_change_payment_keyboard(message):
     if str(message.chat.id) == ADMIN_CHAT_ID:
-        pending_subscriptions = {uid: data for uid, data in subscriptions.items() if data.get("status") == "pending"}
-        if not pending_subscriptions:
+        pending_orders = order_repository.find_by_status("pending")
+        if not pending_orders:
             no_pending_message = (
                 "📋 No Pending Purchases 📋\n────\nNo requests are pending to change payment method."
             ) + ATTRACTIVE_TEXT
-            bot.reply_to(message, no_pending_message, parse_mode='Markdown')
-            logger.info(f"Admin {message.chat.id} viewed change payment: No pending subscriptions")
+            queue_reply(message, no_pending_message, parse_mode='Markdown')
+            logger.info("Admin %s viewed change payment: No pending subscriptions", message.chat.id)
             return
 
         custom_markup = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
         custom_markup.row(types.KeyboardButton("🔙 Back to Admin"))
-        for user_id in pending_subscriptions.keys():
+        for user_id in dict.fromkeys(order["user_id"] for _, order in pending_orders):
             custom_markup.row(types.KeyboardButton(f"User {user_id}"))
         custom_markup.row(types.KeyboardButton("🌐 Website"))
         change_payment_message = (
@@ -685,34 +1333,28 @@ def show_change_payment_keyboard(message):
             "1. Choose a User ID from the list.\n"
             "2. Select a new payment method.\n"
         ) + ATTRACTIVE_TEXT
-        bot.reply_to(message, change_payment_message, parse_mode='Markdown', reply_markup=custom_markup)
-        logger.info(f"Admin {message.chat.id} accessed change payment method keyboard")
+        queue_reply(message, change_payment_message, parse_mode='Markdown', reply_markup=custom_markup)
+        logger.info("Admin %s accessed change payment method keyboard", message.chat.id)
 
-# Handler for changing payment method via custom keyboard
-@bot.message_handler(content_types=['text'])
+# Buttons of the change payment keyboard (routed here by handle_text)
 def handle_change_payment(message):
     if str(message.chat.id) == ADMIN_CHAT_ID:
-        if message.text == "🔄 Change Payment Method":
-            show_change_payment_keyboard(message)
-        elif message.text == "🔙 Back to Admin":
+        if message.text == "🔙 Back to Admin":
             show_admin_panel(message, page=1)
         else:
-            pending_subscriptions = {uid: data for uid, data in subscriptions.items() if data.get("status") == "pending"}
             user_id_match = None
-            for uid in pending_subscriptions.keys():
-                if message.text == f"User {uid}":
-                    user_id_match = uid
-                    break
-
-            if user_id_match and user_id_match in subscriptions:
-                bot.send_message(message.chat.id, f"ℹ️ Selected User ID: {user_id_match}\nNow select a payment method.", parse_mode='Markdown')
-                bot.register_next_step_handler(message, process_payment_method, user_id_match)
+            if message.text.startswith("User ") and find_order(message.text[len("User "):], PENDING):
+                user_id_match = message.text[len("User "):]
+
+            if user_id_match:
+                queue_message(message.chat.id, f"ℹ️ Selected User ID: {user_id_match}\nNow select a payment method.", parse_mode='Markdown')
+                conversations.set(message.chat.id, "payment_method", user_id_match)
             elif message.text == "🌐 Website":
                 pass
             else:
                 unrecognized_message = "🤔 Please select a valid user ID or payment method." + ATTRACTIVE_TEXT
-                bot.reply_to(message, unrecognized_message, parse_mode='Markdown')
-                logger.warning(f"Admin {message.chat.id} sent unrecognized change payment input: {message.text}")
+                queue_reply(message, unrecognized_message, parse_mode='Markdown')
+                logger.warning("Admin %s sent unrecognized change payment input: %s", message.chat.id, message.text)
 
 # Process the payment method selection
 def process_payment_method(message, user_id):
@@ -721,32 +1363,118 @@ def process_payment_method(message, user_id):
             "🌐 Website": "Website"
         }
         new_method = method_mapping.get(message.text)
-        if new_method and user_id in subscriptions:
-            old_payment = subscriptions[user_id]["payment"]
-            subscriptions[user_id]["payment"] = f"Payment: {old_payment.split(' via')[0]} via {new_method}"
-            save_subscriptions(subscriptions)
+        transaction_id = find_order(user_id, PENDING) if new_method else None
+        old_payment, record = change_payment_method(transaction_id, new_method) if transaction_id else (None, None)
+        if record is not None:
             user_message = (
                 f"ℹ️ Payment Method Updated\n"
                 f"────\n"
                 f"User ID: {user_id}\n"
                 f"Old Payment: {old_payment}\n"
-                f"New Payment: {subscriptions[user_id]['payment']}\n"
+                f"New Payment: {record['payment']}\n"
                 "👉 Your payment method has been updated by the admin."
             ) + ATTRACTIVE_TEXT
-            bot.send_message(int(user_id), user_message, parse_mode='Markdown')
-            bot.reply_to(message, f"✅ Payment method changed to {new_method} for User ID {user_id}", parse_mode='Markdown')
-            logger.info(f"Admin {message.chat.id} changed payment method to {new_method} for user {user_id}")
+            queue_message(int(user_id), user_message, parse_mode='Markdown')
+            queue_reply(message, f"✅ Payment method changed to {new_method} for User ID {user_id}", parse_mode='Markdown')
+            logger.info("Admin %s changed payment method to %s for user %s", message.chat.id, new_method, user_id)
             show_admin_panel(message, page=1)
         else:
             unrecognized_message = "🤔 Please select a valid payment method." + ATTRACTIVE_TEXT
-            bot.reply_to(message, unrecognized_message, parse_mode='Markdown')
-            logger.warning(f"Admin {message.chat.id} selected invalid payment method: {message.text} for User ID {user_id}")
+            queue_reply(message, unrecognized_message, parse_mode='Markdown')
+            logger.warning("Admin %s selected invalid payment method: %s for User ID %s", message.chat.id, message.text, user_id)
 
-# Start the bot with retry logic
-while True:
-    try:
-        logger.info("Bot started")
-        bot.polling(none_stop=True)
-    except Exception as e:
-        logger.error(f"Bot crashed: {str(e)}")
-        time.sleep(5)
+# Conversation step name -> handler(message, *args); names are what ConversationStore persists
+conversation_steps = {
+    "payment_method": process_payment_method,
+}
+
+# Update intake: long polling (default) or a webhook server
+BOT_MODE = os.getenv('BOT_MODE', 'polling')  # polling or webhook
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # Public base URL Telegram should post updates to
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('PORT', os.getenv('WEBHOOK_PORT', '8443')))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '8'))  # Concurrent update handlers
+WEBHOOK_MAX_PENDING = int(os.getenv('WEBHOOK_MAX_PENDING', '100'))  # Updates queued before requests wait
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9100'))  # 0 disables the /metrics endpoint
+
+# Long polling: the offset and unfinished updates are saved to POLL_OFFSET_FILE and replayed
+# after a restart, failed polls back off exponentially, and SIGTERM stops intake and
+# drains handlers and sends
+POLL_TIMEOUT = int(os.getenv('POLL_TIMEOUT', '25'))  # Seconds Telegram holds an empty getUpdates
+POLL_LIMIT = int(os.getenv('POLL_LIMIT', '100'))  # Updates per getUpdates
+POLL_WORKERS = int(os.getenv('POLL_WORKERS', '8'))  # Concurrent update handlers
+POLL_OFFSET_FILE = os.getenv('POLL_OFFSET_FILE', 'polling_offset.json')
+POLL_BACKOFF_MAX = float(os.getenv('POLL_BACKOFF_MAX', '60'))  # Longest wait between failed polls
+DRAIN_TIMEOUT = float(os.getenv('DRAIN_TIMEOUT', '20'))  # Heroku kills a dyno 30s after SIGTERM
+
+polling_supervisor = PollingSupervisor(
+    bot, offset_path=POLL_OFFSET_FILE, workers=POLL_WORKERS, poll_timeout=POLL_TIMEOUT, limit=POLL_LIMIT,
+    backoff_max=POLL_BACKOFF_MAX, drain_timeout=DRAIN_TIMEOUT, drain=outbound.drain
+)
+metrics.gauge("polling_in_flight", polling_supervisor.in_flight)
+metrics.gauge("polling_failures", lambda: polling_supervisor.failures)
+
+def run_polling():
+    logger.info("Bot started")
+    polling_supervisor.run()
+
+# Start the work only one process may do: resumed broadcasts, expiry jobs, analytics
+# saving and the payment watcher. A follower worker calls this when it wins the leader
+# lock; from then on it also runs the calls other followers send over `channel`
+# (returns the thread doing that, if any).
+def become_leader(channel=None):
+    global BOT_ROLE, leader_channel, analytics, expiry_scheduler
+    if BOT_ROLE == "follower":
+        analytics, expiry_scheduler = leader_services["analytics"], leader_services["expiry_scheduler"]
+        analytics.load()
+        BOT_ROLE, leader_channel = "leader", None
+        logger.info("Worker %s became the leader", os.getenv('BOT_WORKER'))
+    broadcast_manager.resume_all()
+    expiry_scheduler.load(order_repository)
+    expiry_scheduler.start()
+    analytics.start(ANALYTICS_FLUSH_INTERVAL)
+    if PAYMENT_PROVIDER != "none":
+        payment_watcher.start()
+    if channel is not None:
+        return serve_leader_channel(channel, dict(
+            leader_services, queue_message=queue_message, notify_admin_of_payment=notify_admin_of_payment, handle_report=handle_report,
+            handle_broadcast=handle_broadcast, handle_broadcast_cancel=handle_broadcast_cancel
+        ))
+
+leader_services = {}
+
+# Called by workers.py in each worker process once this module is loaded; returns
+# become_leader()'s channel thread on the leader
+def start_worker(channel, leader):
+    global leader_channel, analytics, expiry_scheduler
+    if METRICS_PORT:
+        serve_metrics(metrics, METRICS_HOST, METRICS_PORT)
+    leader_services.update(analytics=analytics, expiry_scheduler=expiry_scheduler)
+    if leader:
+        return become_leader(channel)
+    leader_channel = channel
+    analytics = LeaderProxy(channel, "analytics")
+    expiry_scheduler = LeaderProxy(channel, "expiry_scheduler")
+    return None
+
+if __name__ == "__main__":
+    if BOT_MODE == "webhook" and not WEBHOOK_URL:
+        logger.critical("BOT_MODE=webhook needs WEBHOOK_URL (the public base URL Telegram posts updates to)")
+        raise SystemExit("WEBHOOK_URL is not set")
+    if METRICS_PORT:
+        # /health and /ready report on the poller (polling mode only)
+        checks = {"/health": polling_supervisor.healthy, "/ready": polling_supervisor.ready} if BOT_MODE != "webhook" else None
+        serve_metrics(metrics, METRICS_HOST, METRICS_PORT, checks=checks)
+    become_leader()
+    if BOT_MODE == "webhook":
+        logger.info("Bot started (webhook mode)")
+        run_webhook(
+            bot, WEBHOOK_URL, WEBHOOK_HOST, WEBHOOK_PORT, path=WEBHOOK_PATH,
+            workers=WEBHOOK_WORKERS, max_pending=WEBHOOK_MAX_PENDING, secret_token=WEBHOOK_SECRET,
+            routes={PAYMENT_WEBHOOK_PATH: receive_payment_webhook} if PAYMENT_PROVIDER != "none" else None
+        )
+    else:
+        run_polling()
@@ -0,0 +1,182 @@
+import json
+import os
+import threading
+import time
+import uuid
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+# Persistent state of one broadcast, checkpointed to <directory>/<id>.json.
+# Recipients are streamed in key order. `cursor` is the last key such that every
+# key up to it has been handled. `completed` holds keys past the cursor that
+# finished out of order, so a resume skips them instead of sending twice.
+class Broadcast:
+    def __init__(self, path, state):
+        self.path = path
+        self.state = state
+        self.lock = threading.Lock()
+
+    @property
+    def id(self):
+        return self.state["id"]
+
+    @classmethod
+    def create(cls, directory, text, filters):
+        broadcast_id = uuid.uuid4().hex[:8]
+        state = {
+            "id": broadcast_id, "text": text, "filters": filters, "created_at": time.time(),
+            "cursor": "", "completed": [], "sent": 0, "failed": 0, "skipped": 0,
+            "errors": {}, "done": False, "cancelled": False, "report_message_id": None,
+        }
+        return cls(os.path.join(directory, f"{broadcast_id}.json"), state)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r") as f:
+            return cls(path, json.load(f))
+
+    def save(self):
+        with self.lock:
+            data = json.dumps(self.state)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+
+
+# Runs broadcasts on background threads.
+# At most `window` sends are queued at a time, so a 100k-recipient broadcast never
+# floods the outbound queue and the checkpoint stays close to the real progress.
+#   send(chat_id, text) -> Future             queue one message (low priority lane)
+#   build_filter(filters) -> record predicate
+#   report(broadcast, rate, final)            progress callback for the admin chat
+class BroadcastManager:
+    def __init__(self, repository, directory, send, build_filter, report, window=200, report_interval=5, checkpoint_interval=2):
+        self.repository = repository
+        self.directory = directory
+        self.send = send
+        self.build_filter = build_filter
+        self.report = report
+        self.window = window
+        self.report_interval = report_interval
+        self.checkpoint_interval = checkpoint_interval
+        self.active = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def start(self, text, filters):
+        broadcast = Broadcast.create(self.directory, text, filters)
+        broadcast.save()
+        self._launch(broadcast)
+        return broadcast
+
+    # Restart every broadcast that had not finished when the bot stopped
+    def resume_all(self):
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(".json"):
+                continue
+            try:
+                broadcast = Broadcast.load(os.path.join(self.directory, name))
+            except (OSError, ValueError) as e:
+                logger.error("Unreadable broadcast checkpoint %s: %s", name, e)
+                continue
+            if not broadcast.state["done"] and broadcast.id not in self.active:
+                logger.info("Resuming broadcast %s after %r", broadcast.id, broadcast.state['cursor'])
+                self._launch(broadcast)
+
+    def cancel(self, broadcast_id):
+        broadcast = self.active.get(broadcast_id)
+        if broadcast is None:
+            return False
+        broadcast.state["cancelled"] = True
+        return True
+
+    def _launch(self, broadcast):
+        self.active[broadcast.id] = broadcast
+        threading.Thread(target=self._run, args=(broadcast,), name=f"broadcast-{broadcast.id}", daemon=True).start()
+
+    def _run(self, broadcast):
+        state = broadcast.state
+        matches = self.build_filter(state["filters"])
+        completed = set(state["completed"])
+        order = deque()
+        in_flight = threading.Semaphore(self.window)
+        idle = threading.Condition()
+        outstanding = [0]
+        started = time.monotonic()
+        sent_at_start = state["sent"] + state["failed"]
+        last_report = started
+        last_checkpoint = 0
+
+        # Advance the cursor over the finished prefix; caller holds broadcast.lock
+        def advance():
+            while order and order[0] in completed:
+                state["cursor"] = order.popleft()
+                completed.discard(state["cursor"])
+            state["completed"] = list(completed)
+
+        def finished(key, future):
+            error = future.exception()
+            with broadcast.lock:
+                if error is None:
+                    state["sent"] += 1
+                else:
+                    state["failed"] += 1
+                    code = str(getattr(error, "error_code", type(error).__name__))
+                    state["errors"][code] = state["errors"].get(code, 0) + 1
+                completed.add(key)
+                advance()
+            in_flight.release()
+            with idle:
+                outstanding[0] -= 1
+                idle.notify_all()
+
+        def tick(final=False):
+            nonlocal last_report, last_checkpoint
+            now = time.monotonic()
+            if final or now - last_checkpoint >= self.checkpoint_interval:
+                broadcast.save()
+                last_checkpoint = now
+            if final or now - last_report >= self.report_interval:
+                rate = (state["sent"] + state["failed"] - sent_at_start) / max(now - started, 0.001)
+                try:
+                    self.report(broadcast, rate, final)
+                except Exception as e:
+                    logger.warning("Broadcast %s progress report failed: %s", broadcast.id, e)
+                last_report = now
+
+        try:
+            for key, record in self.repository.iter_after(state["cursor"]):
+                if state["cancelled"]:
+                    break
+                with broadcast.lock:
+                    order.append(key)
+                    if key in completed:
+                        advance()
+                        continue
+                    if not matches(record):
+                        state["skipped"] += 1
+                        completed.add(key)
+                        advance()
+                        continue
+                while not in_flight.acquire(timeout=1):
+                    tick()
+                with idle:
+                    outstanding[0] += 1
+                self.send(key, state["text"]).add_done_callback(lambda future, key=key: finished(key, future))
+                tick()
+            while True:
+                with idle:
+                    if not outstanding[0]:
+                        break
+                    idle.wait(1)
+                tick()
+            state["done"] = True
+        except Exception as e:
+            logger.error("Broadcast %s stopped: %s", broadcast.id, e)
+        finally:
+            tick(final=True)
+            self.active.pop(broadcast.id, None)
+        logger.info("Broadcast %s finished: %s sent, %s failed, %s skipped", broadcast.id, state['sent'], state['failed'], state['skipped'])
@@ -0,0 +1,75 @@
+import json
+import os
+import threading
+import time
+import logging
+
+from telebot import types
+
+logger = logging.getLogger(__name__)
+
+
+# One loaded version of catalog.json: product families, their items, and the
+# inline keyboards built from them. Instances are never mutated, so handlers can
+# keep using one while a reload swaps in the next.
+class Catalog:
+    def __init__(self, data):
+        self.families = {}
+        self.items = {}
+        self.item_family = {}
+        for family in data["families"]:
+            self.families[family["id"]] = family
+            for item in family["items"]:
+                self.items[item["id"]] = item
+                self.item_family[item["id"]] = family
+        self.shop_markup = self._build_shop_markup()
+        self.family_markups = {family_id: self._build_family_markup(family) for family_id, family in self.families.items()}
+
+    def _build_shop_markup(self):
+        inline_markup = types.InlineKeyboardMarkup()
+        buttons = [types.InlineKeyboardButton(family["button"], callback_data=family["id"]) for family in self.families.values()]
+        buttons.append(types.InlineKeyboardButton("🔙 Back", callback_data="back_inline"))
+        for i in range(0, len(buttons), 2):
+            inline_markup.row(*buttons[i:i + 2])
+        return inline_markup
+
+    def _build_family_markup(self, family):
+        inline_markup = types.InlineKeyboardMarkup()
+        buttons = [types.InlineKeyboardButton(item["button"], callback_data=item["id"]) for item in family["items"]]
+        for i in range(0, len(buttons), 2):
+            inline_markup.row(*buttons[i:i + 2])
+        inline_markup.row(types.InlineKeyboardButton("🔙 Back to Shop", callback_data="back_to_shop"))
+        return inline_markup
+
+
+# Holds the current Catalog and reloads it when catalog.json changes on disk.
+# The file is stat'ed at most once per `check_interval` seconds; a broken edit
+# is logged and the previous catalog stays live.
+class CatalogLoader:
+    def __init__(self, path, check_interval=5):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._mtime = os.stat(path).st_mtime
+        self._checked_at = time.monotonic()
+        self._catalog = self._load()
+
+    def get(self):
+        now = time.monotonic()
+        if now - self._checked_at >= self.check_interval and self._lock.acquire(blocking=False):
+            try:
+                self._checked_at = now
+                mtime = os.stat(self.path).st_mtime
+                if mtime != self._mtime:
+                    self._catalog = self._load()
+                    self._mtime = mtime
+                    logger.info("Reloaded catalog from %s", self.path)
+            except Exception as e:
+                logger.error("Failed to reload catalog from %s: %s", self.path, e)
+            finally:
+                self._lock.release()
+        return self._catalog
+
+    def _load(self):
+        with open(self.path, "r", encoding="utf-8") as f:
+            return Catalog(json.load(f))
@@ -0,0 +1,77 @@
+import threading
+import logging
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+
+# Multi-step chat flows ("pick a user, then a payment method"): each chat has at most
+# one pending step, stored as {"step", "args", "expires_at"} in a repository (see
+# storage.py) so flows survive restarts and, on SQL backends, are shared by worker
+# processes. Steps expire `ttl` seconds after they are set, and only the `capacity`
+# most recently set are kept; older ones are dropped, so abandoned flows never pile up.
+# Which chats have a step is also tracked in memory, so messages from chats without
+# one never touch the store. That view covers steps set by this process and those
+# loaded at startup, which is every step of its chats when chats stick to one worker.
+class ConversationStore:
+    def __init__(self, repository, ttl=900, capacity=10000):
+        self.repository = repository
+        self.ttl = ttl
+        self.capacity = capacity
+        self._expiry = OrderedDict()  # chat ID -> expires_at, oldest first
+        self._lock = threading.Lock()
+
+    def load(self):
+        now = str(datetime.now())
+        steps = sorted((record["expires_at"], key) for key, record in self.repository.iter_after(""))
+        with self._lock:
+            for expires_at, key in steps:
+                self._expiry[key] = expires_at
+        self._evict(now)
+        logger.info("Loaded %s conversation steps", len(self._expiry))
+
+    # Wait for `step` with `args` (JSON values) as this chat's next message
+    def set(self, chat_id, step, *args):
+        key = str(chat_id)
+        now = datetime.now()
+        expires_at = str(now + timedelta(seconds=self.ttl))
+        self.repository.put(key, {"step": step, "args": list(args), "expires_at": expires_at})
+        with self._lock:
+            self._expiry[key] = expires_at
+            self._expiry.move_to_end(key)
+        self._evict(str(now))
+
+    def active(self, chat_id):
+        expires_at = self._expiry.get(str(chat_id))
+        return expires_at is not None and expires_at > str(datetime.now())
+
+    # The chat's pending (step, args), removed, or None if it has none or it expired
+    def pop(self, chat_id):
+        key = str(chat_id)
+        with self._lock:
+            expires_at = self._expiry.pop(key, None)
+        if expires_at is None:
+            return None
+        record = self.repository.get(key)
+        self.repository.delete(key)
+        if record is None or record["expires_at"] <= str(datetime.now()):
+            return None
+        return record["step"], record["args"]
+
+    # Drop expired steps and the least recently set ones beyond `capacity`. Steps share
+    # one TTL, so the oldest set is always the first to expire.
+    def _evict(self, now):
+        evicted = []
+        with self._lock:
+            while self._expiry:
+                key, expires_at = next(iter(self._expiry.items()))
+                if expires_at > now and len(self._expiry) <= self.capacity:
+                    break
+                self._expiry.popitem(last=False)
+                evicted.append(key)
+        for key in evicted:
+            self.repository.delete(key)
+
+    def __len__(self):
+        return len(self._expiry)
@@ -0,0 +1,110 @@
+import csv
+import gzip
+import io
+import json
+import os
+
+# Bot API uploads are capped at 50 MB; leave headroom for data still buffered when a part is cut
+MAX_PART_BYTES = 45 * 1024 * 1024
+
+EXPORT_FIELDS = ("user_id", "transaction_id", "plan", "payment", "status", "timestamp")
+EXPORT_FORMATS = ("txt", "csv", "jsonl")
+
+
+# Writes export rows straight to disk, starting a new part file whenever the
+# current one reaches `max_part_bytes` (measured on the file as written, i.e.
+# after compression).
+class ExportWriter:
+    def __init__(self, directory, fmt="txt", compress=False, max_part_bytes=MAX_PART_BYTES, basename="user_data"):
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError(f"Unknown export format: {fmt}")
+        self.directory = directory
+        self.fmt = fmt
+        self.compress = compress
+        self.max_part_bytes = max_part_bytes
+        self.basename = basename
+        self.parts = []
+        self.rows = 0
+        self._raw = None
+        self._text = None
+        self._csv = None
+
+    def _open_part(self):
+        suffix = f".{self.fmt}" + (".gz" if self.compress else "")
+        path = os.path.join(self.directory, f"{self.basename}.part{len(self.parts) + 1}{suffix}")
+        self._raw = open(path, "wb")
+        stream = gzip.GzipFile(fileobj=self._raw, mode="wb") if self.compress else self._raw
+        self._text = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+        self.parts.append(path)
+        if self.fmt == "csv":
+            self._csv = csv.writer(self._text)
+            self._csv.writerow(EXPORT_FIELDS)
+        elif self.fmt == "txt":
+            self._text.write("User Data with Payment Details:\n\n")
+
+    def _close_part(self):
+        if self._text:
+            self._text.close()
+            self._raw.close()
+            self._text = None
+
+    def write(self, user_id, record):
+        if self._text is None:
+            self._open_part()
+        row = {"user_id": user_id}
+        row.update((field, record.get(field)) for field in EXPORT_FIELDS[1:])
+        if self.fmt == "csv":
+            self._csv.writerow([row[field] if row[field] is not None else "" for field in EXPORT_FIELDS])
+        elif self.fmt == "jsonl":
+            self._text.write(json.dumps(row) + "\n")
+        else:
+            self._text.write(
+                f"User ID: {user_id}\n"
+                f"Transaction ID: {record.get('transaction_id', 'N/A')}\n"
+                f"Plan: {record.get('plan', 'N/A')}\n"
+                f"Payment: {record.get('payment', 'N/A')}\n"
+                f"Status: {record.get('status', 'N/A')}\n"
+                f"Timestamp: {record.get('timestamp', 'N/A')}\n"
+                "────\n"
+            )
+        self.rows += 1
+        # raw.tell() trails by at most the text buffer and zlib's pending block
+        if self._raw.tell() >= self.max_part_bytes:
+            self._close_part()
+
+    def close(self):
+        if not self.parts:
+            self._open_part()
+        self._close_part()
+        return self.parts
+
+
+# Build a record predicate from export filters: status (comma list), from/to (YYYY-MM-DD, inclusive)
+def build_export_filter(filters):
+    statuses = set(filters["status"].split(",")) if filters.get("status") else None
+    date_from = filters.get("from")
+    date_to = filters.get("to")
+
+    def matches(record):
+        if statuses and record.get("status") not in statuses:
+            return False
+        day = (record.get("timestamp") or "")[:10]
+        if date_from and day < date_from:
+            return False
+        if date_to and day > date_to:
+            return False
+        return True
+    return matches
+
+
+# Stream `records` (an iterable of (user_id, record)) into part files under `directory`
+def export_records(records, directory, fmt="txt", compress=False, filters=None, max_part_bytes=MAX_PART_BYTES):
+    matches = build_export_filter(filters or {})
+    writer = ExportWriter(directory, fmt=fmt, compress=compress, max_part_bytes=max_part_bytes)
+    try:
+        for user_id, record in records:
+            if matches(record):
+                writer.write(user_id, record)
+    finally:
+        parts = writer.close()
+    return parts, writer.rows
@@ -0,0 +1,235 @@
+import argparse
+import itertools
+import json
+import re
+import threading
+import time
+import logging
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+logger = logging.getLogger(__name__)
+
+ADMIN_CHAT_ID = 7944149645
+FIRST_USER_ID = 100000000
+
+# Methods whose result is a Message
+MESSAGE_METHODS = {"sendMessage", "sendPhoto", "sendSticker", "sendDocument", "editMessageText", "editMessageReplyMarkup"}
+
+
+# Local stand-in for the Telegram Bot API, for benchmarks and replays.
+# Serves queued updates through getUpdates (honouring offset, limit and the
+# long-poll timeout), answers every other method with a plausible result, and
+# records each outgoing call as (monotonic time, method, params).
+# Point the bot at it with TELEGRAM_API_URL=http://host:port
+class FakeTelegramAPI:
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0):
+        self.latency = latency
+        self.calls = []
+        self.method_counts = Counter()
+        self._updates = deque()
+        self._next_update_id = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._cond = threading.Condition()
+        # Set on the first getUpdates, i.e. once a bot is up and polling
+        self.polled = threading.Event()
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name="fake-telegram-api", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    # Queue raw update dicts; update_ids are assigned here when missing. Returns the count queued.
+    def push_updates(self, updates):
+        count = 0
+        with self._cond:
+            for update in updates:
+                update.setdefault("update_id", next(self._next_update_id))
+                self._updates.append(update)
+                count += 1
+            self._cond.notify_all()
+        return count
+
+    def pending_updates(self):
+        return len(self._updates)
+
+    def reset_calls(self):
+        with self._cond:
+            self.calls = []
+            self.method_counts = Counter()
+
+    def _get_updates(self, params):
+        offset = int(params.get("offset", 0))
+        limit = int(params.get("limit", 100))
+        timeout = float(params.get("timeout", 0))
+        deadline = time.monotonic() + timeout
+        self.polled.set()
+        with self._cond:
+            while self._updates and self._updates[0]["update_id"] < offset:
+                self._updates.popleft()
+            while not self._updates:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                self._cond.wait(remaining)
+            return list(itertools.islice(self._updates, limit))
+
+    def _result(self, method, params):
+        if method == "getUpdates":
+            return self._get_updates(params)
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot"}
+        if method not in MESSAGE_METHODS:
+            return True
+        chat_id = int(params.get("chat_id") or 0)
+        message = {
+            "message_id": int(params.get("message_id") or next(self._message_ids)),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+        }
+        file_id = params.get("photo") or params.get("sticker") or params.get("document") or f"FAKE_{method}_{message['message_id']}"
+        if method == "sendPhoto":
+            message["photo"] = [{"file_id": file_id, "file_unique_id": "photo", "width": 512, "height": 512}]
+        elif method == "sendSticker":
+            message["sticker"] = {
+                "file_id": file_id, "file_unique_id": "sticker", "type": "regular",
+                "width": 512, "height": 512, "is_animated": False, "is_video": False
+            }
+        elif method == "sendDocument":
+            message["document"] = {"file_id": file_id, "file_unique_id": "document"}
+        else:
+            message["text"] = params.get("text", "")
+        return message
+
+    def _handler_class(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def _handle(self):
+                url = urlsplit(self.path)
+                match = re.fullmatch(r"/bot[^/]+/(\w+)", url.path)
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                if not match:
+                    self._reply(404, {"ok": False, "error_code": 404, "description": "Not Found"})
+                    return
+                method = match.group(1)
+                params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+                if body and self.headers.get("Content-Type", "").startswith("application/x-www-form-urlencoded"):
+                    params.update({key: values[-1] for key, values in parse_qs(body.decode("utf-8")).items()})
+                if method != "getUpdates":
+                    if api.latency:
+                        time.sleep(api.latency)
+                    with api._cond:
+                        api.calls.append((time.monotonic(), method, params))
+                        api.method_counts[method] += 1
+                self._reply(200, {"ok": True, "result": api._result(method, params)})
+
+            do_GET = _handle
+            do_POST = _handle
+
+            def _reply(self, status, payload):
+                body = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                try:
+                    self.end_headers()
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The bot went away mid long-poll (end of a benchmark run)
+                    self.close_connection = True
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def message_update(chat_id, text):
+    user = {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"}
+    return {"message": {
+        "message_id": 1, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}, "from": user, "text": text,
+        **({"entities": [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]} if text.startswith("/") else {})
+    }}
+
+
+_callback_query_ids = itertools.count(1)
+
+
+def callback_update(chat_id, data, query_id=None):
+    user = {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"}
+    return {"callback_query": {
+        "id": str(query_id or next(_callback_query_ids)), "chat_instance": str(chat_id), "data": data, "from": user,
+        "message": {"message_id": 1, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}, "text": "menu"}
+    }}
+
+
+# One purchase session per user: /start, Store, Our Shop, a plan, Pay via Website,
+# then the admin approving (or every third one rejecting) it. Every tenth user is
+# followed by the admin opening the panel and paging.
+def synthetic_session(chat_id, family_id, item_id, admin_chat_id=ADMIN_CHAT_ID):
+    yield message_update(chat_id, "/start")
+    yield message_update(chat_id, "🛒 Store")
+    yield callback_update(chat_id, "our_shop")
+    yield callback_update(chat_id, family_id)
+    yield callback_update(chat_id, item_id)
+    yield callback_update(chat_id, f"pay_website_{chat_id}")
+    action = "reject" if chat_id % 3 == 0 else "activate"
+    yield callback_update(admin_chat_id, f"{action}_{chat_id}")
+    if chat_id % 10 == 0:
+        yield message_update(admin_chat_id, "🛠️ Admin")
+        yield callback_update(admin_chat_id, "page_2")
+
+
+def synthetic_updates(users, catalog, first_user_id=FIRST_USER_ID, admin_chat_id=ADMIN_CHAT_ID):
+    # Plans cycle through every catalog item
+    items = [(family["id"], item["id"]) for family in catalog["families"] for item in family["items"]]
+    for i in range(users):
+        family_id, item_id = items[i % len(items)]
+        yield from synthetic_session(first_user_id + i, family_id, item_id, admin_chat_id)
+
+
+# python fake_telegram_api.py --port 8081 --users 100
+# then run the bot with TELEGRAM_API_URL=http://127.0.0.1:8081
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Telegram Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--users", type=int, default=100, help="synthetic purchase sessions to queue")
+    parser.add_argument("--catalog", default="catalog.json")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every non-getUpdates call")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    with open(args.catalog, "r", encoding="utf-8") as f:
+        catalog = json.load(f)
+    api = FakeTelegramAPI(args.host, args.port, latency=args.latency).start()
+    queued = api.push_updates(synthetic_updates(args.users, catalog))
+    logger.info("Fake Bot API on %s with %s queued updates", api.url, queued)
+    try:
+        while True:
+            time.sleep(5)
+            logger.info("Pending updates: %s, calls: %s", api.pending_updates(), dict(api.method_counts))
+    except KeyboardInterrupt:
+        api.stop()
+
+
+if __name__ == "__main__":
+    main()
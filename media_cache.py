@@ -0,0 +1,66 @@
+import hashlib
+import json
+import os
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# Persistent map of local media file -> Telegram file_id.
+# Entries carry the file's sha256, so editing the image invalidates its file_id.
+# The hash is only recomputed when the file's size or mtime changes.
+class MediaCache:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path, "r") as f:
+                self._entries = json.load(f)
+        except FileNotFoundError:
+            self._entries = {}
+
+    # Return the cached file_id for `media_path`, or None if it must be uploaded
+    def lookup(self, media_path):
+        stat = os.stat(media_path)
+        with self._lock:
+            entry = self._entries.get(media_path)
+        if not entry:
+            return None
+        if entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            return entry["file_id"]
+        if entry["sha256"] != self._hash(media_path):
+            logger.info("Media file %s changed; cached file_id invalidated", media_path)
+            self.forget(media_path)
+            return None
+        # Touched but identical content: keep the file_id, remember the new stat
+        with self._lock:
+            entry.update(size=stat.st_size, mtime=stat.st_mtime)
+            self._save()
+        return entry["file_id"]
+
+    def store(self, media_path, file_id):
+        stat = os.stat(media_path)
+        entry = {"file_id": file_id, "sha256": self._hash(media_path), "size": stat.st_size, "mtime": stat.st_mtime}
+        with self._lock:
+            self._entries[media_path] = entry
+            self._save()
+
+    def forget(self, media_path):
+        with self._lock:
+            if self._entries.pop(media_path, None) is not None:
+                self._save()
+
+    @staticmethod
+    def _hash(media_path):
+        digest = hashlib.sha256()
+        with open(media_path, "rb") as f:
+            for chunk in iter(lambda: f.read(65536), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._entries, f, indent=4)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,220 @@
+import bisect
+import functools
+import json
+import threading
+import time
+import logging
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telebot import apihelper
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds (upper bounds; +Inf is implicit)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class _Histogram:
+    __slots__ = ("counts", "sum", "count", "max")
+
+    def __init__(self, buckets):
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+
+# In-process metrics in the Prometheus text format.
+# Counters and histograms are keyed by (name, labels); gauges are callables read at
+# scrape time, so values like queue depth cost nothing until someone looks.
+class Metrics:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.started = time.time()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram(self.buckets)
+            histogram.counts[index] += 1
+            histogram.sum += seconds
+            histogram.count += 1
+            histogram.max = max(histogram.max, seconds)
+
+    def gauge(self, name, read):
+        self._gauges[name] = read
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    # Decorator: time every call into a `<name>_seconds` histogram and count exceptions in `<name>_errors_total`
+    def timed(self, name, **labels):
+        def decorate(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                except Exception:
+                    self.inc(f"{name}_errors_total", **labels)
+                    raise
+                finally:
+                    self.observe(f"{name}_seconds", time.perf_counter() - started, **labels)
+            return wrapper
+        return decorate
+
+    def counter_value(self, name, **labels):
+        return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    # Snapshot of one histogram family: {labels: (count, sum, max, p50, p99)}
+    def histogram_summary(self, name):
+        with self._lock:
+            series = {labels: (h.count, h.sum, h.max, list(h.counts)) for (n, labels), h in self._histograms.items() if n == name}
+        return {
+            labels: (count, total, peak, self._quantile(counts, 0.5, peak), self._quantile(counts, 0.99, peak))
+            for labels, (count, total, peak, counts) in series.items()
+        }
+
+    def counters(self, name):
+        with self._lock:
+            return {labels: value for (n, labels), value in self._counters.items() if n == name}
+
+    def read_gauges(self):
+        values = {}
+        for name, read in self._gauges.items():
+            try:
+                values[name] = read()
+            except Exception as e:
+                logger.warning("Gauge %s failed: %s", name, e)
+        return values
+
+    # Estimate a quantile as the upper bound of the bucket holding it (the observed max for +Inf)
+    def _quantile(self, counts, q, peak):
+        total = sum(counts)
+        if not total:
+            return 0.0
+        rank = q * total
+        seen = 0
+        for bound, count in zip(self.buckets, counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, peak)
+        return peak
+
+    def render(self):
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, (list(h.counts), h.sum, h.count)) for key, h in self._histograms.items())
+        emitted = set()
+
+        def header(name, kind):
+            if name not in emitted:
+                emitted.add(name)
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in counters:
+            header(name, "counter")
+            lines.append(f"{name}{_labels(labels)} {value}")
+        for (name, labels), (counts, total, count) in histograms:
+            header(name, "histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{_labels(labels)} {total}")
+            lines.append(f"{name}_count{_labels(labels)} {count}")
+        for name, value in sorted(self.read_gauges().items()):
+            header(name, "gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+# Time every Bot API request and count failures by Telegram error code.
+# apihelper looks _make_request up as a module global on each call, so replacing
+# it covers every bot method (send_message, send_photo, answer_callback_query, ...).
+def instrument_telegram_api(metrics):
+    make_request = apihelper._make_request
+
+    @functools.wraps(make_request)
+    def timed_request(token, method_name, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return make_request(token, method_name, *args, **kwargs)
+        except apihelper.ApiTelegramException as e:
+            metrics.inc("telegram_api_errors_total", method=method_name, code=str(e.error_code))
+            raise
+        except Exception as e:
+            metrics.inc("telegram_api_errors_total", method=method_name, code=type(e).__name__)
+            raise
+        finally:
+            metrics.observe("telegram_api_seconds", time.perf_counter() - started, method=method_name)
+
+    apihelper._make_request = timed_request
+
+
+# Serve GET /metrics on a background thread (stdlib only)
+# `checks` maps extra paths (e.g. /health, /ready) to fn() -> (ok, status dict), served
+# as JSON with 200 or 503
+def serve_metrics(metrics, host="127.0.0.1", port=9100, checks=None):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split("?")[0]
+            if checks and path in checks:
+                ok, status = checks[path]()
+                body = json.dumps(status).encode("utf-8")
+                self.send_response(200 if ok else 503)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+            if path != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    logger.info("Serving metrics on http://%s:%s/metrics", host, port)
+    return server
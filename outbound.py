@@ -0,0 +1,227 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+import logging
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+import requests
+from telebot.apihelper import ApiTelegramException
+
+logger = logging.getLogger(__name__)
+
+# Priority lanes: lower drains first
+PRIORITY_ADMIN = 0
+PRIORITY_USER = 1
+PRIORITY_BULK = 2
+
+
+# Errors the dispatcher retries (429, 5xx, network); jobs that catch exceptions
+# themselves re-raise these so the retry still happens
+def is_retryable(error):
+    if isinstance(error, ApiTelegramException):
+        return error.error_code == 429 or error.error_code >= 500
+    return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+
+# Token bucket: `rate` tokens per second, holding at most `capacity`
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    # Take a token and return 0, or return the seconds until one is available
+    def take(self):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+
+class _Job:
+    __slots__ = ("fn", "args", "kwargs", "priority", "future", "attempts")
+
+    def __init__(self, fn, args, kwargs, priority):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.future = Future()
+        self.attempts = 0
+
+
+# Background sender for Bot API calls.
+# Jobs are queued per chat and always run in submission order for that chat.
+# Chats with work wait in a ready heap ordered by the priority of their next job,
+# so admin notifications overtake user replies and broadcasts. A chat that is out
+# of tokens (per-chat bucket) or told to back off (429) is parked on a timer heap
+# instead of holding a worker thread. 429s honour retry_after; 5xx and network
+# errors retry with jittered exponential backoff.
+class OutboundDispatcher:
+    def __init__(self, workers=8, global_rate=30, chat_rate=1, chat_burst=3, max_attempts=5, max_batch=3, max_chat_buckets=10000):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_attempts = max_attempts
+        self.max_batch = max_batch
+        self.max_chat_buckets = max_chat_buckets
+        self._chat_buckets = OrderedDict()
+        self._queues = {}
+        self._ready = []
+        self._delayed = []
+        self._seq = itertools.count()
+        self._pending = 0
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._threads = [
+            threading.Thread(target=self._worker, name=f"outbound-{i}", daemon=True) for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    # Queue fn(*args, **kwargs) for `chat_id`; returns a Future with its result
+    def submit(self, chat_id, fn, /, *args, priority=PRIORITY_USER, **kwargs):
+        job = _Job(fn, args, kwargs, priority)
+        key = str(chat_id)
+        with self._cond:
+            queue = self._queues.get(key)
+            if queue is None:
+                queue = self._queues[key] = deque()
+                heapq.heappush(self._ready, (priority, next(self._seq), key))
+            queue.append(job)
+            self._pending += 1
+            self._cond.notify()
+        return job.future
+
+    # Jobs queued or in flight
+    def depth(self):
+        return self._pending
+
+    # Block until every queued job has finished (or `timeout` seconds pass)
+    def drain(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._pending:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def stop(self, timeout=None):
+        self.drain(timeout)
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+
+    def _chat_bucket(self, key):
+        bucket = self._chat_buckets.get(key)
+        if bucket is None:
+            bucket = self._chat_buckets[key] = TokenBucket(self.chat_rate, self.chat_burst)
+            if len(self._chat_buckets) > self.max_chat_buckets:
+                self._chat_buckets.popitem(last=False)
+        else:
+            self._chat_buckets.move_to_end(key)
+        return bucket
+
+    # Called with the lock held: move parked chats whose delay has passed back to the ready heap
+    def _release_delayed(self):
+        now = time.monotonic()
+        while self._delayed and self._delayed[0][0] <= now:
+            _, priority, key = heapq.heappop(self._delayed)
+            heapq.heappush(self._ready, (priority, next(self._seq), key))
+
+    def _next_chat(self):
+        with self._cond:
+            while True:
+                if self._stopping:
+                    return None
+                self._release_delayed()
+                if self._ready:
+                    return heapq.heappop(self._ready)[2]
+                timeout = self._delayed[0][0] - time.monotonic() if self._delayed else None
+                self._cond.wait(timeout)
+
+    # Called with the lock held: hand the chat back to the heaps, or forget it once drained
+    def _requeue(self, key, delay=0):
+        queue = self._queues[key]
+        if not queue:
+            del self._queues[key]
+        elif delay > 0:
+            heapq.heappush(self._delayed, (time.monotonic() + delay, queue[0].priority, key))
+        else:
+            heapq.heappush(self._ready, (queue[0].priority, next(self._seq), key))
+        self._cond.notify()
+
+    def _worker(self):
+        while True:
+            key = self._next_chat()
+            if key is None:
+                return
+            delay = 0
+            # Drain a short batch for this chat while its bucket allows
+            for _ in range(self.max_batch):
+                with self._cond:
+                    queue = self._queues[key]
+                    if not queue:
+                        break
+                    job = queue[0]
+                delay = self._chat_bucket(key).take()
+                if delay:
+                    break
+                wait = self.global_bucket.take()
+                while wait:
+                    time.sleep(wait)
+                    wait = self.global_bucket.take()
+                delay = self._run(job)
+                if delay:
+                    break
+                with self._cond:
+                    queue.popleft()
+                    self._pending -= 1
+                    self._cond.notify_all()
+            with self._cond:
+                self._requeue(key, delay)
+
+    # Execute one job; returns a retry delay, or 0 once the job is finished either way
+    def _run(self, job):
+        job.attempts += 1
+        try:
+            result = job.fn(*job.args, **job.kwargs)
+        except ApiTelegramException as e:
+            if e.error_code == 429:
+                retry_after = (e.result_json or {}).get("parameters", {}).get("retry_after", 1)
+                return self._retry(job, e, retry_after)
+            if e.error_code >= 500:
+                return self._retry(job, e, self._backoff(job))
+            self._fail(job, e)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            return self._retry(job, e, self._backoff(job))
+        except Exception as e:
+            self._fail(job, e)
+        else:
+            job.future.set_result(result)
+        return 0
+
+    def _retry(self, job, error, delay):
+        if job.attempts >= self.max_attempts:
+            self._fail(job, error)
+            return 0
+        logger.warning("Outbound %s failed (attempt %s), retrying in %.1fs: %s", getattr(job.fn, '__name__', job.fn), job.attempts, delay, error)
+        return delay
+
+    def _backoff(self, job):
+        return min(30, 2 ** (job.attempts - 1)) * random.uniform(0.5, 1.5)
+
+    def _fail(self, job, error):
+        logger.error("Outbound %s failed after %s attempt(s): %s", getattr(job.fn, '__name__', job.fn), job.attempts, error)
+        job.future.set_exception(error)
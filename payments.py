@@ -0,0 +1,240 @@
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+import logging
+from collections import deque
+from datetime import datetime
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+class Payment:
+    __slots__ = ("transaction_id", "amount", "currency", "provider_id", "provider")
+
+    def __init__(self, transaction_id, amount, currency, provider_id, provider):
+        self.transaction_id = transaction_id
+        self.amount = amount
+        self.currency = currency
+        self.provider_id = provider_id
+        self.provider = provider
+
+    def __repr__(self):
+        return f"Payment({self.provider}:{self.provider_id} {self.amount} {self.currency} for {self.transaction_id})"
+
+
+# Payment providers turn a pending request into a checkout link and report
+# confirmed payments, each carrying the transaction_id it was created for.
+#   create_checkout(transaction_id, user_id, plan, amount) -> URL, or None for the static website link
+#   poll(since) -> confirmed payments for requests created at or after `since` (epoch seconds)
+#   parse_webhook(body, headers) -> confirmed payments from a push notification (raises ValueError if not authentic)
+class PaymentProvider:
+    name = "none"
+
+    def create_checkout(self, transaction_id, user_id, plan, amount):
+        return None
+
+    def poll(self, since):
+        return []
+
+    def parse_webhook(self, body, headers):
+        raise ValueError(f"{self.name} provider does not accept webhooks")
+
+
+# Local provider for tests and staging. Payments are confirmed either in code
+# (pay()) or by appending {"transaction_id": ..., "amount": ...} lines to `inbox_path`,
+# which each poll reads from where the previous one stopped.
+class MockPaymentProvider(PaymentProvider):
+    name = "mock"
+
+    def __init__(self, inbox_path=None, checkout_url="https://pay.example.invalid/checkout/"):
+        self.inbox_path = inbox_path
+        self.checkout_url = checkout_url
+        self._inbox_offset = 0
+        self._payments = deque()
+        self._lock = threading.Lock()
+
+    def create_checkout(self, transaction_id, user_id, plan, amount):
+        return self.checkout_url + transaction_id
+
+    def pay(self, transaction_id, amount, currency="USD"):
+        with self._lock:
+            self._payments.append(Payment(transaction_id, amount, currency, f"mock-{len(self._payments) + 1}", self.name))
+
+    def poll(self, since):
+        if self.inbox_path and os.path.exists(self.inbox_path):
+            with open(self.inbox_path, "r", encoding="utf-8") as f:
+                f.seek(self._inbox_offset)
+                for line in iter(f.readline, ""):
+                    if not line.endswith("\n"):
+                        break
+                    self._inbox_offset = f.tell()
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.pay(entry["transaction_id"], float(entry["amount"]), entry.get("currency", "USD"))
+        with self._lock:
+            payments = list(self._payments)
+            self._payments.clear()
+        return payments
+
+    def parse_webhook(self, body, headers):
+        entry = json.loads(body)
+        return [Payment(entry["transaction_id"], float(entry["amount"]), entry.get("currency", "USD"), entry.get("id", "mock-webhook"), self.name)]
+
+
+# Coinbase Commerce: one charge per payment request (BTC, ETH, USDT, SOL and the
+# other supported coins are settled by Coinbase), with our transaction_id in the
+# charge metadata. poll() pages through recent charges newest first and stops at
+# the first page older than `since`; webhooks are verified with the shared secret.
+class CoinbaseCommerceProvider(PaymentProvider):
+    name = "coinbase"
+    api_url = "https://api.commerce.coinbase.com"
+    confirmed_statuses = ("COMPLETED", "CONFIRMED", "RESOLVED")
+    confirmed_events = ("charge:confirmed", "charge:resolved")
+
+    def __init__(self, api_key, webhook_secret=None, page_size=100, timeout=15):
+        if not api_key:
+            raise RuntimeError("The coinbase payment provider requires COINBASE_API_KEY")
+        self.webhook_secret = webhook_secret
+        self.page_size = page_size
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update({"X-CC-Api-Key": api_key, "X-CC-Version": "2018-03-22"})
+
+    def create_checkout(self, transaction_id, user_id, plan, amount):
+        response = self.session.post(f"{self.api_url}/charges", json={
+            "name": plan[:100],
+            "description": f"Order {transaction_id}",
+            "pricing_type": "fixed_price",
+            "local_price": {"amount": f"{amount:.2f}", "currency": "USD"},
+            "metadata": {"transaction_id": transaction_id, "user_id": user_id},
+        }, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()["data"]["hosted_url"]
+
+    def poll(self, since):
+        payments = []
+        params = {"order": "desc", "limit": self.page_size}
+        while True:
+            response = self.session.get(f"{self.api_url}/charges", params=params, timeout=self.timeout)
+            response.raise_for_status()
+            page = response.json()
+            charges = page.get("data", [])
+            for charge in charges:
+                timeline = charge.get("timeline") or [{}]
+                if timeline[-1].get("status") in self.confirmed_statuses:
+                    payment = self._payment(charge)
+                    if payment:
+                        payments.append(payment)
+            oldest = self._created(charges[-1]) if charges else None
+            cursor = (page.get("pagination") or {}).get("cursor_range", [None, None])[-1]
+            if not charges or not cursor or oldest is None or oldest < since:
+                return payments
+            params["starting_after"] = cursor
+
+    def parse_webhook(self, body, headers):
+        if not self.webhook_secret:
+            raise ValueError("COINBASE_WEBHOOK_SECRET is not configured")
+        expected = hmac.new(self.webhook_secret.encode(), body, hashlib.sha256).hexdigest()
+        if not hmac.compare_digest(expected, headers.get("X-CC-Webhook-Signature", "")):
+            raise ValueError("Bad Coinbase webhook signature")
+        event = json.loads(body)["event"]
+        if event.get("type") not in self.confirmed_events:
+            return []
+        payment = self._payment(event["data"])
+        return [payment] if payment else []
+
+    def _payment(self, charge):
+        transaction_id = (charge.get("metadata") or {}).get("transaction_id")
+        if not transaction_id:
+            return None
+        amount = 0.0
+        currency = "USD"
+        for payment in charge.get("payments", []):
+            local = (payment.get("value") or {}).get("local") or {}
+            amount += float(local.get("amount", 0))
+            currency = local.get("currency", currency)
+        return Payment(transaction_id, amount, currency, charge.get("code"), self.name)
+
+    @staticmethod
+    def _created(charge):
+        try:
+            return datetime.fromisoformat(charge["created_at"].replace("Z", "+00:00")).timestamp()
+        except (KeyError, ValueError):
+            return None
+
+
+# Polls the provider on a background thread and hands each confirmed payment to
+# `confirm(key, record, payment)` after matching its transaction_id through the
+# repository's transaction index. Webhook deliveries go through submit(). Matching
+# is idempotent on the caller's side: a payment for a request that is no longer
+# pending is ignored, so overlapping polls and webhook retries are harmless.
+# Polls look back `lookback` seconds (older requests are auto-rejected anyway) and
+# are skipped while nothing is pending.
+class PaymentWatcher:
+    def __init__(self, provider, repository, confirm, lookback=72 * 3600, interval=30):
+        self.provider = provider
+        self.repository = repository
+        self.confirm = confirm
+        self.lookback = lookback
+        self.interval = interval
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="payment-watcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def submit(self, payments):
+        matched = 0
+        with self._lock:
+            for payment in payments:
+                match = self.repository.find_by_transaction_id(payment.transaction_id)
+                if match is None:
+                    logger.warning("Payment %s matches no request", payment)
+                    continue
+                key, record = match
+                try:
+                    self.confirm(key, record, payment)
+                    matched += 1
+                except Exception as e:
+                    logger.error("Failed to apply payment %s to %s: %s", payment, key, e)
+        return matched
+
+    def poll_once(self):
+        if not self.repository.count_by_status("pending"):
+            return 0
+        started = time.perf_counter()
+        payments = self.provider.poll(time.time() - self.lookback)
+        matched = self.submit(payments)
+        if payments:
+            logger.info("Payment poll found %s confirmed payment(s), %s matched, in %.2fs", len(payments), matched, time.perf_counter() - started)
+        return matched
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.poll_once()
+            except Exception as e:
+                logger.error("Payment poll via %s failed: %s", self.provider.name, e)
+
+
+# Build the provider selected by PAYMENT_PROVIDER (none, mock or coinbase)
+def open_payment_provider(name, config):
+    if not name or name == "none":
+        return PaymentProvider()
+    if name == "mock":
+        return MockPaymentProvider(config.get("mock_inbox"))
+    if name == "coinbase":
+        return CoinbaseCommerceProvider(config.get("coinbase_api_key"), config.get("coinbase_webhook_secret"))
+    raise ValueError(f"Unknown payment provider: {name}")
@@ -0,0 +1,211 @@
+import json
+import os
+import random
+import signal
+import threading
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from telebot import apihelper, types
+
+logger = logging.getLogger(__name__)
+
+
+# Long polling under supervision, in place of bot.polling() in a restart loop.
+#
+# getUpdates confirms to Telegram every update before the offset it is called with, so
+# intake runs ahead on a fetch cursor and what is still being handled is kept in
+# `offset_path` instead: before each fetch the file is rewritten with the next offset
+# and the raw JSON of every update still in flight. A restart replays those first,
+# then resumes from the offset, so after a crash an unfinished update is handled again
+# rather than lost (at-least-once: one that finished after the last save runs twice).
+# A slow handler holds only its own update, never the intake of the others;
+# `max_in_flight` bounds how many run or wait at once.
+#
+# Failed polls are retried after a jittered exponential backoff. stop() (SIGTERM or
+# SIGINT under run()) ends intake at once, waits up to `drain_timeout` seconds for
+# the handlers in flight, then calls `drain(remaining seconds)` (e.g. the outbound
+# queue) and saves the offset with whatever is still unfinished.
+class PollingSupervisor:
+    def __init__(self, bot, offset_path="polling_offset.json", workers=8, poll_timeout=25, limit=100,
+                 allowed_updates=None, backoff_base=1.0, backoff_max=60.0, max_in_flight=100,
+                 drain_timeout=20.0, drain=None, unhealthy_after=5):
+        self.bot = bot
+        self.workers = workers
+        self.offset_path = offset_path
+        self.poll_timeout = poll_timeout
+        self.limit = limit
+        self.allowed_updates = allowed_updates
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_in_flight = max_in_flight
+        self.drain_timeout = drain_timeout
+        self.drain = drain
+        self.unhealthy_after = unhealthy_after
+        self.state = "starting"  # starting, polling, backoff, draining, stopped
+        self.failures = 0
+        self.last_poll = None
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="update-worker")
+        self._in_flight = {}  # update_id -> raw update JSON
+        self._offset = None  # next update ID to fetch
+        self._saved = None  # (offset, in-flight IDs) last written to offset_path
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+
+    # The saved offset, and the updates that were still unfinished when it was saved
+    def load_offset(self):
+        try:
+            with open(self.offset_path, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+            offset, unfinished = saved["offset"], saved.get("in_flight", [])
+        except FileNotFoundError:
+            return None, []
+        except (ValueError, KeyError) as e:
+            logger.error("Ignoring unreadable polling offset in %s: %s", self.offset_path, e)
+            return None, []
+        self._offset = offset
+        return offset, unfinished
+
+    def offset(self):
+        return self._offset
+
+    def save_offset(self):
+        with self._cond:
+            offset = self._offset
+            update_ids = sorted(self._in_flight)
+            unfinished = [self._in_flight[update_id] for update_id in update_ids]
+        saved = (offset, tuple(update_ids))
+        if offset is None or saved == self._saved:
+            return
+        tmp_path = self.offset_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write('{"offset": %d, "in_flight": [%s]}' % (offset, ", ".join(unfinished)))
+        os.replace(tmp_path, self.offset_path)
+        self._saved = saved
+
+    def in_flight(self):
+        return len(self._in_flight)
+
+    def _handle(self, update):
+        try:
+            self.bot.process_new_updates([update])
+        except Exception as e:
+            logger.error("Handler failed for update %s: %s", update.update_id, e)
+        finally:
+            with self._cond:
+                self._in_flight.pop(update.update_id, None)
+                self._cond.notify_all()
+
+    # Hand raw updates (JSON text) to the pool, waiting while `max_in_flight` are running
+    def _dispatch(self, raw_updates):
+        for raw in raw_updates:
+            update = types.Update.de_json(raw)
+            with self._cond:
+                while len(self._in_flight) >= self.max_in_flight and not self._stop.is_set():
+                    self._cond.wait(1)
+                if self._stop.is_set():
+                    return
+                self._in_flight[update.update_id] = raw
+                if self._offset is None or update.update_id >= self._offset:
+                    self._offset = update.update_id + 1
+            self._executor.submit(self._handle, update)
+
+    def _backoff_delay(self):
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (self.failures - 1))
+        return random.uniform(delay / 2, delay)
+
+    def _poll(self):
+        while not self._stop.is_set():
+            try:
+                # Saved first: this fetch confirms everything before the offset to Telegram
+                self.save_offset()
+            except OSError as e:
+                logger.error("Failed to save polling offset to %s: %s", self.offset_path, e)
+                self._stop.wait(self._backoff_delay() if self.failures else 1)
+                continue
+            try:
+                updates = apihelper.get_updates(
+                    self.bot.token, offset=self._offset, limit=self.limit, timeout=self.poll_timeout + 10,
+                    allowed_updates=self.allowed_updates, long_polling_timeout=self.poll_timeout
+                )
+            except Exception as e:
+                self.failures += 1
+                self.state = "backoff"
+                delay = self._backoff_delay()
+                logger.error("Polling failed (%s in a row), retrying in %.1fs: %s", self.failures, delay, e)
+                self._stop.wait(delay)
+                continue
+            if self.failures:
+                logger.info("Polling recovered after %s failures", self.failures)
+            self.failures = 0
+            self.last_poll = time.monotonic()
+            if self._stop.is_set():
+                break  # Not dispatched, so not confirmed: Telegram sends them again after a restart
+            self.state = "polling"
+            self._dispatch(json.dumps(update) for update in updates)
+
+    def start(self):
+        # Handlers run on our pool; skip telebot's own worker threads
+        self.bot.threaded = False
+        offset, unfinished = self.load_offset()
+        if unfinished:
+            logger.info("Handling %s updates left unfinished by the last run", len(unfinished))
+            self._dispatch(json.dumps(update) for update in unfinished)
+        logger.info("Polling from update %s with %s handler threads", offset, self.workers)
+        self._thread = threading.Thread(target=self._poll, name="polling", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._stop.is_set():
+            return
+        logger.info("Stopping intake and draining %s in-flight updates", self.in_flight())
+        self.state = "draining"
+        deadline = time.monotonic() + self.drain_timeout
+        with self._cond:
+            self._stop.set()
+            self._cond.notify_all()
+            while self._in_flight and time.monotonic() < deadline:
+                self._cond.wait(deadline - time.monotonic())
+        if self._in_flight:
+            logger.error("%s updates still running after %ss; they are saved to run again on restart", len(self._in_flight), self.drain_timeout)
+        if self.drain and not self.drain(max(deadline - time.monotonic(), 0)):
+            logger.error("Outbound sends still queued after %ss", self.drain_timeout)
+        try:
+            self.save_offset()
+        except OSError as e:
+            logger.error("Failed to save polling offset to %s: %s", self.offset_path, e)
+        self.state = "stopped"
+        logger.info("Polling stopped at offset %s", self.offset())
+
+    # Poll until SIGTERM/SIGINT, then drain and return
+    def run(self):
+        stopping = threading.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda signum, frame: stopping.set())
+        self.start()
+        while not stopping.wait(1):
+            if not self._thread.is_alive():
+                logger.error("Polling thread exited unexpectedly; restarting it")
+                self._thread = threading.Thread(target=self._poll, name="polling", daemon=True)
+                self._thread.start()
+        self.stop()
+
+    # Liveness: the poll loop runs and has not failed `unhealthy_after` times in a row
+    def healthy(self):
+        alive = self._thread is not None and self._thread.is_alive() or self.state in ("draining", "stopped")
+        return alive and self.failures < self.unhealthy_after, self.status()
+
+    # Readiness: polling normally, not starting, backing off or shutting down
+    def ready(self):
+        return self.state == "polling", self.status()
+
+    def status(self):
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "in_flight": self.in_flight(),
+            "offset": self.offset(),
+            "last_poll_seconds_ago": None if self.last_poll is None else round(time.monotonic() - self.last_poll, 1),
+        }
@@ -0,0 +1,245 @@
+import argparse
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+
+STATUSES = ("selected", "pending", "activated", "rejected", "expired")
+PAYMENT_METHODS = ("Website",)
+
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+_TIMESTAMP = re.compile(r"\d{4}-\d\d-\d\d \d\d:\d\d:\d\d(\.\d{6})?")
+_PAYMENT = re.compile(r"^(?:Payment: )*(\$\d+(?:\.\d\d)?) via (.+)$")
+
+
+# "$15 via Website" -> ("$15", "Website"). Older code stacked "Payment: " prefixes
+# onto the text on every change; they are dropped. (None, None) if it does not parse.
+def split_payment(text):
+    match = _PAYMENT.match(text or "")
+    return match.groups() if match else (None, None)
+
+
+def payment_text(price, method):
+    return f"{price} via {method}"
+
+
+# The same payment text paid via another method
+def payment_with_method(text, method):
+    price, _ = split_payment(text)
+    return payment_text(price or (text or "").split(" via")[0], method)
+
+
+# Strings <-> small ints for fields with few distinct values (status, plan, item,
+# payment method). Codes are only meaningful inside this process; files keep the strings.
+class Codebook:
+    def __init__(self, values=()):
+        self._values = []
+        self._codes = {}
+        self._lock = threading.Lock()
+        for value in values:
+            self.code(value)
+
+    def code(self, value):
+        code = self._codes.get(value)
+        if code is None:
+            with self._lock:
+                code = self._codes.get(value)
+                if code is None:
+                    code = self._codes[value] = len(self._values)
+                    self._values.append(value)
+        return code
+
+    def value(self, code):
+        return self._values[code]
+
+
+STATUS_CODES = Codebook(STATUSES)
+PLAN_CODES = Codebook()
+ITEM_CODES = Codebook()
+METHOD_CODES = Codebook(PAYMENT_METHODS)
+
+
+# Field encoders return None when a value would not come back unchanged; such values
+# are kept as they are in the record's `extra` dict, so packing is always lossless.
+def _encode_time(text):
+    if not isinstance(text, str) or not _TIMESTAMP.fullmatch(text) or text.endswith(".000000"):
+        return None
+    try:
+        return (datetime.fromisoformat(text) - _EPOCH) // _MICROSECOND
+    except ValueError:
+        return None
+
+
+def _decode_time(micros):
+    return str(_EPOCH + micros * _MICROSECOND)
+
+
+# Any ISO date or timestamp as microseconds since the epoch (for ordering, so it is not
+# as strict as _encode_time); None if it does not parse
+def timestamp_micros(text):
+    try:
+        return (datetime.fromisoformat(text) - _EPOCH) // _MICROSECOND
+    except (TypeError, ValueError):
+        return None
+
+
+def _encode_uuid(text):
+    if not isinstance(text, str) or len(text) != 36:
+        return None
+    try:
+        raw = bytes.fromhex(text.replace("-", ""))
+    except ValueError:
+        return None
+    return raw if len(raw) == 16 and _decode_uuid(raw) == text else None
+
+
+def _decode_uuid(raw):
+    digits = raw.hex()
+    return f"{digits[:8]}-{digits[8:12]}-{digits[12:16]}-{digits[16:20]}-{digits[20:]}"
+
+
+def _encode_chat_id(text):
+    if isinstance(text, str) and text.isdigit() and str(int(text)) == text:
+        return int(text)
+    return None
+
+
+def _format_price(cents):
+    return f"${cents // 100}" if cents % 100 == 0 else f"${cents // 100}.{cents % 100:02d}"
+
+
+def _encoder(codebook):
+    return lambda value: codebook.code(value) if isinstance(value, str) else None
+
+
+# slot -> (record field, encode, decode), in the order to_dict() emits fields
+_FIELDS = (
+    ("user_id", _encode_chat_id, str),
+    ("plan", _encoder(PLAN_CODES), PLAN_CODES.value),
+    ("item", _encoder(ITEM_CODES), ITEM_CODES.value),
+    ("status", _encoder(STATUS_CODES), STATUS_CODES.value),
+    ("timestamp", _encode_time, _decode_time),
+    ("transaction_id", _encode_uuid, _decode_uuid),
+    ("activated_at", _encode_time, _decode_time),
+    ("expires_at", _encode_time, _decode_time),
+)
+_DECODERS = {name: decode for name, _, decode in _FIELDS}
+
+
+# One stored record in about a third of the memory of its dict: integer chat ID,
+# microseconds since the epoch for timestamps (naive local time, as str(datetime.now())
+# wrote it), 16-byte transaction UUIDs, coded status/plan/item/payment method and the
+# price in cents. Fields that do not fit the compact form stay in `extra` unchanged.
+# Read-only; get()/[] decode one field and to_dict() rebuilds the full record.
+class CompactRecord:
+    __slots__ = ("user_id", "plan", "item", "status", "timestamp", "transaction_id",
+                 "activated_at", "expires_at", "price", "method", "extra")
+
+    @classmethod
+    def pack(cls, record):
+        self = cls.__new__(cls)
+        extra = None
+        for name, encode, _ in _FIELDS:
+            value = record.get(name)
+            code = encode(value) if value is not None else None
+            if code is None and name in record:
+                extra = extra or {}
+                extra[name] = value
+            setattr(self, name, code)
+        self.price = self.method = None
+        if "payment" in record:
+            price, method = split_payment(record["payment"])
+            cents = int(round(float(price[1:]) * 100)) if price is not None else None
+            if cents is not None and payment_text(_format_price(cents), method) == record["payment"]:
+                self.price = cents
+                self.method = METHOD_CODES.code(method)
+            else:
+                extra = extra or {}
+                extra["payment"] = record["payment"]
+        for name, value in record.items():
+            if name not in _DECODERS and name != "payment":
+                extra = extra or {}
+                extra[name] = value
+        self.extra = extra
+        return self
+
+    def _payment(self):
+        return payment_text(_format_price(self.price), METHOD_CODES.value(self.method))
+
+    def get(self, name, default=None):
+        decode = _DECODERS.get(name)
+        if decode is not None:
+            code = getattr(self, name)
+            if code is not None:
+                return decode(code)
+        elif name == "payment" and self.price is not None:
+            return self._payment()
+        if self.extra is not None:
+            return self.extra.get(name, default)
+        return default
+
+    def __getitem__(self, name):
+        value = self.get(name, _MISSING)
+        if value is _MISSING:
+            raise KeyError(name)
+        return value
+
+    def __contains__(self, name):
+        return self.get(name, _MISSING) is not _MISSING
+
+    def to_dict(self):
+        record = {}
+        for name, _, decode in _FIELDS:
+            code = getattr(self, name)
+            if code is not None:
+                record[name] = decode(code)
+        if self.price is not None:
+            record["payment"] = self._payment()
+        if self.extra:
+            # Lists (reminders_sent) are copied so edits to the dict never reach the stored record
+            for name, value in self.extra.items():
+                record[name] = list(value) if isinstance(value, list) else value
+        return record
+
+    def __repr__(self):
+        return f"CompactRecord({self.to_dict()!r})"
+
+
+_MISSING = object()
+
+
+# Rewrite records from the current JSON schema so every field fits CompactRecord:
+# stacked "Payment: " prefixes are dropped from payment texts. Returns the records changed.
+def migrate_records(records):
+    changed = 0
+    for record in records.values():
+        price, method = split_payment(record.get("payment"))
+        if price is not None and record["payment"] != payment_text(price, method):
+            record["payment"] = payment_text(price, method)
+            changed += 1
+    return changed
+
+
+# One-shot migration of journal stores (snapshot plus pending journal) in place:
+#   python records.py subscriptions.json orders.json
+# The fixed records are written as a new snapshot and the journal is folded into it.
+def main():
+    from storage import JournalStore
+
+    parser = argparse.ArgumentParser(description="Migrate journal stores to the compact record schema")
+    parser.add_argument("snapshots", nargs="+", help="journal snapshots (subscriptions.json, orders.json)")
+    args = parser.parse_args()
+    for path in args.snapshots:
+        started = time.perf_counter()
+        store = JournalStore(path)
+        records = store.load()
+        changed = migrate_records(records)
+        loose = sum(1 for record in records.values() if CompactRecord.pack(record).extra)
+        store.rewrite(records)
+        store.close()
+        print(f"{path}: {len(records)} records, {changed} migrated, {loose} with fields kept verbatim, in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
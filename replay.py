@@ -0,0 +1,290 @@
+import argparse
+import bisect
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+
+from benchmark import make_workdir, start_bot_child, child_result, percentile
+from fake_telegram_api import FakeTelegramAPI, message_update, callback_update
+
+# Replays recorded traffic against bot.py and the fake Bot API.
+#
+#   python replay.py bot.log --speed 10 --record run.json
+#   python replay.py bot.log --speed max --compare run.json
+#
+# Sources are bot.log in either format (text "%(asctime)s - %(levelname)s - %(message)s"
+# or JSON lines), or a capture file of {"ts": <epoch>, "update": {...}} lines, which
+# --save-capture writes from a parsed log. Gaps between updates are kept (divided by
+# --speed) up to --max-gap seconds, so bursts such as the replies after a broadcast
+# arrive as bursts.
+
+TEXT_LINE = re.compile(r"^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d),(\d{3}) - \w+ - (.*)$")
+START_EVENT = re.compile(r"^User (\d+) started the bot")
+MESSAGE_EVENT = re.compile(r"^User (\d+) sent message: (.*)$")
+CALLBACK_EVENT = re.compile(r"^User (\d+) triggered callback: (.*)$")
+
+# "started the bot" is also logged when these re-open the welcome screen; those are not /start commands
+WELCOME_TRIGGERS = {("message", "🔙 Back to Start"), ("callback", "back_inline")}
+WELCOME_WINDOW = 2.0
+
+UUID_PATTERN = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
+TIMESTAMP_PATTERN = re.compile(r"\d{4}-\d\d-\d\d \d\d:\d\d:\d\d(\.\d+)?")
+
+
+def _unescape(text):
+    # Older logs wrote emoji as \U0001f6d2 escapes
+    if re.search(r"\\[uUx][0-9a-fA-F]", text):
+        return text.encode("latin-1", "backslashreplace").decode("unicode_escape")
+    return text
+
+
+def _parse_line(line):
+    line = line.strip()
+    if line.startswith("{"):
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            return None
+        stamp, message = entry.get("ts", ""), entry.get("message", "")
+    else:
+        match = TEXT_LINE.match(line)
+        if not match:
+            return None
+        stamp, message = f"{match.group(1)},{match.group(2)}", match.group(3)
+    try:
+        ts = datetime.strptime(stamp, "%Y-%m-%d %H:%M:%S,%f").timestamp()
+    except ValueError:
+        return None
+    match = START_EVENT.match(message)
+    if match:
+        return ts, int(match.group(1)), "start", "/start"
+    match = MESSAGE_EVENT.match(message)
+    if match:
+        return ts, int(match.group(1)), "message", _unescape(match.group(2))
+    match = CALLBACK_EVENT.match(message)
+    if match:
+        return ts, int(match.group(1)), "callback", match.group(2)
+    return None
+
+
+# Parse bot.log (text or JSON lines) into (ts, update) pairs in time order
+def parse_log(path):
+    events = []
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            event = _parse_line(line)
+            if event:
+                events.append(event)
+    events.sort(key=lambda event: event[0])
+
+    triggers = defaultdict(list)
+    for ts, chat_id, kind, data in events:
+        if (kind, data) in WELCOME_TRIGGERS:
+            triggers[chat_id].append(ts)
+    updates = []
+    for ts, chat_id, kind, data in events:
+        if kind == "start":
+            times = triggers.get(chat_id, [])
+            i = bisect.bisect_left(times, ts - WELCOME_WINDOW)
+            if i < len(times) and times[i] <= ts + WELCOME_WINDOW:
+                continue
+            updates.append((ts, message_update(chat_id, "/start")))
+        elif kind == "message":
+            updates.append((ts, message_update(chat_id, data)))
+        else:
+            updates.append((ts, callback_update(chat_id, data)))
+    return updates
+
+
+def load_capture(path):
+    updates = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                updates.append((entry["ts"], entry["update"]))
+    return updates
+
+
+def load_source(path):
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        first = f.readline()
+    try:
+        if "update" in json.loads(first):
+            return load_capture(path)
+    except ValueError:
+        pass
+    return parse_log(path)
+
+
+def save_capture(updates, path):
+    with open(path, "w", encoding="utf-8") as f:
+        for ts, update in updates:
+            f.write(json.dumps({"ts": ts, "update": update}, ensure_ascii=False) + "\n")
+
+
+# Seconds after the first update at which each one is pushed
+def schedule(updates, speed, max_gap):
+    offsets = []
+    offset = 0.0
+    previous = None
+    for ts, _ in updates:
+        if previous is not None:
+            offset += min(max(ts - previous, 0), max_gap) / speed
+        offsets.append(offset)
+        previous = ts
+    return offsets
+
+
+def peak_rate(updates):
+    times = [ts for ts, _ in updates]
+    peak = 0
+    start = 0
+    for end in range(len(times)):
+        while times[end] - times[start] >= 1:
+            start += 1
+        peak = max(peak, end - start + 1)
+    return peak
+
+
+def _update_keys(update):
+    if "callback_query" in update:
+        query = update["callback_query"]
+        return str(query["message"]["chat"]["id"]), query["id"]
+    return str(update["message"]["chat"]["id"]), None
+
+
+def _normalize(text):
+    return TIMESTAMP_PATTERN.sub("<ts>", UUID_PATTERN.sub("<uuid>", text or ""))
+
+
+# What the bot sent, per chat: Counter of (method, normalized text). Handlers for one
+# chat may interleave with admin traffic, so outputs are compared as multisets.
+def record_outputs(calls):
+    outputs = defaultdict(Counter)
+    for _, method, params in calls:
+        key = params.get("chat_id") or "callback_answers"
+        outputs[key][f"{method} {_normalize(params.get('text') or params.get('caption'))}".strip()] += 1
+    return {chat: dict(counter) for chat, counter in outputs.items()}
+
+
+def compare_outputs(baseline, outputs, limit=10):
+    diverged = []
+    for chat in sorted(set(baseline) | set(outputs)):
+        expected, actual = Counter(baseline.get(chat, {})), Counter(outputs.get(chat, {}))
+        if expected != actual:
+            diverged.append((chat, dict(expected - actual), dict(actual - expected)))
+    return diverged[:limit], len(diverged), len(set(baseline) | set(outputs))
+
+
+# Time from each update being offered to the first API call it caused for its chat
+# (or its answerCallbackQuery), measured on the fake API's clock
+def response_latencies(pushed, calls):
+    by_key = defaultdict(list)
+    for t, _, params in calls:
+        key = params.get("callback_query_id") or params.get("chat_id")
+        if key:
+            by_key[str(key)].append(t)
+    latencies = []
+    for pushed_at, chat_id, query_id in pushed:
+        times = by_key.get(query_id) if query_id else None
+        times = times or by_key.get(chat_id, [])
+        i = bisect.bisect_left(times, pushed_at)
+        if i < len(times):
+            latencies.append(times[i] - pushed_at)
+    return latencies
+
+
+def replay(updates, speed, max_gap, store=None, timeout=None, production_rates=False):
+    offsets = schedule(updates, speed, max_gap)
+    timeout = timeout or (offsets[-1] if offsets else 0) + 120
+    api = FakeTelegramAPI().start()
+    workdir = make_workdir("replay-")
+    try:
+        if store:
+            shutil.copy(store, os.path.join(workdir, "subscriptions.json"))
+        child = start_bot_child(api, workdir, len(updates), timeout, production_rates)
+        pushed = []
+
+        def feed():
+            api.polled.wait(timeout)
+            started = time.monotonic()
+            for offset, (_, update) in zip(offsets, updates):
+                delay = started + offset - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                chat_id, query_id = _update_keys(update)
+                pushed.append((time.monotonic(), chat_id, query_id))
+                api.push_updates([dict(update)])
+
+        feeder = threading.Thread(target=feed, name="replay-feed", daemon=True)
+        started = time.monotonic()
+        feeder.start()
+        result = child_result(child)
+        feeder.join()
+        result["wall_seconds"] = time.monotonic() - started
+        result["api_calls"] = dict(api.method_counts)
+        result["response_latencies"] = response_latencies(pushed, api.calls)
+        result["outputs"] = record_outputs(api.calls)
+        return result
+    finally:
+        api.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded bot traffic against the fake Bot API")
+    parser.add_argument("source", help="bot.log (text or JSON lines) or a capture file")
+    parser.add_argument("--speed", default="1", help="1, 10, ... or max")
+    parser.add_argument("--max-gap", type=float, default=60, help="longest idle gap kept, in source seconds")
+    parser.add_argument("--limit", type=int, help="replay only the first N updates")
+    parser.add_argument("--store", help="subscriptions snapshot to start from (default: empty)")
+    parser.add_argument("--timeout", type=float, help="seconds to wait for the bot (default: replay length + 120)")
+    parser.add_argument("--production-rates", action="store_true", help="keep the configured outbound rate limits")
+    parser.add_argument("--save-capture", help="write the parsed updates as a capture file and exit")
+    parser.add_argument("--record", help="write this run's outputs for a later --compare")
+    parser.add_argument("--compare", help="outputs recorded by an earlier run")
+    args = parser.parse_args()
+
+    updates = load_source(args.source)[:args.limit]
+    if args.save_capture:
+        save_capture(updates, args.save_capture)
+        print(f"Wrote {len(updates)} updates to {args.save_capture}")
+        return
+    if not updates:
+        print("No replayable updates found.")
+        return
+    speed = float("inf") if args.speed == "max" else float(args.speed)
+    span = updates[-1][0] - updates[0][0]
+    print(f"Replaying {len(updates)} updates spanning {span:.0f}s (peak {peak_rate(updates)}/s) at " + ("max speed" if args.speed == "max" else f"{args.speed}x"))
+
+    result = replay(updates, speed, args.max_gap, store=args.store, timeout=args.timeout, production_rates=args.production_rates)
+    latencies = result["response_latencies"]
+    print(f"Handled {result['handled']}/{len(updates)} updates in {result['wall_seconds']:.1f}s"
+          + ("" if result["completed"] else " (timed out)") + f", {result['errors']} handler errors")
+    print(f"Handler latency ms: p50 {result['p50_ms']:.2f}  p99 {result['p99_ms']:.2f}  max {result['max_ms']:.2f}")
+    print(f"Response latency ms: p50 {percentile(latencies, 0.5) * 1000:.2f}  p99 {percentile(latencies, 0.99) * 1000:.2f}  "
+          f"max {max(latencies, default=0) * 1000:.2f}  ({len(latencies)} updates answered)")
+    print("API calls: " + ", ".join(f"{method} {count}" for method, count in sorted(result["api_calls"].items())))
+    for error in result["error_sample"]:
+        print(f"  handler error: {error}")
+
+    if args.record:
+        with open(args.record, "w", encoding="utf-8") as f:
+            json.dump(result["outputs"], f, ensure_ascii=False, indent=1)
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        shown, diverged, compared = compare_outputs(baseline, result["outputs"])
+        print(f"Divergence: {diverged} of {compared} chats")
+        for chat, missing, extra in shown:
+            print(f"  chat {chat}: missing {missing} extra {extra}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# Maps callback_data to handlers in constant time.
+# Exact routes are a dict lookup. Prefix routes ("page_", "activate_", ...) are found
+# by probing the dict at each "_" boundary of the data (callback_data is at most
+# 64 bytes), keeping the longest registered prefix. The remainder is split into
+# typed arguments once, before the handler runs. A fallback resolver handles
+# routes that live in data, such as catalog items.
+class CallbackRouter:
+    def __init__(self):
+        self._exact = {}
+        self._prefixes = {}
+        self._fallback = None
+        # route name -> [calls, total seconds, max seconds]; handlers run on several threads
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+
+    def exact(self, *names):
+        def register(handler):
+            for name in names:
+                self._exact[name] = handler
+            return handler
+        return register
+
+    # Handler receives (call, *args); `converters` parse the "_"-separated remainder,
+    # the last argument taking whatever is left
+    def prefix(self, prefix, *converters):
+        def register(handler):
+            self._prefixes[prefix] = (handler, converters)
+            return handler
+        return register
+
+    # resolver(data) -> (route name, handler) or None
+    def fallback(self, resolver):
+        self._fallback = resolver
+        return resolver
+
+    def resolve(self, data):
+        handler = self._exact.get(data)
+        if handler:
+            return data, handler, ()
+        match = None
+        for i, ch in enumerate(data):
+            if ch == "_" and data[:i + 1] in self._prefixes:
+                match = data[:i + 1]
+        if match:
+            handler, converters = self._prefixes[match]
+            remainder = data[len(match):]
+            parts = remainder.split("_", len(converters) - 1) if converters else []
+            if len(parts) != len(converters):
+                raise ValueError(f"Expected {len(converters)} arguments for {match}*, got {remainder!r}")
+            return match + "*", handler, tuple(convert(part) for convert, part in zip(converters, parts))
+        if self._fallback:
+            resolved = self._fallback(data)
+            if resolved:
+                name, handler = resolved
+                return name, handler, ()
+        return None
+
+    def dispatch(self, call):
+        try:
+            resolved = self.resolve(call.data)
+        except ValueError as e:
+            logger.warning("Malformed callback data %r: %s", call.data, e)
+            return
+        if resolved is None:
+            logger.warning("No route for callback data %r", call.data)
+            return
+        name, handler, args = resolved
+        started = time.perf_counter()
+        try:
+            return handler(call, *args)
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._stats_lock:
+                stats = self._stats.setdefault(name, [0, 0.0, 0.0])
+                stats[0] += 1
+                stats[1] += elapsed
+                stats[2] = max(stats[2], elapsed)
+
+    # Copy of the per-route stats: route name -> (calls, total seconds, max seconds)
+    def stats(self):
+        with self._stats_lock:
+            return {name: tuple(stats) for name, stats in self._stats.items()}
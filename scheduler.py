@@ -0,0 +1,166 @@
+import calendar
+import heapq
+import itertools
+import threading
+import time
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+DAY = 86400
+
+
+def add_months(moment, months):
+    month = moment.month - 1 + months
+    year = moment.year + month // 12
+    month = month % 12 + 1
+    return moment.replace(year=year, month=month, day=min(moment.day, calendar.monthrange(year, month)[1]))
+
+
+def parse_timestamp(value):
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+# Time-driven subscription jobs: renewal reminders, expiry, and auto-rejecting
+# payment requests that were never approved.
+# Each tracked order has exactly one entry in a heap ordered by the time of its next
+# job, so a tick only touches what is due. Entries are validated lazily: when one
+# comes due the order's current record decides what (if anything) happens, and an
+# order that changed since it was scheduled is simply rescheduled.
+#   load(repository)                         seed the heap once at startup
+#   get(transaction_id) -> order             current order (re-read from shared storage)
+#   remind(transaction_id, order, days)      the subscription ends in `days` days; order["reminders_sent"] is already updated
+#   expire(transaction_id, order)
+#   reject_stale(transaction_id, order)      pending payment older than `pending_timeout`
+class ExpiryScheduler:
+    def __init__(self, get, remind, expire, reject_stale, reminder_days=(7, 1), pending_timeout=72 * 3600, batch_size=500, max_wait=60):
+        self.get = get
+        self.remind = remind
+        self.expire = expire
+        self.reject_stale = reject_stale
+        self.reminder_days = sorted(set(reminder_days), reverse=True)
+        self.pending_timeout = pending_timeout
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self._heap = []
+        self._scheduled = {}
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread = None
+
+    # (due, job) for the record's next job, or None if nothing is scheduled for it
+    def next_job(self, record):
+        status = record.get("status")
+        if status == "activated":
+            expires = parse_timestamp(record.get("expires_at"))
+            if expires is None:
+                return None
+            sent = record.get("reminders_sent", ())
+            for days in self.reminder_days:
+                if days not in sent:
+                    return expires - days * DAY, "remind"
+            return expires, "expire"
+        if status == "pending" and record.get("transaction_id"):
+            requested = parse_timestamp(record.get("timestamp"))
+            if requested is not None:
+                return requested + self.pending_timeout, "reject_stale"
+        return None
+
+    # (Re)schedule an order after it changed
+    def track(self, transaction_id, record):
+        job = self.next_job(record)
+        with self._cond:
+            if job is None:
+                self._scheduled.pop(transaction_id, None)
+                return
+            due = job[0]
+            if self._scheduled.get(transaction_id) == due:
+                return
+            self._scheduled[transaction_id] = due
+            heapq.heappush(self._heap, (due, next(self._seq), transaction_id))
+            if self._heap[0][2] == transaction_id:
+                self._cond.notify()
+
+    # Seed from storage: only activated and pending orders can have jobs
+    def load(self, repository):
+        for status in ("activated", "pending"):
+            for transaction_id, record in repository.find_by_status(status):
+                self.track(transaction_id, record)
+        logger.info("Expiry scheduler tracking %s subscriptions", len(self._scheduled))
+
+    def pending(self):
+        return len(self._scheduled)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="expiry-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread:
+            self._thread.join()
+
+    def _due_batch(self):
+        with self._cond:
+            while not self._stopping:
+                now = time.time()
+                batch = []
+                while self._heap and self._heap[0][0] <= now and len(batch) < self.batch_size:
+                    due, _, transaction_id = heapq.heappop(self._heap)
+                    # Superseded by a later track() for the same order
+                    if self._scheduled.get(transaction_id) != due:
+                        continue
+                    del self._scheduled[transaction_id]
+                    batch.append(transaction_id)
+                if batch:
+                    return batch
+                wait = min(self._heap[0][0] - now, self.max_wait) if self._heap else self.max_wait
+                self._cond.wait(wait)
+            return None
+
+    def _run(self):
+        while True:
+            batch = self._due_batch()
+            if batch is None:
+                return
+            started = time.perf_counter()
+            for transaction_id in batch:
+                try:
+                    self._process(transaction_id)
+                except Exception as e:
+                    logger.error("Scheduled job failed for order %s: %s", transaction_id, e)
+            logger.info("Expiry scheduler processed %s due subscriptions in %.3fs", len(batch), time.perf_counter() - started)
+
+    def _process(self, transaction_id):
+        record = self.get(transaction_id)
+        if record is None:
+            return
+        job = self.next_job(record)
+        if job is None:
+            return
+        due, kind = job
+        now = time.time()
+        if due > now:
+            # The record changed after this entry was queued
+            self.track(transaction_id, record)
+            return
+        expires = parse_timestamp(record.get("expires_at"))
+        if kind == "reject_stale":
+            self.reject_stale(transaction_id, record)
+        elif kind == "expire" or now >= expires:
+            self.expire(transaction_id, record)
+        else:
+            # Reminders missed while the bot was down collapse into the nearest one
+            overdue = [days for days in self.reminder_days if expires - days * DAY <= now]
+            sent = record.setdefault("reminders_sent", [])
+            sent.extend(days for days in overdue if days not in sent)
+            self.remind(transaction_id, record, min(overdue))
+        # expire/reject_stale write a new copy of the record, so schedule from what was stored
+        self.track(transaction_id, self.get(transaction_id) or record)
@@ -0,0 +1,44 @@
+import itertools
+import threading
+from collections import OrderedDict
+
+
+# Open admin searches, so result pages can be walked with short callback data
+# ("search_<id>_<page>") instead of carrying filters and cursors in the 64-byte payload.
+# Each search keeps its filters and the keyset cursor each visited page starts after;
+# the oldest searches are dropped once `capacity` are open.
+class SearchSessions:
+    def __init__(self, capacity=200):
+        self.capacity = capacity
+        self._sessions = OrderedDict()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def create(self, filters):
+        with self._lock:
+            search_id = format(next(self._ids), "x")
+            self._sessions[search_id] = (filters, [None])
+            if len(self._sessions) > self.capacity:
+                self._sessions.popitem(last=False)
+            return search_id
+
+    # (filters, cursor page `page` starts after), or None for an unknown or unvisited page
+    def page(self, search_id, page):
+        with self._lock:
+            session = self._sessions.get(search_id)
+            if session is None or not 0 <= page < len(session[1]):
+                return None
+            self._sessions.move_to_end(search_id)
+            return session[0], session[1][page]
+
+    # Record where page `page` starts once the page before it has been shown
+    def remember(self, search_id, page, cursor):
+        with self._lock:
+            session = self._sessions.get(search_id)
+            if session is None:
+                return
+            cursors = session[1]
+            if page < len(cursors):
+                cursors[page] = cursor
+            elif page == len(cursors):
+                cursors.append(cursor)
@@ -0,0 +1,668 @@
+import bisect
+import heapq
+import json
+import os
+import threading
+import logging
+import sqlite3
+
+from records import CompactRecord, timestamp_micros
+
+logger = logging.getLogger(__name__)
+
+
+# Append-only journal with a compacted snapshot.
+# Every mutation appends one JSON line to the journal, so a write costs the size of
+# one record instead of the whole store. Once the journal passes `compact_every`
+# records it is rotated to `<journal>.old` and folded into the snapshot on a
+# background thread, using only the files on disk (the live dict is never locked).
+class JournalStore:
+    def __init__(self, snapshot_path, journal_path=None, compact_every=1000, fsync=False):
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path or snapshot_path + ".journal"
+        self.old_journal_path = self.journal_path + ".old"
+        self.compact_every = compact_every
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._journal = None
+        self._journal_records = 0
+        self._compactor = None
+
+    # Rebuild state from snapshot plus journal(s)
+    def load(self):
+        # A leftover rotated journal means the last compaction never finished
+        if os.path.exists(self.old_journal_path):
+            self._compact_rotated()
+        records = self._read_snapshot()
+        self._journal_records = self._replay(self.journal_path, records)
+        self._journal = open(self.journal_path, "a", encoding="utf-8")
+        logger.info("Loaded %s records from %s (%s journal entries)", len(records), self.snapshot_path, self._journal_records)
+        return records
+
+    def put(self, key, value):
+        self._append({"op": "put", "key": key, "value": value})
+
+    # Replace the whole store with `records`: a new snapshot and an empty journal
+    def rewrite(self, records):
+        with self._lock:
+            if self._compactor:
+                self._compactor.join()
+            tmp_path = self.snapshot_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(records, f, indent=4)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.snapshot_path)
+            if self._journal:
+                self._journal.close()
+            for path in (self.journal_path, self.old_journal_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            self._journal = open(self.journal_path, "a", encoding="utf-8")
+            self._journal_records = 0
+
+    def delete(self, key):
+        self._append({"op": "delete", "key": key})
+
+    def close(self):
+        with self._lock:
+            if self._journal:
+                self._journal.close()
+                self._journal = None
+        if self._compactor:
+            self._compactor.join()
+
+    def _append(self, entry):
+        line = json.dumps(entry, separators=(",", ":")) + "\n"
+        with self._lock:
+            self._journal.write(line)
+            self._journal.flush()
+            if self.fsync:
+                os.fsync(self._journal.fileno())
+            self._journal_records += 1
+            if self._journal_records >= self.compact_every and not self._compacting() and not os.path.exists(self.old_journal_path):
+                self._rotate()
+                self._compactor = threading.Thread(target=self._compact_rotated, name="journal-compactor", daemon=True)
+                self._compactor.start()
+
+    def _compacting(self):
+        return self._compactor is not None and self._compactor.is_alive()
+
+    # Called with the lock held: swap in a fresh journal file
+    def _rotate(self):
+        self._journal.close()
+        os.replace(self.journal_path, self.old_journal_path)
+        self._journal = open(self.journal_path, "a", encoding="utf-8")
+        self._journal_records = 0
+
+    def _compact_rotated(self):
+        try:
+            records = self._read_snapshot()
+            applied = self._replay(self.old_journal_path, records)
+            tmp_path = self.snapshot_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(records, f, indent=4)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.snapshot_path)
+            os.remove(self.old_journal_path)
+            logger.info("Compacted %s journal entries into %s (%s records)", applied, self.snapshot_path, len(records))
+        except Exception as e:
+            logger.error("Journal compaction failed for %s: %s", self.snapshot_path, e)
+
+    def _read_snapshot(self):
+        try:
+            with open(self.snapshot_path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    @staticmethod
+    def _replay(path, records):
+        applied = 0
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A torn final line from a crash mid-write; everything before it is intact
+                        logger.warning("Skipping unreadable journal line in %s", path)
+                        continue
+                    if entry["op"] == "put":
+                        records[entry["key"]] = entry["value"]
+                    elif entry["op"] == "delete":
+                        records.pop(entry["key"], None)
+                    applied += 1
+        except FileNotFoundError:
+            pass
+        return applied
+
+
+# Where a record sits in the indexes: (timestamp as integer microseconds, key), the
+# timestamp being the one CompactRecord already holds. Timestamps that do not parse
+# (or are missing) sort first, as -1. One tuple is shared by every index.
+def index_position(key, record):
+    micros = record.timestamp if isinstance(record, CompactRecord) else None
+    if micros is None:
+        micros = timestamp_micros(record.get("timestamp"))
+    return (micros if micros is not None else -1, key)
+
+
+# Secondary index: record[field] -> index positions in order. The caller passes the
+# record being replaced, so no per-key state is kept beyond the positions themselves.
+# With skip_missing, records without the field are not indexed at all.
+class BucketIndex:
+    def __init__(self, field, skip_missing=False):
+        self.field = field
+        self.skip_missing = skip_missing
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    # Move a record from the bucket of `previous` (at previous_position) to the bucket
+    # of `record` (at position); either may be None, for an insert or a delete
+    def update(self, record, position, previous=None, previous_position=None):
+        with self._lock:
+            if previous is not None:
+                self._remove(previous.get(self.field), previous_position)
+            if record is None:
+                return
+            value = record.get(self.field)
+            if value is None and self.skip_missing:
+                return
+            bisect.insort(self._buckets.setdefault(value, []), position)
+
+    def _remove(self, value, position):
+        bucket = self._buckets.get(value)
+        if bucket is None:
+            return
+        i = bisect.bisect_left(bucket, position)
+        if i < len(bucket) and bucket[i] == position:
+            del bucket[i]
+            if not bucket:
+                del self._buckets[value]
+
+    def page(self, value, offset=0, limit=None):
+        end = None if limit is None else offset + limit
+        with self._lock:
+            return [key for _, key in self._buckets.get(value, [])[offset:end]]
+
+    def count(self, value):
+        return len(self._buckets.get(value, ()))
+
+    def values(self):
+        with self._lock:
+            return list(self._buckets)
+
+    # Positions of one bucket after `after`, copied out in chunks
+    # so writers are never blocked for long and a concurrent insert cannot break the walk
+    def scan(self, value, after=None, chunk=256):
+        while True:
+            with self._lock:
+                bucket = self._buckets.get(value, [])
+                i = bisect.bisect_right(bucket, after) if after else 0
+                batch = bucket[i:i + chunk]
+            yield from batch
+            if len(batch) < chunk:
+                return
+            after = batch[-1]
+
+
+# Secondary index: transaction_id -> key, for O(1) payment matching, plus the
+# transaction IDs in sorted order for prefix lookups. Orders are keyed by their
+# transaction ID, so the key string itself is stored when the two are equal.
+class TransactionIndex:
+    def __init__(self):
+        self._keys = {}
+        self._sorted = []
+        self._lock = threading.Lock()
+
+    # Bulk build at load time: one sort instead of an insort per record
+    def load(self, records):
+        with self._lock:
+            for key, record in records.items():
+                transaction_id = record.get("transaction_id")
+                if transaction_id:
+                    self._keys[key if transaction_id == key else transaction_id] = key
+            self._sorted = sorted(self._keys)
+
+    # Point `record`'s transaction ID at `key`, dropping the one of the record it
+    # replaces (`previous`); either may be None, for an insert or a delete
+    def update(self, key, record, previous=None):
+        transaction_id = record.get("transaction_id") if record is not None else None
+        old = previous.get("transaction_id") if previous is not None else None
+        with self._lock:
+            if old and old != transaction_id and self._keys.get(old) == key:
+                del self._keys[old]
+                del self._sorted[bisect.bisect_left(self._sorted, old)]
+            if transaction_id and self._keys.get(transaction_id) != key:
+                if transaction_id == key:
+                    transaction_id = key
+                if transaction_id not in self._keys:
+                    bisect.insort(self._sorted, transaction_id)
+                self._keys[transaction_id] = key
+
+    def get(self, transaction_id):
+        return self._keys.get(transaction_id)
+
+    # Keys whose transaction_id starts with `prefix`
+    def prefix(self, prefix, limit=None):
+        with self._lock:
+            i = bisect.bisect_left(self._sorted, prefix)
+            j = bisect.bisect_left(self._sorted, prefix + "\uffff", i)
+            if limit is not None:
+                j = min(j, i + limit)
+            return [self._keys[transaction_id] for transaction_id in self._sorted[i:j]]
+
+
+# Search filters shared by the repositories:
+#   user_id, status (comma list), item, transaction_prefix, from/to (YYYY-MM-DD, inclusive)
+# Results come in (timestamp, key) order; `after` is the (timestamp, key) of the last
+# result already shown (see search_cursor), so pages are keyset-paginated.
+def search_cursor(key, record):
+    return (record.get("timestamp") or "", key)
+
+
+def _search_bounds(filters):
+    lower = (filters["from"],) if filters.get("from") else None
+    upper = filters["to"] + "\uffff" if filters.get("to") else None
+    return lower, upper
+
+
+# The same bounds and cursor as index positions: the first position to return and
+# the first timestamp past the "to" day
+def _position_bounds(filters, after):
+    start = index_position(after[1], {"timestamp": after[0]}) if after else None
+    if filters.get("from"):
+        lower = (timestamp_micros(filters["from"]),)
+        start = max(start, lower) if start else lower
+    end = None
+    if filters.get("to"):
+        end = timestamp_micros(filters["to"]) + 86400 * 10**6
+    return start, end
+
+
+def _search_matcher(filters):
+    statuses = set(filters["status"].split(",")) if filters.get("status") else None
+    user_id = filters.get("user_id")
+    item = filters.get("item")
+    prefix = filters.get("transaction_prefix")
+
+    def matches(record):
+        if statuses and record.get("status") not in statuses:
+            return False
+        if user_id and record.get("user_id") != user_id:
+            return False
+        if item and record.get("item") != item:
+            return False
+        if prefix and not (record.get("transaction_id") or "").startswith(prefix):
+            return False
+        return True
+    return matches
+
+
+# A compare-and-set matches only if the stored record is unchanged as a whole, so a
+# concurrent edit to any field (not just the status) makes it fail and retry
+def _same_version(current, expected):
+    if current is None or expected is None:
+        return current is expected
+    return current.to_dict() == expected
+
+
+# Repository over a JournalStore. The loaded dict is the source of truth for reads,
+# so this backend is only safe for a single bot process. Records are held as
+# CompactRecord; reads hand out plain dicts, like the SQL backends do.
+class JournalRepository:
+    prefix_sort_limit = 2000
+
+    def __init__(self, snapshot_path, compact_every=1000):
+        self.store = JournalStore(snapshot_path, compact_every=compact_every)
+        self.records = {}
+        self.status_index = BucketIndex("status")
+        self.user_index = BucketIndex("user_id", skip_missing=True)
+        self.item_index = BucketIndex("item", skip_missing=True)
+        self.transaction_index = TransactionIndex()
+        self._cas_lock = threading.Lock()
+        self._records_lock = threading.Lock()
+
+    def load_all(self):
+        self.records = self.store.load()
+        # Packed in place, so the loaded dicts are freed as we go
+        for key, record in self.records.items():
+            packed = self.records[key] = CompactRecord.pack(record)
+            self._index(key, packed)
+        self.transaction_index.load(self.records)
+        return self.records
+
+    # Index `record` in place of `previous` (None for an insert or a delete)
+    def _index(self, key, record, previous=None):
+        position = index_position(key, record) if record is not None else None
+        previous_position = index_position(key, previous) if previous is not None else None
+        for index in (self.status_index, self.user_index, self.item_index):
+            index.update(record, position, previous, previous_position)
+
+    def get(self, key):
+        record = self.records.get(key)
+        return record.to_dict() if record is not None else None
+
+    def put(self, key, record):
+        packed = CompactRecord.pack(record)
+        # Indexed under the lock, so concurrent writes to one key move it in the same order
+        with self._records_lock:
+            previous = self.records.get(key)
+            self.records[key] = packed
+            self._index(key, packed, previous)
+            self.transaction_index.update(key, packed, previous)
+        self.store.put(key, record)
+
+    # Write `record` only if the stored one still equals `expected` (as read with
+    # get(); expected None: only if there is no record yet)
+    def compare_and_set(self, key, expected, record):
+        with self._cas_lock:
+            if not _same_version(self.records.get(key), expected):
+                return False
+            self.put(key, record)
+            return True
+
+    def delete(self, key):
+        with self._records_lock:
+            previous = self.records.pop(key, None)
+            if previous is not None:
+                self._index(key, None, previous)
+                self.transaction_index.update(key, None, previous)
+        self.store.delete(key)
+
+    def find_by_status(self, status, offset=0, limit=None):
+        return [(key, self.records[key].to_dict()) for key in self.status_index.page(status, offset, limit)]
+
+    def count_by_status(self, status):
+        return self.status_index.count(status)
+
+    # Records carrying this user_id (orders), oldest first
+    def find_by_user(self, user_id):
+        return [(key, self.records[key].to_dict()) for key in self.user_index.page(user_id)]
+
+    # Stream records in key order, starting after `after` (for resumable scans).
+    # Walks a snapshot of the keys, so handlers can keep writing while a broadcast or
+    # export streams; records added after the snapshot are not included. batch_size is
+    # unused here (everything is in memory); it is kept to match the SQL signature.
+    def iter_after(self, after="", batch_size=500):
+        with self._records_lock:
+            keys = list(self.records)
+        for key in sorted(key for key in keys if key > after):
+            record = self.records.get(key)
+            if record is not None:
+                yield key, record.to_dict()
+
+    def find_by_transaction_id(self, transaction_id):
+        key = self.transaction_index.get(transaction_id)
+        if key is None or key not in self.records:
+            return None
+        return key, self.records[key].to_dict()
+
+    # Walks the narrowest prebuilt index for the filters (transaction prefix, else the
+    # smallest of the user, item and status buckets, else every status bucket merged by
+    # time) from the cursor, so a page costs about `limit` index steps rather than a
+    # scan of the store
+    def search(self, filters, after=None, limit=10):
+        start, end = _position_bounds(filters, after)
+        keys = None
+        if filters.get("transaction_prefix"):
+            # A short prefix matches too much to sort per page; it is then checked while walking the buckets
+            keys = self.transaction_index.prefix(filters["transaction_prefix"], limit=self.prefix_sort_limit + 1)
+            if len(keys) > self.prefix_sort_limit:
+                keys = None
+        if keys is not None:
+            positions = sorted(index_position(key, self.records[key]) for key in keys if key in self.records)
+            positions = positions[bisect.bisect_right(positions, start):] if start else positions
+        else:
+            statuses = filters["status"].split(",") if filters.get("status") else self.status_index.values()
+            size = sum(self.status_index.count(status) for status in statuses)
+            positions = None
+            for field, index in (("user_id", self.user_index), ("item", self.item_index)):
+                if filters.get(field) and index.count(filters[field]) < size:
+                    size = index.count(filters[field])
+                    positions = index.scan(filters[field], start)
+            if positions is None:
+                positions = heapq.merge(*(self.status_index.scan(status, start) for status in statuses))
+        matches = _search_matcher(filters)
+        results = []
+        for timestamp, key in positions:
+            if end and timestamp >= end:
+                break
+            record = self.records.get(key)
+            if record is not None and matches(record):
+                results.append((key, record.to_dict()))
+                if len(results) >= limit:
+                    break
+        return results
+
+    def close(self):
+        self.store.close()
+
+
+# Shared SQL implementation. Indexed columns are copied out of the record so
+# status/timestamp/transaction/user lookups hit an index; the full record is kept as JSON.
+class SQLRepository:
+    placeholder = "?"
+
+    def __init__(self, table):
+        self.table = table
+
+    def _schema(self):
+        t = self.table
+        return [
+            f"CREATE TABLE IF NOT EXISTS {t} ("
+            "key TEXT PRIMARY KEY, status TEXT, timestamp TEXT, transaction_id TEXT, data TEXT NOT NULL, user_id TEXT, item TEXT)",
+            f"CREATE INDEX IF NOT EXISTS {t}_status_idx ON {t} (status, timestamp)",
+            f"CREATE INDEX IF NOT EXISTS {t}_timestamp_idx ON {t} (timestamp)",
+            f"CREATE INDEX IF NOT EXISTS {t}_transaction_id_idx ON {t} (transaction_id)",
+            f"CREATE INDEX IF NOT EXISTS {t}_user_id_idx ON {t} (user_id, timestamp)",
+            f"CREATE INDEX IF NOT EXISTS {t}_item_idx ON {t} (item, timestamp)",
+        ]
+
+    def _create_schema(self):
+        statements = self._schema()
+        self._query(statements[0])
+        # Tables created before these columns were indexed
+        for column in ("user_id", "item"):
+            try:
+                self._query(f"SELECT {column} FROM {self.table} LIMIT 0")
+            except Exception:
+                self._query(f"ALTER TABLE {self.table} ADD COLUMN {column} TEXT")
+        for statement in statements[1:]:
+            self._query(statement)
+
+    def _columns(self, record):
+        return (
+            record.get("status"), record.get("timestamp"), record.get("transaction_id"), json.dumps(record),
+            record.get("user_id"), record.get("item")
+        )
+
+    def _query(self, sql, params=(), fetch=None):
+        raise NotImplementedError
+
+    def _sql(self, sql):
+        return sql.replace("?", self.placeholder)
+
+    def load_all(self):
+        rows = self._query(f"SELECT key, data FROM {self.table}", fetch="all")
+        return {key: json.loads(data) for key, data in rows}
+
+    def get(self, key):
+        row = self._query(f"SELECT data FROM {self.table} WHERE key = ?", (key,), fetch="one")
+        return json.loads(row[0]) if row else None
+
+    def put(self, key, record):
+        self._query(
+            f"INSERT INTO {self.table} (key, status, timestamp, transaction_id, data, user_id, item) VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET status = excluded.status, timestamp = excluded.timestamp, "
+            "transaction_id = excluded.transaction_id, data = excluded.data, user_id = excluded.user_id, item = excluded.item",
+            (key,) + self._columns(record)
+        )
+
+    # Conditional write: the UPDATE only matches while the stored JSON is still `expected`'s
+    # (records come from json.loads, so dumping `expected` again gives the same text)
+    def compare_and_set(self, key, expected, record):
+        values = self._columns(record)
+        if expected is None:
+            return self._query(
+                f"INSERT INTO {self.table} (key, status, timestamp, transaction_id, data, user_id, item) VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (key) DO NOTHING", (key,) + values
+            ) == 1
+        return self._query(
+            f"UPDATE {self.table} SET status = ?, timestamp = ?, transaction_id = ?, data = ?, user_id = ?, item = ? "
+            "WHERE key = ? AND data = ?",
+            values + (key, json.dumps(expected))
+        ) == 1
+
+    def delete(self, key):
+        self._query(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+
+    # Stream records in key order, starting after `after`, one keyset page at a time
+    def iter_after(self, after="", batch_size=500):
+        while True:
+            rows = self._query(
+                f"SELECT key, data FROM {self.table} WHERE key > ? ORDER BY key LIMIT ?", (after, batch_size), fetch="all"
+            )
+            for key, data in rows:
+                yield key, json.loads(data)
+            if len(rows) < batch_size:
+                return
+            after = rows[-1][0]
+
+    def find_by_status(self, status, offset=0, limit=None):
+        sql = f"SELECT key, data FROM {self.table} WHERE status = ? ORDER BY timestamp, key"
+        params = (status,)
+        if limit is not None:
+            sql += " LIMIT ? OFFSET ?"
+            params += (limit, offset)
+        elif offset:
+            sql += " LIMIT -1 OFFSET ?" if self.placeholder == "?" else " OFFSET ?"
+            params += (offset,)
+        return [(key, json.loads(data)) for key, data in self._query(sql, params, fetch="all")]
+
+    def count_by_status(self, status):
+        return self._query(f"SELECT COUNT(*) FROM {self.table} WHERE status = ?", (status,), fetch="one")[0]
+
+    def find_by_user(self, user_id):
+        rows = self._query(f"SELECT key, data FROM {self.table} WHERE user_id = ? ORDER BY timestamp, key", (user_id,), fetch="all")
+        return [(key, json.loads(data)) for key, data in rows]
+
+    def find_by_transaction_id(self, transaction_id):
+        row = self._query(f"SELECT key, data FROM {self.table} WHERE transaction_id = ?", (transaction_id,), fetch="one")
+        return (row[0], json.loads(row[1])) if row else None
+
+    # Every filter is a range or equality on an indexed column; pages are keyset-paginated on (timestamp, key)
+    def search(self, filters, after=None, limit=10):
+        where, params = [], []
+        if filters.get("user_id"):
+            where.append("user_id = ?")
+            params.append(filters["user_id"])
+        if filters.get("status"):
+            statuses = filters["status"].split(",")
+            where.append(f"status IN ({', '.join('?' * len(statuses))})")
+            params.extend(statuses)
+        if filters.get("item"):
+            where.append("item = ?")
+            params.append(filters["item"])
+        if filters.get("transaction_prefix"):
+            where.append("transaction_id >= ? AND transaction_id < ?")
+            params.extend((filters["transaction_prefix"], filters["transaction_prefix"] + "\uffff"))
+        lower, upper = _search_bounds(filters)
+        if lower:
+            where.append("timestamp >= ?")
+            params.append(lower[0])
+        if upper:
+            where.append("timestamp <= ?")
+            params.append(upper)
+        if after:
+            where.append("(timestamp > ? OR (timestamp = ? AND key > ?))")
+            params.extend((after[0], after[0], after[1]))
+        sql = f"SELECT key, data FROM {self.table}"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY timestamp, key LIMIT ?"
+        params.append(limit)
+        return [(key, json.loads(data)) for key, data in self._query(sql, tuple(params), fetch="all")]
+
+
+# SQLite backend for local use: one connection per thread, WAL so several
+# bot processes on the same host can share the file.
+class SQLiteRepository(SQLRepository):
+    def __init__(self, path, table="subscriptions"):
+        super().__init__(table)
+        self.path = path
+        self._local = threading.local()
+        self._create_schema()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _query(self, sql, params=(), fetch=None):
+        conn = self._connection()
+        with conn:
+            cursor = conn.execute(self._sql(sql), params)
+            if fetch == "one":
+                return cursor.fetchone()
+            if fetch == "all":
+                return cursor.fetchall()
+            return cursor.rowcount
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+# Postgres backend with a threaded connection pool (needs psycopg2)
+class PostgresRepository(SQLRepository):
+    placeholder = "%s"
+
+    def __init__(self, host, dbname, user, password, port=5432, table="subscriptions", minconn=1, maxconn=10):
+        super().__init__(table)
+        try:
+            from psycopg2.pool import ThreadedConnectionPool
+        except ImportError:
+            raise RuntimeError("The postgres storage backend requires psycopg2 (pip install psycopg2-binary)")
+        self.pool = ThreadedConnectionPool(minconn, maxconn, host=host, dbname=dbname, user=user, password=password, port=port)
+        self._create_schema()
+
+    def _query(self, sql, params=(), fetch=None):
+        conn = self.pool.getconn()
+        try:
+            with conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(self._sql(sql), params)
+                    if fetch == "one":
+                        return cursor.fetchone()
+                    if fetch == "all":
+                        return cursor.fetchall()
+                    return cursor.rowcount
+        finally:
+            self.pool.putconn(conn)
+
+    def close(self):
+        self.pool.closeall()
+
+
+# Build the repository selected by STORAGE_BACKEND (journal, sqlite or postgres)
+def open_repository(backend, name, config):
+    if backend == "journal":
+        return JournalRepository(config.get("journal_path") or f"{name}.json", compact_every=config.get("compact_every", 1000))
+    if backend == "sqlite":
+        return SQLiteRepository(config.get("sqlite_path", "bot.db"), table=name)
+    if backend == "postgres":
+        return PostgresRepository(
+            config["db_host"], config["db_name"], config["db_user"], config["db_password"],
+            port=config.get("db_port", 5432), table=name,
+            minconn=config.get("db_pool_min", 1), maxconn=config.get("db_pool_max", 10)
+        )
+    raise ValueError(f"Unknown storage backend: {backend}")
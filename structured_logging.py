@@ -0,0 +1,58 @@
+import json
+import logging
+import logging.handlers
+import queue
+import time
+
+# Event fields lifted from `extra={...}` into each JSON line
+EVENT_FIELDS = ("event", "user_id", "callback", "transaction_id", "latency_ms", "route", "error_code")
+
+
+# One JSON object per line: timestamp, level, logger, message and any event fields
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(record.created)) + f",{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in EVENT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+# QueueHandler that hands the record over untouched. The stock handler formats
+# the message in the caller's thread; deferring it moves %-formatting and JSON
+# encoding onto the listener thread along with the file I/O.
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        return record
+
+
+# Route all logging through a queue to a rotating file handler on a background thread.
+# Rotation is by size, or by time when `rotate_when` is set (e.g. "midnight").
+# Returns the QueueListener; stop it at exit to flush what is still queued.
+def setup_logging(path, level=logging.INFO, fmt="json", max_bytes=10 * 1024 * 1024, backup_count=5, rotate_when=None):
+    if rotate_when:
+        file_handler = logging.handlers.TimedRotatingFileHandler(path, when=rotate_when, backupCount=backup_count, encoding="utf-8")
+    else:
+        file_handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+    if fmt == "json":
+        file_handler.setFormatter(JsonFormatter())
+    else:
+        file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+    root = logging.getLogger()
+    root.setLevel(level)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(DeferredQueueHandler(log_queue))
+    listener.start()
+    return listener
@@ -0,0 +1,97 @@
+import threading
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+
+logger = logging.getLogger(__name__)
+
+SELECTED = "selected"
+PENDING = "pending"
+ACTIVATED = "activated"
+REJECTED = "rejected"
+EXPIRED = "expired"
+
+# event -> (states it may fire from, resulting state). None is "no record yet".
+TRANSITIONS = {
+    "select": ((None,), SELECTED),
+    "request_payment": ((SELECTED,), PENDING),
+    "activate": ((PENDING,), ACTIVATED),
+    "reject": ((PENDING,), REJECTED),
+    "expire": ((ACTIVATED,), EXPIRED),
+}
+
+
+# Lifecycle state of a record. Older selections were stored as "pending" before a
+# payment was requested; without a transaction_id they are still only selected.
+def state_of(record):
+    if record is None:
+        return None
+    status = record.get("status")
+    if status == PENDING and not record.get("transaction_id"):
+        return SELECTED
+    return status
+
+
+# Order lifecycle: selected -> pending -> activated/rejected, activated -> expired.
+# apply() re-reads the record under a per-key lock, checks the event is allowed from
+# its current state, and writes a modified copy with the repository's compare-and-set
+# (matching the whole record as read), so handlers in other threads or processes
+# cannot interleave or overwrite each other's edits. An event that no longer applies (a double click, a second admin
+# approving, a redelivered update) changes nothing and reports applied=False.
+# write_timer() wraps each compare-and-set, e.g. to time store writes.
+class SubscriptionStateMachine:
+    def __init__(self, repository, stripes=64, retries=3, write_timer=nullcontext):
+        self.repository = repository
+        self.retries = retries
+        self.write_timer = write_timer
+        self._locks = [threading.RLock() for _ in range(stripes)]
+
+    @contextmanager
+    def locked(self, key):
+        with self._locks[hash(key) % len(self._locks)]:
+            yield
+
+    # update(record) edits the copy before it is written. Returns (current record or None, applied).
+    def apply(self, key, event, update=None):
+        sources, target = TRANSITIONS[event]
+        return self._write(key, event, sources, target, update)
+
+    # Edit a record without changing its state (by default in any state it can be in)
+    def modify(self, key, update, states=(SELECTED, PENDING, ACTIVATED, REJECTED, EXPIRED)):
+        return self._write(key, "modify", states, None, update)
+
+    def _write(self, key, event, sources, target, update):
+        with self.locked(key):
+            for _ in range(self.retries):
+                current = self.repository.get(key)
+                if state_of(current) not in sources:
+                    return current, False
+                record = dict(current or {})
+                if update:
+                    update(record)
+                if target:
+                    record["status"] = target
+                with self.write_timer():
+                    written = self.repository.compare_and_set(key, current, record)
+                if written:
+                    return record, True
+                logger.info("Concurrent update to %s during %s, retrying", key, event)
+            return self.repository.get(key), False
+
+
+# Bounded set of recently handled keys (callback query IDs), for dropping redelivered updates
+class RecentKeys:
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    # True the first time a key is seen
+    def add(self, key):
+        with self._lock:
+            if key in self._keys:
+                return False
+            self._keys[key] = None
+            if len(self._keys) > self.capacity:
+                self._keys.popitem(last=False)
+            return True
@@ -0,0 +1,73 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from telebot import types
+
+logger = logging.getLogger(__name__)
+
+
+# Webhook receiver: an aiohttp endpoint that accepts Telegram updates and hands
+# each one to a bounded thread pool, so a slow handler (e.g. a stalled send_photo)
+# only occupies one worker instead of blocking every other chat.
+# At most `max_pending` updates are queued or running; beyond that the request
+# waits, which pushes back on Telegram instead of growing memory.
+# `routes` maps extra POST paths (e.g. payment notifications) to fn(body, headers) -> HTTP status,
+# run on the same pool.
+def build_webhook_app(bot, path, workers=8, max_pending=100, secret_token=None, routes=None):
+    from aiohttp import web
+
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="update-worker")
+    slots = None
+
+    def process_update(update):
+        try:
+            bot.process_new_updates([update])
+        except Exception as e:
+            logger.error("Handler failed for update %s: %s", update.update_id, e)
+
+    async def receive_update(request):
+        nonlocal slots
+        if secret_token and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret_token:
+            return web.Response(status=403)
+        if slots is None:
+            slots = asyncio.Semaphore(max_pending)
+        update = types.Update.de_json(await request.text())
+        await slots.acquire()
+        future = asyncio.get_running_loop().run_in_executor(executor, process_update, update)
+        future.add_done_callback(lambda _: slots.release())
+        return web.Response()
+
+    def route_handler(fn):
+        async def receive(request):
+            body = await request.read()
+            try:
+                status = await asyncio.get_running_loop().run_in_executor(executor, fn, body, request.headers)
+            except Exception as e:
+                logger.error("Handler for %s failed: %s", request.path, e)
+                status = 500
+            return web.Response(status=status)
+        return receive
+
+    async def shutdown(app):
+        executor.shutdown(wait=True)
+
+    app = web.Application()
+    app.router.add_post(path, receive_update)
+    for route_path, fn in (routes or {}).items():
+        app.router.add_post(route_path, route_handler(fn))
+    app.on_cleanup.append(shutdown)
+    return app
+
+
+# Register the webhook with Telegram and serve it until interrupted
+def run_webhook(bot, url, host, port, path="/telegram", workers=8, max_pending=100, secret_token=None, routes=None):
+    from aiohttp import web
+
+    # Updates are already dispatched on our pool; skip telebot's own worker threads
+    bot.threaded = False
+    app = build_webhook_app(bot, path, workers=workers, max_pending=max_pending, secret_token=secret_token, routes=routes)
+    bot.remove_webhook()
+    bot.set_webhook(url=url.rstrip("/") + path, secret_token=secret_token)
+    logger.info("Webhook registered at %s%s, listening on %s:%s with %s workers", url.rstrip('/'), path, host, port, workers)
+    web.run_app(app, host=host, port=port, print=None)
@@ -0,0 +1,319 @@
+import argparse
+import fcntl
+import multiprocessing
+import os
+import threading
+import time
+import zlib
+import logging
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+# Multi-process mode: one front receiver polls Telegram and hands every update to one
+# of N worker processes, chosen by chat ID, so each chat's updates are handled in
+# order by a single worker while different chats run on different cores.
+#
+#   STORAGE_BACKEND=sqlite python workers.py --workers 4
+#
+# Workers import bot.py and share its SQL store (the journal backend is single-process).
+# The worker holding the leader lock runs the scheduled jobs (expiry scheduler, payment
+# watcher, broadcasts, analytics) and sends admin notifications; the other workers
+# forward those to it over a queue. If the leader dies, a follower takes the lock over.
+# Each worker sends through its own outbound queue at OUTBOUND_GLOBAL_RATE / N messages
+# per second, so together they stay within the bot token's global limit.
+
+
+# The chat an update belongs to (0 if it has none, e.g. a poll update)
+def update_chat_id(update):
+    for field in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        if field in update:
+            return update[field]["chat"]["id"]
+    query = update.get("callback_query")
+    if query:
+        message = query.get("message") or {}
+        return message.get("chat", {}).get("id", query["from"]["id"])
+    for value in update.values():
+        if isinstance(value, dict) and "from" in value:
+            return value["from"]["id"]
+    return 0
+
+
+# Admin approve/reject buttons are spread by the order they act on instead of the admin
+# chat, so approvals do not all queue behind one worker. They keep no per-chat state
+# (the transitions are compare-and-set), and one keyed by a user's chat ID lands on that
+# user's worker, after the user's own payment request.
+SPREAD_CALLBACKS = ("activate_", "reject_")
+
+
+def partition_key(update):
+    data = (update.get("callback_query") or {}).get("data") or ""
+    for prefix in SPREAD_CALLBACKS:
+        if data.startswith(prefix):
+            key = data[len(prefix):]
+            return int(key) if key.isdigit() else zlib.crc32(key.encode())
+    return update_chat_id(update)
+
+
+def worker_for(update, count):
+    return partition_key(update) % count
+
+
+# Exclusive lock on a file, held for as long as the process lives; the OS drops it
+# when the holder exits, however it exits
+class LeaderLock:
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def try_acquire(self):
+        if self._file is not None:
+            return True
+        f = open(self.path, "a")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        self._file = f
+        return True
+
+    # Retry every `interval` seconds on a background thread; on_elected() runs once the lock is held
+    def watch(self, on_elected, interval=5):
+        def run():
+            while not self.try_acquire():
+                time.sleep(interval)
+            on_elected()
+        threading.Thread(target=run, name="leader-election", daemon=True).start()
+
+
+# Stand-in for a leader-owned object on follower workers: method calls are sent to
+# the leader as (name, method, args, kwargs) and return nothing
+class LeaderProxy:
+    def __init__(self, channel, name):
+        self._channel = channel
+        self._name = name
+
+    def __getattr__(self, method):
+        def forward(*args, **kwargs):
+            self._channel.put((self._name, method, args, kwargs))
+        return forward
+
+
+def forwarded_future():
+    future = Future()
+    future.set_result(None)
+    return future
+
+
+# Leader side: run calls forwarded by followers against `targets` (name -> object)
+# until a None arrives. Returns the thread doing it.
+def serve_leader_channel(channel, targets):
+    def run():
+        while True:
+            call = channel.get()
+            if call is None:
+                break
+            name, method, args, kwargs = call
+            try:
+                target = targets[name]
+                (getattr(target, method) if method else target)(*args, **kwargs)
+            except Exception as e:
+                logger.error("Forwarded call %s.%s failed: %s", name, method, e)
+    thread = threading.Thread(target=run, name="leader-channel", daemon=True)
+    thread.start()
+    return thread
+
+
+# Worker process entry point: import the bot (running its startup only if this worker
+# is the leader) and handle updates from `updates` one at a time, in arrival order.
+# Reports ("ready", index, role) once loaded, ("leader", index) if promoted later and
+# ("handled", index, seconds, error) per update.
+def worker_main(index, count, updates, leader_channel, events, lock_path, env):
+    os.environ.update(env)
+    lock = LeaderLock(lock_path)
+    leader = lock.try_acquire()
+    os.environ["BOT_ROLE"] = "leader" if leader else "follower"
+    os.environ["BOT_WORKER"] = f"{index}/{count}"
+    import bot
+    from telebot import types
+
+    # Handlers run on this thread, one update at a time, so a chat's updates keep their order
+    bot.bot.threaded = False
+    channel_thread = [bot.start_worker(leader_channel, leader)]
+
+    def promoted():
+        channel_thread[0] = bot.become_leader(leader_channel)
+        events.put(("leader", index))
+
+    if not leader:
+        lock.watch(promoted)
+    events.put(("ready", index, os.environ["BOT_ROLE"]))
+    while True:
+        data = updates.get()
+        if data is None:
+            break
+        started = time.perf_counter()
+        error = None
+        try:
+            bot.bot.process_new_updates([types.Update.de_json(data)])
+        except Exception as e:
+            error = repr(e)
+            logger.error("Worker %s failed on update %s: %s", index, data.get("update_id"), e)
+        events.put(("handled", index, time.perf_counter() - started, error))
+    # The leader first runs what the (already stopped) followers forwarded
+    if channel_thread[0] is not None:
+        channel_thread[0].join(30)
+    bot.outbound.drain(30)
+    events.put(("stopped", index, None))
+
+
+# Front side: the worker processes and their queues. dispatch() blocks while the chosen
+# worker already has `queue_size` updates waiting, which slows polling down instead of
+# growing memory. Workers that die are restarted by check().
+class WorkerPool:
+    def __init__(self, count, lock_path="bot.leader.lock", queue_size=1000, env=None, on_event=None):
+        self.count = count
+        self.lock_path = lock_path
+        self.env = env or {}
+        self.on_event = on_event
+        self._context = multiprocessing.get_context("spawn")
+        self.queues = [self._context.Queue(queue_size) for _ in range(count)]
+        self.leader_channel = self._context.Queue()
+        self.events = self._context.Queue()
+        self.processes = [None] * count
+        self.roles = [None] * count
+        self.ready = [threading.Event() for _ in range(count)]
+        self.handled = [0] * count
+
+    # Worker 0 starts first and, holding the leader lock, runs the bot's one-time startup
+    # migrations before any other worker loads the store
+    def start(self, timeout=300):
+        threading.Thread(target=self._read_events, name="worker-events", daemon=True).start()
+        for index in range(self.count):
+            self._spawn(index)
+            if index == 0 and not self.ready[0].wait(timeout):
+                raise RuntimeError("Worker 0 did not start")
+        for event in self.ready:
+            event.wait(timeout)
+        logger.info("Started %s bot workers", self.count)
+
+    # Each worker logs to its own file (bot.log -> bot.0.log, ...): rotation is per process
+    def _spawn(self, index):
+        env = dict(self.env)
+        root, ext = os.path.splitext(os.getenv("LOG_FILE", "bot.log"))
+        env["LOG_FILE"] = f"{root}.{index}{ext}"
+        if int(os.getenv("METRICS_PORT", "0")):
+            env["METRICS_PORT"] = str(int(os.getenv("METRICS_PORT")) + 1 + index)
+        process = self._context.Process(
+            target=worker_main, name=f"bot-worker-{index}", daemon=True,
+            args=(index, self.count, self.queues[index], self.leader_channel, self.events, self.lock_path, env),
+        )
+        process.start()
+        self.processes[index] = process
+
+    def _read_events(self):
+        while True:
+            event = self.events.get()
+            if event[0] == "ready":
+                self.roles[event[1]] = event[2]
+                self.ready[event[1]].set()
+                logger.info("Worker %s ready as %s", event[1], event[2])
+            elif event[0] == "leader":
+                self.roles[event[1]] = "leader"
+                logger.info("Worker %s took over as leader", event[1])
+            elif event[0] == "handled":
+                self.handled[event[1]] += 1
+            if self.on_event:
+                self.on_event(event)
+
+    def dispatch(self, update):
+        self.queues[worker_for(update, self.count)].put(update)
+
+    def check(self):
+        for index, process in enumerate(self.processes):
+            if process is not None and not process.is_alive():
+                logger.error("Worker %s exited with code %s; restarting it", index, process.exitcode)
+                self.ready[index].clear()
+                self.roles[index] = None
+                self._spawn(index)
+
+    # Let every worker finish what is queued, drain its sends and exit: followers first,
+    # then the leader, once it has run everything they forwarded to it
+    def stop(self, timeout=60):
+        followers = [index for index in range(self.count) if self.roles[index] != "leader"]
+        leaders = [index for index in range(self.count) if self.roles[index] == "leader"]
+        for group in (followers, leaders):
+            if group is leaders:
+                self.leader_channel.put(None)
+            for index in group:
+                self.queues[index].put(None)
+            for index in group:
+                process = self.processes[index]
+                if process is None:
+                    continue
+                process.join(timeout)
+                if process.is_alive():
+                    logger.error("Worker %s did not stop within %ss; terminating it", index, timeout)
+                    process.terminate()
+
+
+def use_api_url(url):
+    import telebot
+
+    if url:
+        telebot.apihelper.API_URL = url.rstrip("/") + "/bot{0}/{1}"
+
+
+# Poll Telegram and dispatch updates until interrupted
+def run_receiver(pool, token, poll_timeout=20, check_interval=5):
+    import telebot
+
+    offset = None
+    last_check = time.monotonic()
+    failures = 0
+    while True:
+        try:
+            updates = telebot.apihelper.get_updates(token, offset=offset, timeout=poll_timeout, long_polling_timeout=poll_timeout)
+            failures = 0
+        except Exception as e:
+            failures += 1
+            logger.error("Polling failed: %s", e)
+            time.sleep(min(2 ** failures, 60))
+            continue
+        for update in updates:
+            pool.dispatch(update)
+            offset = update["update_id"] + 1
+        if time.monotonic() - last_check >= check_interval:
+            pool.check()
+            last_check = time.monotonic()
+
+
+def main():
+    from dotenv import load_dotenv
+    from structured_logging import setup_logging
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Run the bot as a front receiver and N worker processes")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WORKERS", str(os.cpu_count() or 2))))
+    parser.add_argument("--lock", default=os.getenv("LEADER_LOCK_FILE", "bot.leader.lock"))
+    args = parser.parse_args()
+    if os.getenv("STORAGE_BACKEND", "journal") == "journal":
+        parser.error("worker mode needs a shared store: set STORAGE_BACKEND=sqlite or postgres")
+    token = os.getenv("TELEGRAM_BOT_TOKEN")
+    use_api_url(os.getenv("TELEGRAM_API_URL"))
+
+    listener = setup_logging(os.getenv("FRONT_LOG_FILE", "front.log"), level=os.getenv("LOG_LEVEL", "INFO"), fmt=os.getenv("LOG_FORMAT", "json"))
+    pool = WorkerPool(args.workers, lock_path=args.lock)
+    pool.start()
+    try:
+        run_receiver(pool, token)
+    except KeyboardInterrupt:
+        logger.info("Stopping workers")
+        pool.stop()
+    finally:
+        listener.stop()
+
+
+if __name__ == "__main__":
+    main()